@@ -22,11 +22,16 @@ import sys
 import boto.ec2
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from boto.s3.bucket import Bucket
 
 import os
 import signal
 import commands
 import random
+import shutil
+import hashlib
+import threading
+import Queue
 
 import logging
 import datetime 
@@ -105,6 +110,7 @@ def myexit( exitcode ) :
                 checkedBucketWrite( cfgStack[n]["computationLogFileName"], cfgStack[n]["reportFileName"], bucket )
             else :
                 checkedBucketWrite( computationLogFileName, cfgStack[n]["reportFileName"], bucket )
+            deleteLogSegments( cfgStack[n]["reportFileName"], bucket )
                 
 
         # also copy over any files indicated as key="resultFile_*"
@@ -147,6 +153,7 @@ def myexit( exitcode ) :
             logger.info('self-terminating head node. (set "keepHead":"True" in config if you do not want this)')
         # copy logfiles to S3
         checkedBucketWrite(logFileName, parameters["logFileName"], bucket)
+        deleteLogSegments(parameters["logFileName"], bucket)
         checkedBucketWrite("/mnt/eca-rmpi", parameters["s3JobDir"]+"/start_node.log", bucket)
 
         if ( not keepHead ) :
@@ -199,66 +206,204 @@ def updatePrompt ( fname, prompt ) :
         return 
     return
 
-# read a file (or semicolon separated list of files)
-def checkedBucketRead (semicolonSeparatedFileNameList, bucket, dataDir) :
-    fileNameList = semicolonSeparatedFileNameList.split(";")
-    for fileName in fileNameList :
-        if None == bucket.get_key(fileName) :
-            logger.error(fileName + " missing from bucket " + bucket.name)
-        localFilename = dataDir + fileName
-        # make sure target directory exists
-        if ( not os.path.exists(os.path.dirname(localFilename))) :       
-            os.makedirs(os.path.dirname(localFilename))             
-        
-        # it can get pretty busy at startup - do retry - randomize, wait longer for repeated failures
-        maxRetries = 20
-        retriesLeft = maxRetries
-        while (retriesLeft > 0) :
+#
+# S3 downloads: files are fetched by a pool of worker threads (sized to the instance type, or
+# set with "downloadWorkers") as ranged GETs of downloadPartSizeMB each.  Parts are written in
+# place as they arrive, and folded into the file's MD5 in order as they become contiguous, so
+# there's no second pass over the file - to keep memory bounded, a part isn't started until
+# it's within a few parts of the last one hashed.
+#
+downloadWorkersBySize = { "micro":2, "small":2, "medium":4, "large":4, "xlarge":8 } # anything bigger gets 16
+
+def getDownloadWorkers() :
+    if ("downloadWorkers" in parameters) :
+        return max(1,int(parameters["downloadWorkers"]))
+    instanceType = systemCmd("wget -qO- http://169.254.169.254/latest/meta-data/instance-type", wantOutput=True, tolerateFailure=True).strip()
+    size = instanceType.split(".")[-1]
+    if (size in downloadWorkersBySize) :
+        return downloadWorkersBySize[size]
+    elif (size.endswith("xlarge")) :
+        return 16
+    return 4
+
+def getDownloadPartSize() :
+    return int(float(parameters.get("downloadPartSizeMB","8"))*1024*1024)
+
+class RangedDownload :
+    def __init__(self, key, localFilename, partSize, window) :
+        self.name = key.name
+        self.localFilename = localFilename
+        # the hex digest version of the MD5 hash from S3 - called the "etag" in aws parlance
+        # (this comes back as a string surrounded by double-quote characters)
+        self.s3HexMD5 = key.etag.replace('\"','')
+        self.size = key.size
+        self.partSize = partSize
+        self.nparts = (self.size+partSize-1)/partSize
+        self.window = window
+        self.md5 = hashlib.md5()
+        self.hashed = 0 # parts folded into the MD5 so far
+        self.held = {} # parts that arrived ahead of their turn in the MD5
+        self.failed = False
+        self.cond = threading.Condition()
+        f = open(self.localFilename+".part", "wb")
+        f.truncate(self.size)
+        f.close()
+
+    def fetchPart(self, bucket, n) :
+        self.cond.acquire()
+        while ((n-self.hashed >= self.window) and not self.failed) :
+            self.cond.wait()
+        self.cond.release()
+        if (self.failed) :
+            return
+        start = n*self.partSize
+        end = min(self.size, start+self.partSize)-1
+        data = None
+        for attempt in range(5) :
             try:
-                k=bucket.get_key(fileName)
-                if k == None:
-                    logger.error(fileName + " missing from bucket " + bucket.name)
-                # else ok -- file found
-
-                # get the hex digest version of the MD5 hash from S3-- called the "etag" in aws parlance
-                # (this comes back as a string surrounded by double-quote characters)
-                s3HexMD5 = k.etag.replace('\"','')
-                s3FileSize = k.size
-                k.get_contents_to_filename(localFilename)
-
-                # calculate local hash after download
-                try:
-                    fp = open(localFilename, "r")
-                    (localHexMD5,localB64MD5) = k.compute_md5(fp)
-                    fp.close()
-                    localFileSize = os.path.getsize(localFilename)
-                    
-                except:
-                    logger.warn("error: could not open local file for comparison!")
-                    raise
+                data = Key(bucket, self.name).get_contents_as_string(headers={"Range":"bytes=%d-%d" % (start, end)})
+                if (len(data) == end+1-start) :
+                    f = open(self.localFilename+".part", "r+b")
+                    f.seek(start)
+                    f.write(data)
+                    f.close()
+                    break
+                logger.warn("%s: got %d bytes for range %d-%d" % (self.name, len(data), start, end))
+            except Exception, exception:
+                logger.warn("%s: retry of range %d-%d due to exception on download from S3: %s" % (self.name, start, end, exception))
+            data = None
+            sleep( randrange( 1, 5+(2*attempt) ) )
+        self.cond.acquire()
+        if (None == data) :
+            self.failed = True
+        else :
+            self.held[n] = data
+            while (self.hashed in self.held) :
+                self.md5.update(self.held.pop(self.hashed))
+                self.hashed += 1
+        self.cond.notifyAll()
+        self.cond.release()
+
+    # check size and MD5, and put the file in place - returns True on success
+    def finish(self) :
+        if (self.failed or (self.hashed != self.nparts)) :
+            return False
+        if (os.path.getsize(self.localFilename+".part") != self.size):
+            logger.warn("%s: local and downloaded file sizes do not match." % self.name)
+            return False
+        if ("-" in self.s3HexMD5) : # multipart upload, etag isn't the MD5 of the whole file
+            logger.info("%s: multipart upload, verified size only" % self.name)
+        elif (self.s3HexMD5 != self.md5.hexdigest()):
+            logger.warn("%s: md5 sums did not match" % self.name)
+            return False
+        os.rename(self.localFilename+".part", self.localFilename)
+        return True
+
+def downloadWorker(tasks, bucketName) :
+    bucket = Bucket(S3Connection( parameters["aws_access_key_id"], parameters["aws_secret_access_key"] ), bucketName) # connections aren't shared between threads
+    while True :
+        try:
+            (download, n) = tasks.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            download.fetchPart(bucket, n)
+        except Exception, exception:
+            logger.error("%s: download failed: %s" % (download.name, exception))
+            download.cond.acquire()
+            download.failed = True
+            download.cond.notifyAll()
+            download.cond.release()
+
+# download a list of (S3 filename, local data directory) pairs, all at once
+def checkedBucketReadAll (fileList, bucket) :
+    nworkers = getDownloadWorkers()
+    partSize = getDownloadPartSize()
+    # it can get pretty busy at startup - do retry - randomize, wait longer for repeated failures
+    maxRetries = 20
+    retriesLeft = maxRetries
+    pending = fileList
+    while (len(pending) and (retriesLeft > 0)) :
+        downloads = []
+        tasks = Queue.Queue()
+        for (fileName, dataDir) in pending :
+            localFilename = dataDir + fileName
+            # make sure target directory exists
+            if ( not os.path.exists(os.path.dirname(localFilename))) :
+                os.makedirs(os.path.dirname(localFilename))
+            try:
+                k = bucket.get_key(fileName)
+            except Exception, exception:
+                logger.warn( str(fileName) + ": retry due to exception on S3 lookup: " + str(exception))
+                k = None
+            if (None == k) :
+                logger.error(fileName + " missing from bucket " + bucket.name)
+                continue
+            download = RangedDownload(k, localFilename, partSize, 2*nworkers)
+            downloads.append((fileName, dataDir, download))
+            for n in range(download.nparts) :
+                tasks.put((download, n))
+        logger.info("downloading %d files (%d parts) from S3 with %d workers" % (len(downloads), tasks.qsize(), nworkers))
+        workers = [threading.Thread(target=downloadWorker, args=(tasks, bucket.name)) for n in range(min(nworkers, tasks.qsize()))]
+        for w in workers :
+            w.start()
+        for w in workers :
+            w.join()
+        failed = [(fileName, dataDir) for (fileName, dataDir) in pending if not [d for d in downloads if (d[0] == fileName) and (d[1] == dataDir)]]
+        for (fileName, dataDir, download) in downloads :
+            if (download.finish()) :
+                try :
+                    cmd = "chmod a+r " + download.localFilename
+                    os.system(cmd)
+                except Exception, exception:
+                    logger.error( exception )
+                    logger.error("command \""+cmd+"\" failed")
+            else :
+                failed.append((fileName, dataDir))
+        pending = failed
+        if (len(pending)) :
+            logger.warn( "%d files to retry: %s" % (len(pending), ", ".join([f for (f, d) in pending])) )
+            sleep( randrange( maxRetries+3-retriesLeft, maxRetries+15-retriesLeft) )
+            retriesLeft -= 1
 
-                if (localFileSize != s3FileSize):
-                    logger.warn("local and downloaded file sizes do not match.")
-                    raise Exception()
+#
+# with "sharedDataViaNFS":"True" the head node downloads the sharedFile_* data just once, into
+# the NFS export, and the clients use it from there instead of each pulling its own copy from S3.
+# Data dirs get a link to the NFS copy, except for files given as "sharedFile_Local_*", which the
+# clients copy to local disk for faster I/O.
+#
+nfsDataDir = "/mnt/nfs-shared/data/"
+nfsDataReadyFileName = nfsDataDir + ".eca-data-ready" # head writes this once the downloads are done
 
-                if (s3HexMD5 != localHexMD5):
-                    logger.warn("md5 sums did not match")
-                    raise Exception()
+def sharedDataViaNFS() :
+    return ( "sharedDataViaNFS" in parameters ) and ( "True" == parameters["sharedDataViaNFS"] )
 
-                # if here, ok!
-                
-                retriesLeft = 0
-            except:
-                logger.warn( str(fileName) + ": retry due to exception on download from S3: " + str(sys.exc_info()[0]))
-                sleep( randrange( maxRetries+3-retriesLeft, maxRetries+15-retriesLeft) )
-                retriesLeft -= 1
+# the sharedFile_* data for all configs, as (S3 filename, data dir, wants a local copy)
+def sharedFileList() :
+    files = []
+    for cfg in cfgStack :
+        for cfgKey,val in cfg.iteritems():
+            if (cfgKey.startswith("sharedFile_")):
+                files.extend([(fileName, cfg["dataDir"], cfgKey.startswith("sharedFile_Local_")) for fileName in val.split(";")])
+    return sorted(set(files))
+
+# put the NFS copy of a shared file in a data dir
+def placeSharedFile(fileName, dataDir, wantLocalCopy) :
+    localFilename = dataDir + fileName
+    if ( not os.path.exists(os.path.dirname(localFilename))) :
+        os.makedirs(os.path.dirname(localFilename))
+    if (os.path.lexists(localFilename)) :
+        os.remove(localFilename)
+    if (wantLocalCopy) :
+        shutil.copyfile(nfsDataDir + fileName, localFilename+".part")
+        os.rename(localFilename+".part", localFilename)
+        systemCmd("chmod a+r " + localFilename)
+    else :
+        os.symlink(nfsDataDir + fileName, localFilename)
 
-        try :
-            cmd = "chmod a+r " + localFilename
-            os.system(cmd)
-        except Exception, exception:
-            logger.error( exception )
-            logger.error("command \""+cmd+"\" failed")
+# read a file (or semicolon separated list of files)
+def checkedBucketRead (semicolonSeparatedFileNameList, bucket, dataDir) :
+    checkedBucketReadAll([(fileName, dataDir) for fileName in semicolonSeparatedFileNameList.split(";")], bucket)
 
 def checkedBucketWrite ( localFileName, targetFileName, bucket, showMsg = True ) :
     try:
@@ -271,12 +416,67 @@ def checkedBucketWrite ( localFileName, targetFileName, bucket, showMsg = True )
     except:
         logger.error( "error uploading file " + localFileName + " to S3 " + targetFileName )
 
+#
+# log shipping: rather than uploading whole log files over and over, ship just the text added
+# since last time, as numbered segments "<target>.gen0.seg000000", "<target>.gen0.seg000001"...
+# which the launcher reads in order (see S3LogTail in eca_launch_helper.py).  A file that gets
+# truncated and rewritten starts a new generation, "<target>.gen1.seg000000" and so on.
+#
+maxLogSegmentSize = 4*1024*1024
+
+def logSegmentName( targetFileName, generation, n ) :
+    return "%s.gen%d.seg%06d" % ( targetFileName, generation, n )
+
+class LogShipper :
+    def __init__(self, localFileName, targetFileName, bucket) :
+        self.localFileName = localFileName
+        self.targetFileName = targetFileName
+        self.bucket = bucket
+        self.offset = 0 # bytes shipped so far
+        self.generation = 0
+        self.segment = 0 # next segment number
+
+    # upload anything new - nothing at all if the file hasn't grown
+    def ship(self) :
+        if ( not os.path.isfile( self.localFileName ) ) :      # make sure local file exists
+            return
+        size = os.path.getsize( self.localFileName )
+        if ( size < self.offset ) : # rewritten rather than appended to, ship it again from the top
+            self.offset = 0
+            if ( self.segment > 0 ) : # (an empty generation can just start over)
+                self.generation += 1
+                self.segment = 0
+        while ( self.offset < size ) :
+            f = open( self.localFileName, "rb" )
+            f.seek( self.offset )
+            data = f.read( min( maxLogSegmentSize, size-self.offset ) )
+            f.close()
+            if ( not data ) :
+                return
+            try:
+                k = Key( self.bucket )
+                k.key = logSegmentName( self.targetFileName, self.generation, self.segment )
+                k.set_contents_from_string( data )
+            except:
+                logger.error( "error uploading new text of " + self.localFileName + " to S3 " + k.key )
+                return # try again next time
+            self.offset += len( data )
+            self.segment += 1
+
+# once the whole file is in S3, its segments aren't needed
+def deleteLogSegments( targetFileName, bucket ) :
+    try:
+        for k in bucket.list( prefix = targetFileName+".gen" ) :
+            k.delete()
+    except:
+        logger.error( "error deleting log segments of S3 " + targetFileName )
+
 def fileMonitor ( localFileNameList, targetFileNameList, bucket, wait ) :
+    shippers = [ LogShipper( localFileNameList[ ix ], targetFileNameList[ ix ], bucket ) for ix in range( len( localFileNameList ) ) ]
     sleep( wait )
     while ( True ) :
-        for ix in range( len( localFileNameList ) ) :       
-            if ( os.path.isfile( localFileNameList[ ix ] ) ) :      # make sure local file exists
-                checkedBucketWrite( localFileNameList[ ix ], targetFileNameList[ ix ], bucket, False )
+        for shipper in shippers :
+            shipper.ship()
         sleep( wait )
 
 wait = 10   # much less than this and AWS gets irritated and throttles you back
@@ -509,18 +709,31 @@ if ( mode == "head" ) :
         
         logger.info("downloading R script and data files from S3 while we wait for clients to connect")
         # go through the config parameters, anything named "sharedFile_*" gets copied to data dir
+        downloadList = []
+        if ( sharedDataViaNFS() ) : # one copy of the data, in the NFS export
+            downloadList.extend([(fileName, nfsDataDir) for (fileName, dataDir, wantLocalCopy) in sharedFileList()])
         for cfg in cfgStack :
             for cfgKey,val in cfg.iteritems():
-                if (cfgKey.startswith("sharedFile_")):    
-                    checkedBucketRead(val, bucket, cfg["dataDir"])
-            checkedBucketRead(cfg["scriptFileName"], bucket, cfg["dataDir"])
-            checkedBucketRead(cfg["RMPI_FrameworkScriptFileName"], bucket, cfg["dataDir"])
-            checkedBucketRead(cfg["frameworkSupportScript"], bucket, cfg["dataDir"])
+                if (cfgKey.startswith("sharedFile_") and not sharedDataViaNFS()):    
+                    downloadList.extend([(fileName, cfg["dataDir"]) for fileName in val.split(";")])
+            downloadList.append((cfg["scriptFileName"], cfg["dataDir"]))
+            downloadList.append((cfg["RMPI_FrameworkScriptFileName"], cfg["dataDir"]))
+            downloadList.append((cfg["frameworkSupportScript"], cfg["dataDir"]))
             # execute the R package installation script if provided
             if "packageInstaller" in cfg :
-                checkedBucketRead(cfg["packageInstaller"], bucket, cfg["dataDir"])
+                downloadList.append((cfg["packageInstaller"], cfg["dataDir"]))
 
             n = n+1
+        checkedBucketReadAll(sorted(set(downloadList)), bucket) # configs may share files
+        if ( sharedDataViaNFS() ) :
+            for (fileName, dataDir, wantLocalCopy) in sharedFileList() :
+                if (os.path.isfile(nfsDataDir + fileName)) :
+                    placeSharedFile(fileName, dataDir, False) # the NFS export is local disk here
+            systemCmd("chmod -R a+rX " + nfsDataDir)
+            readyFile = open(nfsDataReadyFileName, "w")
+            readyFile.write(str(datetime.datetime.utcnow()))
+            readyFile.close()
+            logger.info("shared data is in %s for clients" % nfsDataDir)
         logger.info("S3 downloads complete")
         
         logger.info("waiting for all nodes to report ready")
@@ -686,13 +899,17 @@ elif mode == "client":
 
     logger.info("downloading R script and data files from S3")
     # go through the config parameters, anything named "sharedFile_*" gets copied to data dir
+    downloadList = []
     for cfg in cfgStack :
         for cfgKey,val in cfg.iteritems():
-            if (cfgKey.startswith("sharedFile_")):    
-                checkedBucketRead(val, bucket, cfg["dataDir"])
+            if (cfgKey.startswith("sharedFile_") and not sharedDataViaNFS()): # else we get it from the head node, below
+                downloadList.extend([(fileName, cfg["dataDir"]) for fileName in val.split(";")])
+        if "packageInstaller" in cfg :
+            downloadList.append((cfg["packageInstaller"], cfg["dataDir"]))
+    checkedBucketReadAll(sorted(set(downloadList)), bucket) # configs may share files
+    for cfg in cfgStack :
         # execute the R package installation script if provided
         if "packageInstaller" in cfg :
-            checkedBucketRead(cfg["packageInstaller"], bucket, cfg["dataDir"])
             packageInstaller = cfg[ "dataDir" ] + cfg["packageInstaller"]
             args = [ safeRscript, packageInstaller ]
             logger.debug( "running R package installer script \"%s\"" % ( packageInstaller ) )
@@ -773,6 +990,26 @@ elif mode == "client":
     # logger.info("  output: %s" % nfsOutput)
     logger.info("nfs service (client mode) started")
 
+    if ( sharedDataViaNFS() ) :
+        # wait for the head node to finish downloading the shared data, then use its copy - anything
+        # it doesn't have by the time we give up waiting, we'll get from S3 ourselves
+        maxwaitMinutes = int(parameters.get("nfsDataWaitMinutes","30"))
+        totalwait = 0
+        while ( (not os.path.isfile(nfsDataReadyFileName)) and (totalwait < 60*maxwaitMinutes) ) :
+            logger.info("waiting for head node to download shared data")
+            sleep( wait )
+            totalwait = totalwait + wait
+        downloadList = []
+        for (fileName, dataDir, wantLocalCopy) in sharedFileList() :
+            if ( os.path.isfile(nfsDataReadyFileName) and os.path.isfile(nfsDataDir + fileName) ) :
+                placeSharedFile(fileName, dataDir, wantLocalCopy)
+            else :
+                downloadList.append((fileName, dataDir))
+        if (len(downloadList)) :
+            logger.warn("%d shared files not available via NFS, downloading them from S3" % len(downloadList))
+            checkedBucketReadAll(downloadList, bucket)
+        logger.info("shared data in place")
+
     # save the client node's IP address for others to find:
     ipFileName="/mnt/nfs-shared/clientnodeinfo/client_%d" % client_id
     logger.info("logging this ip and checking in: %s" % ipFileName)
@@ -22,12 +22,17 @@ import os
 import platform
 import subprocess
 import simplejson as json
-from gzip import GzipFile
 import zlib
+import struct
+import cStringIO
+import multiprocessing
 import base64
 import tempfile
 import fileinput
 import re
+import threading
+import Queue
+from time import sleep
 
 import boto
 import boto.ec2
@@ -40,6 +45,8 @@ import string
 
 from optparse import OptionParser
 
+import hadoop_fs
+
 # current StarCluster AMIs
 CURRENT_RELEASE_AMI_32="ami-8cf913e5"  # starcluster-base-ubuntu-10.04-x86-rc3
 CURRENT_RELEASE_AMI_64="ami-0af31963"  # starcluster-base-ubuntu-10.04-x86_64-rc1
@@ -701,7 +708,7 @@ def constructCacheFileReference( bucketName , jobDirS3 , configName) :
 # filenameKey allows us to get at filename as config["<filenameKey>"]
 # targetDir is the S3 directory we want it to end up in (if blank, then use the directory named in config["<filenameKey>"])
 # if wantGZ is true and config["<filenameKey>"] does not end in ".gz", a local gzipped copy is
-# created and that's what we upload.
+# created and that's what we upload (or with keepGZipCopies False, it's gzipped as it uploads).
 #
 # side effect: config["<filenameKey>"] is changed to the S3 path 
 def uploadToS3(s3FileList, makePublic=False, noRename=False) :
@@ -727,6 +734,7 @@ def uploadToS3(s3FileList, makePublic=False, noRename=False) :
 		s3BucketID = getHadoopDir()
 		
 	entryConfigNum = currentCfgID # so we can restore current config selection at end
+	transfers = [] # (localPath, s3FileName, streamSource) for files that need uploading
 	for filePairs in s3FileList:
 		(fileNameKey, configNum, targetDir, wantGZ) = filePairs
 		selectConfig(configNum)
@@ -747,24 +755,29 @@ def uploadToS3(s3FileList, makePublic=False, noRename=False) :
 						oldS3Path = s3FileName
 						s3FileName = s3FileName+".gz"
 						if (not os.path.exists(localPath)) :
-							log( "creating gzipped copy of "+oldPath+" as "+localPath+" for transfer to S3" )
-							try:
-								file = open(oldPath,"rb")
-								zipper = GzipFile(localPath,"wb")
-								for line in file :
-									zipper.write(line)
-								zipper.close()
-								file.close()
-								setConfig(fileNameKey, localPath)
-							except Exception, exception:
-								log( exception )
-								log( "Failed to create gzipped copy, using original.  This will work but is less efficient" )
-								localPath = oldPath
-								s3FileName = oldS3Path
+							if (not keepGZipCopies()) :
+								log( oldPath+" will be gzipped on the fly as it's uploaded, not keeping a local copy" )
+							else :
+								log( "creating gzipped copy of "+oldPath+" as "+localPath+" for transfer to S3" )
+								tmpPath = localPath+".tmp"
+								try:
+									zipper = open(tmpPath,"wb")
+									gzipStream(oldPath,zipper)
+									zipper.close()
+									os.rename(tmpPath,localPath) # so an interrupted run can't leave a truncated .gz to be trusted later
+									setConfig(fileNameKey, localPath)
+								except Exception, exception:
+									log( exception )
+									log( "Failed to create gzipped copy, using original.  This will work but is less efficient" )
+									if (os.path.exists(tmpPath)) :
+										os.unlink(tmpPath)
+									localPath = oldPath
+									s3FileName = oldS3Path
 						else :
 							log( "based on filename, "+localPath+" appears to be gzipped copy of "+oldPath+" so we'll use that" )
+					streamSource = gzipStreamSource(localPath) # no .gz on disk, we compress as we go
 					# now set config
-					fp=open(localPath,"rb")
+					fp=open(streamSource or localPath,"rb")
 				except Exception, exception:
 					log( exception )
 					log( "error: could not open local file "+ localPath + " for S3 upload comparison! " )
@@ -780,15 +793,11 @@ def uploadToS3(s3FileList, makePublic=False, noRename=False) :
 							if (not hadoopName.startswith("/")) :
 								hadoopName = "/"+hadoopName
 							hadoopName = getHadoopDir()+hadoopName
-						cmd = getHadoopBinary() + " dfs -ls "+hadoopName
-						debug(cmd)
-						lines = os.popen(cmd).readlines()
+						status = getHadoopStatCache().stat(hadoopName)
 						testKey = None
-						for t in lines :
-							if ( t.find(hadoopName) > -1 ) :
-								items = t.split()
-								testKey = Key()
-								testKey.size = int(items[4])
+						if ((None != status) and not status.isDir) :
+							testKey = Key()
+							testKey.size = status.size
 								
 						result = 0
 					except Exception, e :
@@ -799,19 +808,9 @@ def uploadToS3(s3FileList, makePublic=False, noRename=False) :
 				if testKey == None:
 
 					# file was not on S3,
-					# upload if possible, or exit with error otherwise
-					
-					info( "uploading " + localPath + " to " + s3BucketID + "/" + s3FileName )
-					# boto verifies file upload itself
+					# queue for upload, which happens concurrently once all files are checked
 					fp.close()
-					if (runAWS()) :
-						k = Key(s3Bucket)
-					else :
-						k = HadoopConnection()
-					k.key = s3FileName
-					k.set_contents_from_filename(localPath)
-					if ( makePublic ) :
-						k.set_acl('public-read')
+					transfers.append((localPath, s3FileName, streamSource))
 				else:
 					# file is on S3,
 					# if we have a local copy, compare against it
@@ -822,8 +821,24 @@ def uploadToS3(s3FileList, makePublic=False, noRename=False) :
 					# continue with verifying file
 
 					s3FileSize = testKey.size
-
-					localFileSize = os.path.getsize(localPath)
+					nParts = 1
+					recordedPartSize = None
+					if (runAWS()) :
+						# get the hex digest version of the MD5 hash-- called the "etag" in aws parlance
+						# (this comes back as a string surrounded by double-quote characters)
+						s3HexMD5 = testKey.etag.replace('\"','')
+						if ("-" in s3HexMD5) : # multipart upload, etag isn't a plain md5
+							nParts = int(s3HexMD5.split("-")[1])
+							recordedPartSize = getRecordedPartSize(testKey)
+
+					if (None != streamSource) : # nothing on disk to compare, so see what we would send
+						debug( "compressing "+streamSource+" for comparison with S3 copy..." )
+						sink = MultipartDigestSink(multipartPartSizes(s3FileSize, nParts, recordedPartSize))
+						gzipStream(streamSource, sink)
+						localFileSize = sink.size
+					else :
+						sink = None
+						localFileSize = os.path.getsize(localPath)
 
 					if (localFileSize != s3FileSize):
 						log( "error: local and S3 file sizes of "+localPath+" do not match. Exiting without overwriting file" )
@@ -832,12 +847,17 @@ def uploadToS3(s3FileList, makePublic=False, noRename=False) :
 						exit(-1)
 						
 					if (runAWS()) :
-						# get the hex digest version of the MD5 hash-- called the "etag" in aws parlance
-						# (this comes back as a string surrounded by double-quote characters)
-						s3HexMD5 = testKey.etag.replace('\"','')
-					
 						debug( "calculating local md5 hash..." )
-						(localHexMD5,localB64MD5) = testKey.compute_md5(fp)
+						if (("-" in s3HexMD5) and (None == sink)) :
+							sink = MultipartDigestSink(multipartPartSizes(s3FileSize, nParts, recordedPartSize))
+							for block in iter(lambda: fp.read(1024*1024), "") :
+								sink.write(block)
+						if (None == sink) :
+							(localHexMD5,localB64MD5) = testKey.compute_md5(fp)
+						elif ("-" in s3HexMD5) :
+							localHexMD5 = (sink.partSizeFor(s3HexMD5) and s3HexMD5) or sink.sinks[0].etag()
+						else :
+							localHexMD5 = sink.md5.hexdigest()
 						debug( "done" )
 
 						if (s3HexMD5 == localHexMD5):
@@ -855,6 +875,379 @@ def uploadToS3(s3FileList, makePublic=False, noRename=False) :
 				setConfig(fileNameKey, s3FileName) # now speak in terms of S3 for node config
 	selectConfig(entryConfigNum) # restore entry state
 	debug( "S3 tests complete" )
+	# upload if possible, or exit with error otherwise
+	transferFiles(transfers, s3BucketID, makePublic)
+
+#
+# block-parallel gzip, pigz style: the input is cut into fixed size blocks which are deflated
+# independently on a pool of threads (zlib lets go of the interpreter lock while it works),
+# then written out in order as a single gzip member that any gunzip can read
+#
+def getGZipThreadCount() :
+	return max(1,int(getConfig("gzipThreads",str(multiprocessing.cpu_count()))))
+
+def getGZipBlockSize() :
+	return max(32,int(getConfig("gzipBlockSizeKB","1024")))*1024
+
+def getGZipLevel() :
+	return int(getConfig("gzipLevel","6"))
+
+# keep a .gz copy next to the original?  If not, it gets compressed on the fly as it's uploaded.
+def keepGZipCopies() :
+	return ("True" == getConfig("keepGZipCopies","True"))
+
+# write a gzipped copy of sourcePath to out, which need only have a write() method
+def gzipStream(sourcePath, out) :
+	nthreads = getGZipThreadCount()
+	blockSize = getGZipBlockSize()
+	level = getGZipLevel()
+	jobs = Queue.Queue()
+	done = {} # block number -> deflated block (or the exception that stopped it)
+	ready = threading.Condition()
+	def worker() :
+		while True :
+			(n, block) = jobs.get()
+			if (None == block) :
+				return
+			try :
+				compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS) # raw deflate, we write the header
+				result = compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH) # byte aligned, so blocks concatenate
+			except Exception, exception :
+				result = exception
+			ready.acquire()
+			done[n] = result
+			ready.notify()
+			ready.release()
+	def writeBlock(n) :
+		ready.acquire()
+		while (not n in done) :
+			ready.wait(1)
+		result = done.pop(n)
+		ready.release()
+		if (isinstance(result, Exception)) :
+			raise result
+		out.write(result)
+
+	threads = []
+	for n in range(nthreads) :
+		t = threading.Thread(target=worker)
+		t.setDaemon(True)
+		t.start()
+		threads.append(t)
+	src = open(sourcePath,"rb")
+	try :
+		# gzip header, stamped with the source mtime rather than the time now so output is repeatable
+		out.write("\037\213\010\000"+struct.pack("<I",int(os.path.getmtime(sourcePath)))+"\000\377")
+		crc = zlib.crc32("")
+		size = 0
+		nRead = 0
+		nWritten = 0
+		while True :
+			block = src.read(blockSize)
+			if (not block) :
+				break
+			crc = zlib.crc32(block, crc)
+			size += len(block)
+			jobs.put((nRead, block))
+			nRead += 1
+			while (nRead - nWritten >= 2*nthreads) : # don't let the reader get too far ahead
+				writeBlock(nWritten)
+				nWritten += 1
+		while (nWritten < nRead) :
+			writeBlock(nWritten)
+			nWritten += 1
+	finally :
+		src.close()
+		for t in threads :
+			jobs.put((0, None))
+		for t in threads :
+			t.join()
+	out.write(zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH)) # empty last block
+	out.write(struct.pack("<II", crc & 0xffffffffL, size & 0xffffffffL))
+
+# if localPath is a .gz that uploadToS3() decided not to keep on disk, returns the
+# uncompressed original that gets compressed as it's uploaded, else None
+def gzipStreamSource(localPath) :
+	if (localPath.endswith(".gz") and (not os.path.exists(localPath)) and os.path.exists(localPath[:-3])) :
+		return localPath[:-3]
+	return None
+
+# write-only sink that tallies what would have been written: size, md5, and the etag S3
+# would give it as a multipart upload - for comparing a compressed stream with a remote copy
+class DigestSink :
+	def __init__(self, partSize) :
+		self.size = 0
+		self.md5 = hashlib.md5()
+		self.partSize = partSize
+		self.partMD5 = hashlib.md5()
+		self.partFill = 0
+		self.partDigests = []
+
+	def write(self, data) :
+		self.size += len(data)
+		self.md5.update(data)
+		while len(data) :
+			n = min(len(data), self.partSize-self.partFill)
+			self.partMD5.update(data[:n])
+			self.partFill += n
+			data = data[n:]
+			if (self.partFill == self.partSize) :
+				self.partDigests.append(self.partMD5.digest())
+				self.partMD5 = hashlib.md5()
+				self.partFill = 0
+
+	def etag(self) :
+		digests = list(self.partDigests)
+		if (self.partFill or (0 == len(digests))) :
+			digests.append(self.partMD5.digest())
+		return "%s-%d" % (hashlib.md5("".join(digests)).hexdigest(), len(digests))
+
+# DigestSinks for several part sizes at once, so one pass over the data can check a multipart etag
+class MultipartDigestSink :
+	def __init__(self, partSizes) :
+		self.sinks = [DigestSink(p) for p in partSizes]
+		self.md5 = self.sinks[0].md5
+		self.size = 0
+
+	def write(self, data) :
+		for sink in self.sinks :
+			sink.write(data)
+		self.size = self.sinks[0].size
+
+	# the part size that gives these contents this etag, or None
+	def partSizeFor(self, etag) :
+		for sink in self.sinks :
+			if (sink.etag() == etag) :
+				return sink.partSize
+		return None
+
+# a multipart etag depends on the part size the object was uploaded with, which S3 doesn't tell
+# us - so we note it in the object's metadata as we upload it
+uploadPartSizeMetadata = "upload-part-size"
+
+def getRecordedPartSize(key) :
+	try :
+		return int(key.get_metadata(uploadPartSizeMetadata))
+	except Exception, exception : # not recorded, uploaded before we did that or by something else
+		return None
+
+# the part sizes that fit an object of this size in nParts parts: the one recorded at upload if
+# it fits, else the current setting, whole MB parts, and the usual tool defaults
+def multipartPartSizes(size, nParts, knownPartSize=None) :
+	MB = 1024*1024
+	if (nParts <= 1) : # one part is the whole object, whatever the part size
+		return [max(size,1)]
+	candidates = [knownPartSize, getUploadPartSize(), (((size+nParts-1)/nParts+MB-1)/MB)*MB]
+	candidates.extend([n*MB for n in (5, 8, 15, 16, 32, 64, 100, 128, 256, 512, 1024)])
+	partSizes = []
+	for p in candidates :
+		if (p and ((nParts-1)*p < size <= nParts*p) and not (p in partSizes)) :
+			partSizes.append(p)
+	if (knownPartSize in partSizes) :
+		return [knownPartSize]
+	return partSizes or [getUploadPartSize()]
+
+# write-only sink that sends what it's given to S3 as a multipart upload, a part at a time
+class S3MultipartSink :
+	def __init__(self, bucket, keyName, partSize) :
+		self.mp = bucket.initiate_multipart_upload(keyName, metadata={uploadPartSizeMetadata:str(partSize)})
+		self.partSize = partSize
+		self.buffer = []
+		self.buffered = 0
+		self.nParts = 0
+
+	def write(self, data) :
+		self.buffer.append(data)
+		self.buffered += len(data)
+		while (self.buffered >= self.partSize) :
+			data = "".join(self.buffer)
+			self.uploadPart(data[:self.partSize])
+			self.buffer = [data[self.partSize:]]
+			self.buffered = len(self.buffer[0])
+
+	def uploadPart(self, data) :
+		self.nParts += 1
+		self.mp.upload_part_from_file(cStringIO.StringIO(data), self.nParts)
+
+	# finish the upload, returning the etag S3 gives it
+	def close(self) :
+		if (self.buffered or (0 == self.nParts)) :
+			self.uploadPart("".join(self.buffer))
+		return str(self.mp.complete_upload().etag).replace('\"','')
+
+	def cancel(self) :
+		self.mp.cancel_upload()
+
+#
+# concurrent upload engine - a bounded pool of worker threads, with large S3 objects
+# broken into multipart chunks that upload (and retry) independently
+#
+def getUploadThreadCount() :
+	return max(1,int(getConfig("uploadThreads","4")))
+
+def getUploadPartSize() :
+	return max(5,int(getConfig("uploadPartSizeMB","64")))*1024*1024 # S3 won't take parts under 5MB
+
+# a read-only window onto part of a file, so boto can treat a multipart chunk as a whole file
+class FileChunk :
+	def __init__(self, filename, offset, length) :
+		self.fp = open(filename,"rb")
+		self.offset = offset
+		self.length = length
+		self.pos = 0
+		self.name = filename
+		self.fp.seek(offset)
+
+	def read(self, size=-1) :
+		remaining = self.length - self.pos
+		if (size < 0) or (size > remaining) :
+			size = remaining
+		data = self.fp.read(size)
+		self.pos += len(data)
+		return data
+
+	def seek(self, pos, whence=os.SEEK_SET) :
+		if (os.SEEK_CUR == whence) :
+			pos += self.pos
+		elif (os.SEEK_END == whence) :
+			pos += self.length
+		self.pos = max(0,min(pos,self.length))
+		self.fp.seek(self.offset+self.pos)
+
+	def tell(self) :
+		return self.pos
+
+	def close(self) :
+		self.fp.close()
+
+# each worker thread gets its own S3 connection, boto connections aren't thread safe
+workerState = threading.local()
+def getWorkerBucket(s3BucketID) :
+	if (None == getattr(workerState,"bucket",None)) :
+		s3conn = S3Connection(aws_access_key_id=getConfig("aws_access_key_id"), aws_secret_access_key=getConfig("aws_secret_access_key"))
+		workerState.bucket = s3conn.get_bucket(s3BucketID, validate=False)
+	return workerState.bucket
+
+# run a list of (description, callable) tasks on a bounded thread pool, retrying each
+# failed task with increasing delay - returns the list of descriptions that never succeeded
+def runConcurrently(tasks, nthreads, maxRetry=3) :
+	taskQueue = Queue.Queue()
+	for task in tasks :
+		taskQueue.put(task)
+	failures = []
+	lock = threading.Lock()
+	def worker() :
+		while True :
+			try :
+				(description, task) = taskQueue.get_nowait()
+			except Queue.Empty :
+				return
+			for retry in range(maxRetry+1) :
+				try :
+					task()
+					debug( "done: %s" % description )
+					break
+				except (Exception, SystemExit), exception :
+					if (retry < maxRetry) :
+						debug( "retry %s: %s" % (description, exception) )
+						sleep(2**retry)
+					else :
+						lock.acquire()
+						log( exception )
+						failures.append(description)
+						lock.release()
+	threads = []
+	for n in range(min(nthreads,len(tasks))) :
+		t = threading.Thread(target=worker)
+		t.setDaemon(True)
+		t.start()
+		threads.append(t)
+	for t in threads :
+		while t.isAlive() :
+			t.join(10)
+			if (t.isAlive()) :
+				log_progress() # show some life on long uploads
+	return failures
+
+# push (localPath, remoteName, streamSource) to S3 or hadoop, largest files first so they aren't the stragglers
+def transferFiles(transfers, s3BucketID, makePublic=False) :
+	transfers = sorted(transfers, key=lambda t: -os.path.getsize(t[2] or t[0]))
+	tasks = []
+	multiparts = []
+	for (localPath, remoteName, streamSource) in transfers :
+		info( "uploading " + localPath + " to " + s3BucketID + "/" + remoteName )
+		if (None != streamSource) : # compressed as it goes, so no size to plan parts around
+			tasks.append((remoteName, makeStreamUploadTask(s3BucketID, streamSource, remoteName, makePublic)))
+			continue
+		size = os.path.getsize(localPath)
+		partSize = getUploadPartSize()
+		if (runAWS() and (size > partSize)) :
+			mp = getWorkerBucket(s3BucketID).initiate_multipart_upload(remoteName, metadata={uploadPartSizeMetadata:str(partSize)})
+			multiparts.append((remoteName, mp))
+			nParts = (size+partSize-1)/partSize
+			for n in range(nParts) :
+				tasks.append(("%s part %d of %d" % (remoteName,n+1,nParts),
+							  makePartUploadTask(s3BucketID, localPath, mp.key_name, mp.id, n+1, n*partSize, min(partSize,size-(n*partSize)))))
+		else :
+			tasks.append((remoteName, makeUploadTask(s3BucketID, localPath, remoteName, makePublic)))
+	failures = runConcurrently(tasks, getUploadThreadCount())
+	for (remoteName, mp) in multiparts :
+		if (len([f for f in failures if f.startswith(remoteName+" part ")])) :
+			mp.cancel_upload()
+			failures.append(remoteName)
+		else :
+			mp.complete_upload()
+			if ( makePublic ) :
+				getWorkerBucket(s3BucketID).get_key(remoteName).set_acl('public-read')
+	if (len(failures)) :
+		log( "error: failed to upload %s" % ", ".join(failures) )
+		log( "exiting with error" )
+		exit(-1)
+
+def makeUploadTask(s3BucketID, localPath, remoteName, makePublic) :
+	def task() :
+		if (runAWS()) :
+			k = Key(getWorkerBucket(s3BucketID))
+		else :
+			k = HadoopConnection()
+		k.key = remoteName
+		k.set_contents_from_filename(localPath) # boto verifies file upload itself
+		if ( makePublic ) :
+			k.set_acl('public-read')
+	return task
+
+# gzip streamSource straight into the upload, no .gz written locally
+def makeStreamUploadTask(s3BucketID, streamSource, remoteName, makePublic) :
+	def task() :
+		writeContents = lambda fp: gzipStream(streamSource, fp)
+		if (runAWS()) :
+			sink = S3MultipartSink(getWorkerBucket(s3BucketID), remoteName, getUploadPartSize())
+			try :
+				writeContents(sink)
+				sink.close()
+			except :
+				sink.cancel()
+				raise
+			if ( makePublic ) :
+				getWorkerBucket(s3BucketID).get_key(remoteName).set_acl('public-read')
+		else :
+			k = HadoopConnection()
+			k.key = remoteName
+			k.set_contents_from_stream(writeContents)
+	return task
+
+def makePartUploadTask(s3BucketID, localPath, keyName, uploadId, partNum, offset, length) :
+	def task() :
+		from boto.s3.multipart import MultiPartUpload
+		mp = MultiPartUpload(getWorkerBucket(s3BucketID))
+		mp.key_name = keyName
+		mp.id = uploadId
+		chunk = FileChunk(localPath, offset, length)
+		try :
+			mp.upload_part_from_file(chunk, partNum)
+		finally :
+			chunk.close()
+	return task
 
 def downloadFromS3( filename ) :
 	s3BucketID = S3CompatibleString(getConfig("s3bucketID")) # enforce bucket naming rules
@@ -898,6 +1291,71 @@ def downloadFromS3IfExists( filename ) :
 	except Exception, exception:        # no handler, but need the fallthrough to no operation
 		return
 
+# name of a segment of a log shipped by LogShipper in cluster_infrastructure/start_node.py
+def logSegmentName(filename, generation, n) :
+	return "%s.gen%d.seg%06d" % (filename, generation, n)
+
+# follow a log that a node ships to S3 as numbered segments of new text - read() returns whatever
+# text has arrived since last time.  If the node's file was truncated and rewritten, its segments
+# start over in a new generation, and so do we.
+class S3LogTail :
+	def __init__(self, filename) :
+		self.filename = filename
+		self.generation = 0
+		self.segment = 0 # next segment to read
+		self.size = 0 # bytes read so far, in this generation
+		self.bucket = None
+	def read(self) :
+		text = ""
+		try:
+			if (None == self.bucket) :
+				s3conn = S3Connection(aws_access_key_id=getConfig("aws_access_key_id"), aws_secret_access_key=getConfig("aws_secret_access_key"))
+				self.bucket = s3conn.create_bucket(S3CompatibleString(getConfig("s3bucketID"))) # enforce bucket naming rules
+			while True :
+				k = self.bucket.get_key(logSegmentName(self.filename, self.generation, self.segment))
+				if (None == k) :
+					if ((self.segment > 0) and (None != self.bucket.get_key(logSegmentName(self.filename, self.generation+1, 0)))) :
+						self.generation = self.generation + 1
+						self.segment = 0
+						self.size = 0
+						continue
+					break
+				data = k.get_contents_as_string()
+				text = text + data
+				self.size = self.size + len(data)
+				self.segment = self.segment + 1
+		except Exception, exception:        # try again next time
+			pass
+		return text
+	# text of the complete log past what we've read in segments
+	def remainder(self) :
+		logfile = downloadFromS3IfExists(self.filename)
+		if (None == logfile) :
+			return ""
+		return logfile[self.size:]
+
+
+#
+# local mapreduce, without the external sort: the ECA framework writes all mapper output
+# under the one key "1", so there's no grouping to do and the mapper feeds the reducer directly
+#
+
+# run "cat inputFile | mapper | sort | reducer" without the cat or the sort - mapper and
+# reducer are shell commands, so they may redirect their own logging
+def runLocalMapReduce(mapper, reducer, inputFile) :
+	f = open(inputFile,"rb")
+	m = subprocess.Popen(mapper,shell=True,stdin=f,stdout=subprocess.PIPE)
+	r = subprocess.Popen(reducer,shell=True,stdin=m.stdout)
+	m.stdout.close() # so the mapper sees it if the reducer quits early
+	ret = r.wait()
+	mapperRet = m.wait()
+	f.close()
+	if (mapperRet != 0) :
+		log( "problem running mapper, return code %d" % mapperRet )
+		return mapperRet
+	if (ret != 0) :
+		log( "problem running reducer, return code %d" % ret )
+	return ret
 
 def calculateSpotBidAsPercentage( spotBid, instance_type, emrTax = 0.0 ) :
 	demandprices = { "t1.micro" : 0.02, "m1.small" : 0.085, "m1.large" : 0.34, "m1.xlarge" : 0.68, \
@@ -941,6 +1399,38 @@ def getHadoopHome() :
 def getHadoopBinary() :
 	return getHadoopHome()+"/bin/hadoop"
 
+# file transfers to and from the hadoop cluster go over one WebHDFS connection when the namenode
+# offers it, instead of starting a hadoop JVM for each operation - hadoopFileSystem can be
+# "webhdfs", "cli" (the hadoop command line, as before), or "auto" to try WebHDFS first
+hadoopFS = None
+def getHadoopFS() :
+	global hadoopFS
+	if (None == hadoopFS) :
+		choice = getConfig("hadoopFileSystem","auto")
+		address = getConfig("webhdfs_address","")
+		if ("" == address) : # namenode's web port, if hadoop_dir names the namenode
+			authority = getHadoopDir().replace("hdfs://","").split("/")[0]
+			if (":" in authority) :
+				address = authority.split(":")[0]+":50070"
+		if (("cli" != choice) and ("" != address)) :
+			fs = hadoop_fs.WebHDFSFileSystem(address, getConfig("hadoop_user","") or None)
+			if (("webhdfs" == choice) or (fs.ping() and fs.probe(hadoop_fs.hdfsPath(getHadoopDir())))) :
+				hadoopFS = fs
+			else :
+				info( "WebHDFS at %s not usable from here, using hadoop command line for file transfers" % address )
+		if (None == hadoopFS) :
+			hadoopFS = hadoop_fs.HadoopCLIFileSystem(getHadoopBinary())
+		debug( "using %s for hadoop file transfers" % hadoopFS.name )
+	return hadoopFS
+
+# existence and size of files on the hadoop cluster, from one listing per directory per launch
+hadoopStatCache = None
+def getHadoopStatCache() :
+	global hadoopStatCache
+	if (None == hadoopStatCache) :
+		hadoopStatCache = hadoop_fs.StatCache(getHadoopFS())
+	return hadoopStatCache
+
 def cygwin() :
 	return platform.system().startswith("CYGWIN")
 
@@ -964,22 +1454,11 @@ def cygwinify(filename) :
 # for hadoop clusters, may need to set executable bit on script
 def makeFileExecutable(remoteFilename) :
 	if (runHadoop()) :
-		ret = -7777 # magic number used below 
 		try:
-			args = [getHadoopBinary(),"dfs","-chmod","777",remoteFilename]
-			debug( args )
-			p = subprocess.Popen(args)
-			result = p.communicate()[1]
-			ret = p.wait()
-			if (ret != 0) :
-				log(result)
-				log("problem with hadoop dfs -chmod (have you configured core-site.xml and mapred-site.xml?)")
-				explain_hadoop()
-				exit(ret)
+			getHadoopFS().chmod("777",remoteFilename)
 		except Exception, exception:
-			if (-7777 == ret) : # process never got started
-				log("unable to invoke local copy of hadoop")
 			log( exception )
+			log("problem with hadoop chmod (have you configured core-site.xml and mapred-site.xml?)")
 			explain_hadoop()
 			exit(1)
 
@@ -1040,28 +1519,26 @@ class HadoopConnection():
 		
 	def set_contents_from_filename(self, local_filename) :
 		target_filename = self.key
-		ret = -7777 # magic number used below 
 		try:
 			local_filename = decygwinify(local_filename) # for windows, remove cygwin hoo-hah if any
 			if (not target_filename.startswith(getHadoopDir())) :
 				target_filename = getHadoopDir()+"/"+target_filename
-			args = [getHadoopBinary(),"fs","-put",local_filename,target_filename]
-			debug( args )
-			p = subprocess.Popen(args)
-			result = p.communicate()[1]
-			ret = p.wait()
-			if (ret != 0) :
-				log(result)
-				log("problem with hadoop fs -put (have you configured core-site.xml and mapred-site.xml?)")
-				explain_hadoop()
-				exit(ret)
+			getHadoopStatCache().forget(target_filename)
+			getHadoopFS().put(local_filename,target_filename)
 		except Exception, exception:
-			if (-7777 == ret) : # process never got started
-				log("unable to invoke local copy of hadoop for file transfer purposes")
 			log( exception )
+			log("problem copying %s to hadoop (have you configured core-site.xml and mapred-site.xml?)" % local_filename)
 			explain_hadoop()
 			exit(1)
 		
+	# put whatever writeContents(fp) writes, without a local file
+	def set_contents_from_stream(self, writeContents) :
+		target_filename = self.key
+		if (not target_filename.startswith(getHadoopDir())) :
+			target_filename = getHadoopDir()+"/"+target_filename
+		getHadoopStatCache().forget(target_filename)
+		getHadoopFS().putStream(writeContents,target_filename)
+
 	def set_contents_from_string(self, str) :
 		f = tempfile.NamedTemporaryFile(delete = False)
 		f.write(str)
@@ -1070,14 +1547,11 @@ class HadoopConnection():
 		os.unlink(f.name)
 
 	def get_contents_as_string(self) :
-		args = [getHadoopBinary(),"fs","-cat",self.key]
-		debug( args )
-		p = subprocess.Popen(args)
-		result = p.communicate()[1]
-		ret = p.wait()
-		if (None == result):
-			result = ""
-		return str(result)
+		try :
+			return getHadoopFS().cat(self.key)
+		except Exception, exception:
+			log( exception )
+			return ""
 
 	def set_acl(self, acl) :
 		log( "HadoopConnection set_acl not implemented" )
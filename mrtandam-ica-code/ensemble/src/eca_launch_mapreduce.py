@@ -135,23 +135,28 @@ if ( not eca.runLocal() ) :
     copierCommands = ""
     # go through the config parameters, anything named "sharedFile_*" gets uploaded
     # to S3 with a gzip preference
+    s3FileList = []
     for n in range(-1,len(eca.cfgStack)) :
         for cfgKey,val in eca.selectConfig(n).iteritems():
             if (cfgKey.startswith("sharedFile_")):
                 fullLocalPath = eca.my_abspath( val )              # convert relative path to absolute
                 eca.setConfig( cfgKey, fullLocalPath)
-                # do the upload to S3  
-                s3FileList = [(cfgKey, n, "", True)]
-                eca.uploadToS3(s3FileList) # side effect: after this call config speaks of data files in terms of S3
-                # and set up for copying S3 files out to HDFS
-                hdfsPath = "hdfs:///home/hadoop/"
-                hdfsname = hdfsPath+os.path.basename(eca.getConfig(cfgKey))
-                hadoopCopyCmd = "hadoop dfs -cp "
-                # prepare a list of copy commands to be passed out to mappers
-                cmd = '%s %s%s %s\n' % ( hadoopCopyCmd, bucketURL, eca.getConfig(cfgKey), hdfsname )
-                if not cmd in copierCommands :
-                    copierCommands = copierCommands + cmd
-                eca.setConfig(cfgKey,hdfsname)
+                s3FileList.append((cfgKey, n, "", True))
+    # do the upload to S3, all at once so transfers can overlap
+    eca.uploadToS3(s3FileList) # side effect: after this call config speaks of data files in terms of S3
+    # and set up for copying S3 files out to HDFS
+    entryConfigNum = eca.currentCfgID
+    for (cfgKey, n, targetDir, wantGZ) in s3FileList :
+        eca.selectConfig(n)
+        hdfsPath = "hdfs:///home/hadoop/"
+        hdfsname = hdfsPath+os.path.basename(eca.getConfig(cfgKey))
+        hadoopCopyCmd = "hadoop dfs -cp "
+        # prepare a list of copy commands to be passed out to mappers
+        cmd = '%s %s%s %s\n' % ( hadoopCopyCmd, bucketURL, eca.getConfig(cfgKey), hdfsname )
+        if not cmd in copierCommands :
+            copierCommands = copierCommands + cmd
+        eca.setConfig(cfgKey,hdfsname)
+    eca.selectConfig(entryConfigNum) # restore entry state
     k.key = copierInputFile
     k.set_contents_from_string(copierCommands)
 
@@ -200,9 +205,8 @@ if (eca.runLocal()) :
         reducer = "Rscript %s reducer %s %s %s" % (frameworkScriptPath,mapReduceScriptPath,configName,subCfgName)
         if (resultsFilename != "") :
             reducer=reducer+" >"+redResults +" 2>&1" # capture logging on stderr as well as results on stdout
-        cmd = "cat " + mapperInputFile + " | " + mapper + " | sort | " + reducer
-        eca.log("run: "+ cmd)
-        os.system(cmd)
+        eca.log("run: "+ mapper + " < " + mapperInputFile + " | " + reducer)
+        eca.runLocalMapReduce(mapper, reducer, mapperInputFile)
         wait = 1
         if (resultsFilename != "") :
             os.system("cat "+mapResults +" >> "+resultsFilename) # combine mapper and reducer logs
@@ -30,6 +30,8 @@ from boto.ec2.regioninfo import RegionInfo
 from boto.s3.key import Key
 from time import sleep
 import datetime 
+import hashlib
+import StringIO
 
 # fancy stuff for quiet use of older paramiko+pycrypto on win64
 import warnings
@@ -43,18 +45,38 @@ import eca_launch_helper as eca # functions common to RMPI and MapReduce version
 import multiprocessing
 scriptsFileName = "/root/s.tar.gz"
 scriptsFileB64Name = "/root/s.b64"
+relayKeyName = "/root/.ssh/eca_relay_key" # lets a node pass the boot script on to others
+authorizedKeysName = "/root/.ssh/authorized_keys"
+relayTimeout = 600 # seconds a node waits for the one relaying to it to be ready
+
+# in a bootstrap fan-out tree where each node relays to fanout others, the node that relays to
+# node n - or None if we send to it directly (as we always do for the head node)
+def relayParent(n, fanout) :
+	if ((0 == n) or (fanout < 1)) :
+		return None
+	return (n-1)/fanout
 MSG_SUCCESS = "success"
 MSG_FAILURE = "failed"
 wait = 10 # much less than this and AWS gets irritated and throttles you back
 class startNode(multiprocessing.Process):
-	def __init__ (self,nodenum,verbose,ip_address,privkey,scriptsFileB64Text,bootstrap,readConn, writeConn, lock):
+	# with relayFrom given, the node's bootstrap files are relayed over the cluster's private network
+	# from the node at that address, once that node has them and sets relayReady (a multiprocessing.Event).
+	# A node given relayKeyText can relay to others, and sets ready once it has its own copy.
+	# relayPublicKey is the authorized_keys line that lets relaying nodes in.
+	def __init__ (self,nodenum,verbose,ip_address,privkey,scriptsFileB64Text,bootstrap,readConn, writeConn, lock, private_ip_address=None, relayFrom=None, relayReady=None, relayKeyText=None, ready=None, relayPublicKey=None):
 		multiprocessing.Process.__init__(self) # base class
 		self.verbose = verbose
 		self.nodenum = nodenum
 		self.ip_address = ip_address
+		self.private_ip_address = private_ip_address
 		self.privkey = privkey
 		self.scriptsFileB64Text = scriptsFileB64Text
 		self.bootstrap = bootstrap
+		self.relayFrom = relayFrom
+		self.relayReady = relayReady
+		self.relayKeyText = relayKeyText
+		self.relayPublicKey = relayPublicKey
+		self.ready = ready
 		self.success = False
 		self.retries = 0
 		# pipes for reporting status to parent process
@@ -76,54 +98,78 @@ class startNode(multiprocessing.Process):
 				if ( self.logmsg_repeats > 9 ) :
 					self.writeConn.send("node %d: %s (message repeats %d times)"%(self.nodenum,self.last_logmsg,self.logmsg_repeats))
 					self.logmsg_repeats = 0
+	# run a command on a node, logging anything on stderr, and return its stdout lines
+	def runRemote(self,ssh,cmd):
+		stdin, stdout, stderr = ssh.exec_command(cmd)
+		o = stdout.readlines()
+		e = stderr.readlines()
+		if (0 < len(e)) :
+			self.log(e,True)
+		return o
+	# write the bootstrap script and the config scripts with one sftp session, a stream per file
+	# instead of a round trip per line
+	def sendPayload(self):
+		sftp = self.ssh.open_sftp()
+		for (name, text) in [["bootstrap.py",self.bootstrap],[scriptsFileB64Name,self.scriptsFileB64Text]] :
+			f = sftp.open(name,"wb")
+			f.write(text)
+			f.close()
+		if (None != self.relayKeyText) :
+			f = sftp.open(relayKeyName,"wb")
+			f.write(self.relayKeyText)
+			f.close()
+			sftp.chmod(relayKeyName,0600)
+		sftp.close()
+	# have the relaying node pass its copy of the bootstrap files on to this node
+	def relayPayload(self):
+		relay = paramiko.SSHClient()
+		relay.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+		relay.connect(self.relayFrom, username='root', pkey=self.privkey)
+		try :
+			self.runRemote(relay,"scp -q -i %s -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null bootstrap.py %s root@%s:"%(relayKeyName,scriptsFileB64Name,self.private_ip_address))
+		finally :
+			relay.close()
+	# make sure the bootstrap files arrived intact
+	def checkPayload(self):
+		expected = [hashlib.md5(self.bootstrap).hexdigest(),hashlib.md5(self.scriptsFileB64Text).hexdigest()]
+		sums = [line.split()[0] for line in self.runRemote(self.ssh,"md5sum bootstrap.py %s"%scriptsFileB64Name) if line.strip()]
+		if (sums != expected) :
+			raise Exception("bootstrap files failed checksum verification")
 	def run(self):
 		halfBaked = False # for detecting partial completion
 		while ( (not halfBaked) and (not self.success) )  :
-			import StringIO
 			self.ssh = paramiko.SSHClient()
 			self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 			halfBaked = False # for detecting partial completion
 			try:
 				self.ssh.connect(self.ip_address, username='root', pkey=self.privkey)
-				content = StringIO.StringIO()
-				content.write(self.bootstrap)
-				content.seek(0)
-				# write our bootstrap script
-				line = content.readline()
-				self.log("installing userdata and boot script via ssh...",self.verbose)
-				self.ssh.exec_command("rm -f bootstrap.py")
-				while line :
-					stdin, stdout, stderr = self.ssh.exec_command("echo '%s' >> bootstrap.py"%line)
-					o = stdout.readlines()
-					e = stderr.readlines()
-					if (0 < len(o)) :
-						self.log(o,self.verbose)
-					if (0 < len(e)) :
-						self.log(e,True)
-					line = content.readline()
-				# write our config scripts, in chunks
-				b64content = StringIO.StringIO()
-				b64content.write(self.scriptsFileB64Text)
-				b64content.seek(0)
-				line = b64content.read(1024)
-				self.ssh.exec_command("rm -f %s"%scriptsFileB64Name)
-				while line  :
-					stdin, stdout, stderr = self.ssh.exec_command("echo -n '%s' >> %s"%(line,scriptsFileB64Name))
-					o = stdout.readlines()
-					e = stderr.readlines()
-					if (0 < len(o)) :
-						self.log(o,self.verbose)
-					if (0 < len(e)) :
-						self.log(e,True)
-					line = b64content.read(1024)
+				relayed = False
+				if (None != self.relayFrom) :
+					self.runRemote(self.ssh,"mkdir -p /root/.ssh ; grep -qxF '%s' %s || echo '%s' >> %s"%(self.relayPublicKey,authorizedKeysName,self.relayPublicKey,authorizedKeysName))
+					self.relayReady.wait(relayTimeout)
+					if (self.relayReady.is_set()) :
+						self.log("installing userdata and boot script via %s..."%self.relayFrom,self.verbose)
+						self.relayPayload()
+						relayed = True
+					else :
+						self.log("%s isn't ready to relay boot script, sending it directly"%self.relayFrom,True)
+				if (not relayed) :
+					self.log("installing userdata and boot script via sftp...",self.verbose)
+					self.sendPayload()
+				self.checkPayload()
+				if ((None != self.relayKeyText) and (None != self.ready)) :
+					if (relayed) : # and we'll need the key to pass it on
+						sftp = self.ssh.open_sftp()
+						f = sftp.open(relayKeyName,"wb")
+						f.write(self.relayKeyText)
+						f.close()
+						sftp.chmod(relayKeyName,0600)
+						sftp.close()
+					self.ready.set() # others can get their copies from us now
 				self.log("starting configuration script...",self.verbose)
 				halfBaked = True # clear this once we've done all steps
-				stdin, stdout, stderr = self.ssh.exec_command('chmod 777 bootstrap.py')
+				self.runRemote(self.ssh,'chmod 777 bootstrap.py')
 				stdin, stdout, stderr = self.ssh.exec_command('python bootstrap.py &')
-				if (0 < len(o)) :
-					self.log(o,self.verbose)
-				if (0 < len(e)) :
-					self.log(e,True)
 				self.log("boot script is running.",self.verbose)
 				halfBaked = False # full completion
 				self.success = True
@@ -474,6 +520,28 @@ if __name__ == '__main__':  # needed for multiprocessing under windows
 	nRunning = 0
 	privkey = paramiko.RSAKey.from_private_key_file(eca.getConfig("RSAKeyFileName"))
 	lock = multiprocessing.Lock()
+	# nodes can relay the boot script to one another over the private network, rather than our
+	# sending each of them a copy from here: with bootstrapFanout set we send it only to the head,
+	# which passes it on to that many nodes, each of which passes it on to that many more, and so
+	# on - "bootstrapRelay":"True" alone has the head pass it to all the clients
+	fanout = int(eca.getConfig("bootstrapFanout","0"))
+	if ((0 == fanout) and ("True"==eca.getConfig("bootstrapRelay","False"))) :
+		fanout = len(instances)-1
+	relay = (fanout > 0) and (len(instances) > 1)
+	relayReady = [multiprocessing.Event() for i in range(len(instances))]
+	relayKeyText = None
+	relayPublicKey = None
+	if (relay) :
+		# a keypair just for this launch, so our own key never leaves this machine - relaying nodes
+		# get the private half, the nodes they relay to get the public half, and both go once we're booted
+		relayKey = paramiko.RSAKey.generate(2048)
+		keyFile = StringIO.StringIO()
+		relayKey.write_private_key(keyFile)
+		relayKeyText = keyFile.getvalue()
+		relayKeyComment = "eca-relay-%s"%relayKey.get_fingerprint().encode("hex")
+		relayPublicKey = "%s %s %s"%(relayKey.get_name(),relayKey.get_base64(),relayKeyComment)
+		eca.info("bootstrap relay fan-out is %d"%fanout)
+	booted = [False for i in range(len(instances))]
 	last_status_string=""
 	eca.log("status, nodes 0-%d: P=pending B=booting R=running T=terminated"%(len(instances)-1))
 	while True :
@@ -492,13 +560,27 @@ if __name__ == '__main__':  # needed for multiprocessing under windows
 				statuses[i] = "T"
 			else :
 				statuses[i] = "?"
-			if (instance.state != lastState[i]) :
-				if (instance.state == u'running') :
-					# start a new process to configure this node
-					readConn, writeConn = multiprocessing.Pipe()
+			parent = None
+			if (relay) :
+				parent = relayParent(i,fanout)
+			if ((instance.state == u'running') and (not booted[i]) and ((None == parent) or (None != instances[parent].ip_address))) :
+				# start a new process to configure this node
+				readConn, writeConn = multiprocessing.Pipe()
+				if (not relay) :
 					booter = startNode(i,eca.verbose(),instances[i].ip_address,privkey,scriptsFileB64Text,bootstrap,readConn, writeConn, lock)
-					booter.start()
-					booters.append(booter)
+				else :
+					if (None == parent) :
+						(relayFrom, parentReady) = (None, None)
+					else :
+						(relayFrom, parentReady) = (instances[parent].ip_address, relayReady[parent])
+					if (relayParent(len(instances)-1,fanout) >= i) : # it has nodes to relay to
+						keyText = relayKeyText
+					else :
+						keyText = None
+					booter = startNode(i,eca.verbose(),instances[i].ip_address,privkey,scriptsFileB64Text,bootstrap,readConn, writeConn, lock, instances[i].private_ip_address, relayFrom, parentReady, keyText, relayReady[i], relayPublicKey)
+				booter.start()
+				booters.append(booter)
+				booted[i] = True
 			if instance.state == u'terminated' :
 				eca.log('unknown startup failure')
 				break
@@ -535,6 +617,24 @@ if __name__ == '__main__':  # needed for multiprocessing under windows
 	# success?
 	for i in range(len(booters)) :
 		booters[i].join()
+	for i in range(len(instances)) :
+		if (relay and booted[i]) : # done relaying, so take the relay keypair back off the nodes
+			cmds = []
+			if (relayReady[i].is_set()) :
+				cmds.append("rm -f %s"%relayKeyName)
+			if (None != relayParent(i,fanout)) :
+				cmds.append("sed -i '/ %s$/d' %s"%(relayKeyComment,authorizedKeysName))
+			if (not len(cmds)) :
+				continue
+			try :
+				ssh = paramiko.SSHClient()
+				ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+				ssh.connect(instances[i].ip_address, username='root', pkey=privkey)
+				stdin, stdout, stderr = ssh.exec_command(" ; ".join(cmds))
+				stdout.channel.recv_exit_status()
+				ssh.close()
+			except Exception, inst :
+				eca.log("could not remove relay key from node %d: %s"%(i,str(inst)))
 	if ( nRunning != len(instances) ) :
 		if ("True"!=eca.getConfig("keepHead","False")) :
 			eca.log("error starting cluster, terminating all nodes")
@@ -557,29 +657,29 @@ if __name__ == '__main__':  # needed for multiprocessing under windows
 		eca.log('cluster will not self terminate: keepHead='+eca.getConfig("keepHead","False")+ " and keepClients="+eca.getConfig("keepClients","False"))
 	eca.log_no_newline('waiting for results')
 	eca.log_progress() # put a dot with no newline
-	logfileOld = ""
-	results = [""]
-	resultsOld = [""]
+	# the head node ships its log and the computation logs as they grow, so follow along
+	logTail = eca.S3LogTail( eca.getConfig( "logFileName" ) )
+	resultsTails = []
 	for n in range(len(eca.cfgStack)):
-		results.extend([""])
-		resultsOld.extend([""])
+		eca.selectConfig(n)
+		resultsTails.append( eca.S3LogTail( eca.getConfig( "reportFileName" ) ) )
 	# TODO: pull down result files as they come available in multi-job runs
 	instance = instances[0]
 	while instance.state == u'running' :
 		sleep( wait )
 		instance.update()
-	logfile = eca.downloadFromS3IfExists( eca.getConfig( "logFileName" ) )
-	if ( logfile != None ) :
-		logfileNew = logfile.replace( logfileOld, "" )
+		logfileNew = logTail.read()
+		if ( logfileNew != "" ) :
+			eca.log_no_timestamp( logfileNew )
+	# the head node's final log uploads are whole files, so take whatever we haven't seen from those
+	logfileNew = logTail.read() + logTail.remainder()
+	if ( logfileNew != "" ) :
 		eca.log_no_timestamp( logfileNew )
-		logfileOld = logfile
 	for n in range(len(eca.cfgStack)):
 		eca.selectConfig(n)
-		results[n] = eca.downloadFromS3IfExists( eca.getConfig( "reportFileName" ) )
-		if ( results[n] != None ) :
-			resultsNew = results[n].replace( resultsOld[n], "" )
+		resultsNew = resultsTails[n].read() + resultsTails[n].remainder()
+		if ( resultsNew != "" ) :
 			eca.log_no_timestamp( resultsNew )
-			resultsOld[n] = results[n]
 	eca.log( 'head node has shut down.' )   #  Results:' )
 	eca.log( "copying head node logs from S3 %s/%s to %s"%(eca.getConfig("s3bucketID"),eca.getConfig( "logFileName" ),localLogFileName))
 	eca.downloadFileFromS3(eca.getConfig( "logFileName" ),localLogFileName )
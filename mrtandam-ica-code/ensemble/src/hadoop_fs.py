@@ -0,0 +1,574 @@
+#
+# hadoop filesystem access for the ICA launchers: put, get, cat, ls, rm, chmod and mkdir
+# against HDFS, either over one long lived WebHDFS (REST over HTTP) connection, or failing
+# that by running the hadoop command line client for each operation as we always have.
+# Each hadoop CLI call starts a JVM, which costs seconds - a multi-config job does dozens.
+#
+# For trying things out without a cluster, LocalWebHDFSServer serves a local directory
+# with the subset of the WebHDFS REST API used here:
+#    python hadoop_fs.py serve <directory> [port]
+# then set "webhdfs_address" to "localhost:<port>" in your job config.
+#
+# Part of the Insilicos Cloud Army Project:
+# see http://sourceforge.net/projects/ica/trunk for latest and greatest
+#
+# Copyright (C) 2011 Insilicos LLC  All Rights Reserved
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import sys
+import shutil
+import fnmatch
+import socket
+import httplib
+import urllib
+import urlparse
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+import simplejson as json
+
+# what ls and stat report for each entry
+class FileStatus :
+    def __init__(self, path, size, isDir=False, permission=None, mtime=None) :
+        self.path = path
+        self.size = size
+        self.isDir = isDir
+        self.permission = permission # octal string, if known
+        self.mtime = mtime # modification time as the server gives it, if known
+
+# "hdfs://namenode:9000/user/me/x", "namenode:9000/user/me/x" -> "/user/me/x"
+def hdfsPath(name) :
+    if (name.startswith("hdfs://")) :
+        name = name[len("hdfs://"):]
+    if (not name.startswith("/")) :
+        first = name.split("/",1)
+        if ((len(first) > 1) and (":" in first[0] or "." in first[0])) : # host part
+            name = first[1]
+        name = "/"+name
+    return name
+
+# apply a chmod style mode ("755", "a+x", "u+rw,go-w") to an octal permission string
+def octalMode(mode, current="0") :
+    if (mode.isdigit()) :
+        return mode
+    bits = int(current or "0", 8)
+    shifts = { "u":[6], "g":[3], "o":[0], "a":[6,3,0] }
+    values = { "r":4, "w":2, "x":1 }
+    for clause in mode.split(",") :
+        for op in "+-=" :
+            if (op in clause) :
+                (who, perms) = clause.split(op,1)
+                break
+        else :
+            raise Exception("can't parse file mode %s" % mode)
+        value = sum([values.get(p,0) for p in perms])
+        for w in (who or "a") :
+            for shift in shifts.get(w,[]) :
+                if ("+" == op) :
+                    bits |= (value << shift)
+                elif ("-" == op) :
+                    bits &= ~(value << shift)
+                else :
+                    bits = (bits & ~(7 << shift)) | (value << shift)
+    return "%o" % bits
+
+#
+# the hadoop command line client - a JVM per operation, but works anywhere hadoop fs does
+# (including through the SOCKS proxy setups in hadoop's own config)
+#
+class HadoopCLIFileSystem :
+    def __init__(self, hadoopBinary) :
+        self.hadoopBinary = hadoopBinary
+        self.name = "hadoop command line"
+
+    def run(self, args, stdin=None) :
+        p = subprocess.Popen([self.hadoopBinary,"fs"]+args,stdin=stdin,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        return (p.returncode, output)
+
+    def check(self, args) :
+        (ret, output) = self.run(args)
+        if (0 != ret) :
+            raise Exception("problem with hadoop fs %s: %s" % (" ".join(args), output.strip()))
+        return output
+
+    def put(self, localPath, remotePath, overwrite=False) :
+        if (overwrite) :
+            self.rm(remotePath)
+        self.check(["-put",localPath,remotePath])
+
+    # put whatever writeContents(fp) writes
+    def putStream(self, writeContents, remotePath, overwrite=False) :
+        if (overwrite) :
+            self.rm(remotePath)
+        p = subprocess.Popen([self.hadoopBinary,"fs","-put","-",remotePath], stdin=subprocess.PIPE) # "-" reads from stdin
+        try :
+            writeContents(p.stdin)
+        finally :
+            p.stdin.close()
+        if (0 != p.wait()) :
+            raise Exception("problem with hadoop fs -put to %s" % remotePath)
+
+    def get(self, remotePath, localPath) :
+        self.check(["-copyToLocal",remotePath,localPath])
+
+    def cat(self, remotePath) :
+        return self.check(["-cat",remotePath])
+
+    # write the file's contents from offset on to sink - the CLI can't seek, so skip up to it
+    def getStream(self, remotePath, sink, offset=0) :
+        p = subprocess.Popen([self.hadoopBinary,"fs","-cat",remotePath],stdout=subprocess.PIPE)
+        while (offset > 0) :
+            skipped = len(p.stdout.read(min(offset,1024*1024)))
+            if (not skipped) :
+                break
+            offset -= skipped
+        shutil.copyfileobj(p.stdout, sink, 1024*1024)
+        if (0 != p.wait()) :
+            raise Exception("problem with hadoop fs -cat %s" % remotePath)
+
+    # FileStatus for each entry of a directory (or just the file, if it's a file), None if not there
+    def ls(self, remotePath) :
+        (ret, output) = self.run(["-ls",remotePath])
+        if (0 != ret) :
+            return None
+        entries = []
+        for line in output.split("\n") :
+            items = line.split()
+            if ((len(items) >= 6) and (items[0][0] in "-d")) :
+                mtime = None
+                if (len(items) >= 8) : # date and time columns
+                    mtime = items[-3]+" "+items[-2]
+                entries.append(FileStatus(hdfsPath(items[-1]), int(items[4]), items[0].startswith("d"), None, mtime))
+        return entries
+
+    def stat(self, remotePath) :
+        entries = self.ls(remotePath)
+        if (None != entries) :
+            for e in entries :
+                if (e.path == hdfsPath(remotePath)) :
+                    return e
+            # a listing can't tell a file from a directory holding one thing, so ask
+            if (0 == self.run(["-test","-d",remotePath])[0]) :
+                return FileStatus(hdfsPath(remotePath), 0, True)
+            if ((1 == len(entries)) and not entries[0].isDir) : # the file, under another spelling of its path
+                return entries[0]
+        return None
+
+    def rm(self, remotePath) :
+        self.run(["-rm",remotePath]) # not there is fine
+
+    def chmod(self, mode, remotePath) :
+        self.check(["-chmod",mode,remotePath])
+
+    def mkdir(self, remotePath) :
+        self.run(["-mkdir",remotePath]) # already there is fine
+
+#
+# WebHDFS: one keep-alive HTTP connection to the namenode, plus one per datanode that
+# the namenode redirects us to for file contents - per thread, so that concurrent uploads
+# and steps each have their own and transfers don't wait on each other
+#
+class WebHDFSFileSystem :
+    def __init__(self, address, user=None, timeout=60) :
+        self.address = address
+        self.user = user
+        self.timeout = timeout
+        self.local = threading.local() # .connections: "host:port" -> httplib.HTTPConnection
+        self.opened = [] # every connection any thread has made, for close()
+        self.lock = threading.Lock() # guards opened
+        self.name = "WebHDFS at %s" % address
+
+    def connections(self) :
+        if (not hasattr(self.local, "connections")) :
+            self.local.connections = {}
+        return self.local.connections
+
+    def connection(self, netloc) :
+        connections = self.connections()
+        if (not netloc in connections) :
+            connections[netloc] = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self.lock.acquire()
+            self.opened.append(connections[netloc])
+            self.lock.release()
+        return connections[netloc]
+
+    def url(self, remotePath, op, params) :
+        query = dict(params)
+        query["op"] = op
+        if (self.user) :
+            query["user.name"] = self.user
+        return "/webhdfs/v1%s?%s" % (urllib.quote(hdfsPath(remotePath)), urllib.urlencode(query))
+
+    # make a request on a kept alive connection, reconnecting once if the server has closed it
+    # on us - returns (status, redirect location, body) with body read in full unless a sink is given
+    def send(self, netloc, method, url, body=None, sink=None) :
+        for attempt in (0, 1) :
+            conn = self.connection(netloc)
+            try :
+                headers = {}
+                if (None != body) :
+                    if (hasattr(body, "seek")) :
+                        body.seek(0, 2)
+                        headers["Content-Length"] = str(body.tell())
+                        body.seek(0)
+                    else :
+                        headers["Content-Length"] = str(len(body))
+                    headers["Content-Type"] = "application/octet-stream"
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                if ((None != sink) and (200 == response.status)) :
+                    shutil.copyfileobj(response, sink, 1024*1024)
+                    data = ""
+                else :
+                    data = response.read()
+                return (response.status, response.getheader("location"), data)
+            except (httplib.HTTPException, socket.error) :
+                conn.close()
+                del self.connections()[netloc]
+                if (attempt) :
+                    raise
+
+    # request to the namenode, following a redirect to a datanode for file contents
+    def request(self, method, remotePath, op, params={}, body=None, sink=None, ok=(200,)) :
+        url = self.url(remotePath, op, params)
+        (status, location, data) = self.send(self.address, method, url, (None if (None != body) and ("CREATE" == op) else body), sink)
+        if (status in (301, 302, 307)) :
+            target = urlparse.urlparse(location)
+            (status, location, data) = self.send(target.netloc, method, target.path+"?"+target.query, body, sink)
+        self.check(op, remotePath, status, data, ok)
+        return (status, data)
+
+    def check(self, op, remotePath, status, data, ok) :
+        if (not status in ok) :
+            message = data
+            try :
+                message = json.loads(data)["RemoteException"]["message"]
+            except Exception :
+                pass
+            raise Exception("WebHDFS %s %s failed (%d): %s" % (op, hdfsPath(remotePath), status, message))
+
+    def put(self, localPath, remotePath, overwrite=False) :
+        f = open(localPath,"rb")
+        try :
+            self.request("PUT", remotePath, "CREATE", {"overwrite":str(overwrite).lower()}, body=f, ok=(200,201))
+        finally :
+            f.close()
+
+    # send what writeContents(fp) writes to the datanode as it's written, in HTTP chunks since
+    # we can't know the length up front - on a connection of its own, since a stream can't be
+    # replayed if a kept alive one turns out to have been dropped
+    def putStream(self, writeContents, remotePath, overwrite=False) :
+        url = self.url(remotePath, "CREATE", {"overwrite":str(overwrite).lower()})
+        (status, location, data) = self.send(self.address, "PUT", url)
+        if (status in (301, 302, 307)) :
+            target = urlparse.urlparse(location)
+            conn = httplib.HTTPConnection(target.netloc, timeout=self.timeout)
+            try :
+                conn.putrequest("PUT", target.path+"?"+target.query)
+                conn.putheader("Content-Type", "application/octet-stream")
+                conn.putheader("Transfer-Encoding", "chunked")
+                conn.endheaders()
+                writer = ChunkedWriter(conn)
+                writeContents(writer)
+                writer.close()
+                response = conn.getresponse()
+                (status, data) = (response.status, response.read())
+            finally :
+                conn.close()
+        self.check("CREATE", remotePath, status, data, (200,201))
+
+    def get(self, remotePath, localPath) :
+        f = open(localPath,"wb")
+        try :
+            self.request("GET", remotePath, "OPEN", sink=f)
+        finally :
+            f.close()
+
+    def cat(self, remotePath) :
+        return self.request("GET", remotePath, "OPEN")[1]
+
+    # write the file's contents from offset on to sink, as they arrive
+    def getStream(self, remotePath, sink, offset=0) :
+        self.request("GET", remotePath, "OPEN", {"offset":str(offset)}, sink=sink)
+
+    def status(self, remotePath, s) :
+        path = hdfsPath(remotePath)
+        if (s["pathSuffix"]) :
+            path = path.rstrip("/")+"/"+s["pathSuffix"]
+        return FileStatus(path, int(s["length"]), ("DIRECTORY" == s["type"]), s.get("permission"), s.get("modificationTime"))
+
+    def ls(self, remotePath) :
+        (status, data) = self.request("GET", remotePath, "LISTSTATUS", ok=(200,404))
+        if (404 == status) :
+            return None
+        return [self.status(remotePath, s) for s in json.loads(data)["FileStatuses"]["FileStatus"]]
+
+    def stat(self, remotePath) :
+        (status, data) = self.request("GET", remotePath, "GETFILESTATUS", ok=(200,404))
+        if (404 == status) :
+            return None
+        return self.status(remotePath, json.loads(data)["FileStatus"])
+
+    # like hadoop fs -rm, takes wildcards in the file name
+    def rm(self, remotePath) :
+        if (("*" in remotePath) or ("?" in remotePath)) :
+            pattern = hdfsPath(remotePath)
+            for e in (self.ls(os.path.dirname(pattern)) or []) :
+                if (fnmatch.fnmatchcase(e.path, pattern) and not e.isDir) :
+                    self.rm(e.path)
+            return
+        self.request("DELETE", remotePath, "DELETE", {"recursive":"false"}, ok=(200,404)) # not there is fine
+
+    def chmod(self, mode, remotePath) :
+        current = "0"
+        if (not mode.isdigit()) : # symbolic mode, need the current bits
+            current = (self.stat(remotePath) or FileStatus(remotePath,0)).permission
+        self.request("PUT", remotePath, "SETPERMISSION", {"permission":octalMode(mode, current)})
+
+    def mkdir(self, remotePath) :
+        self.request("PUT", remotePath, "MKDIRS")
+
+    # is there a namenode answering WebHDFS requests?
+    def ping(self) :
+        try :
+            self.request("GET", "/", "GETFILESTATUS")
+            return True
+        except Exception :
+            self.close()
+            return False
+
+    # can we get file contents through a datanode, too?  the namenode may well be reachable
+    # while the datanode addresses it redirects to aren't, from outside the cluster
+    def probe(self, remoteDir) :
+        path = remoteDir.rstrip("/")+"/.webhdfs_probe_%d" % os.getpid()
+        try :
+            self.request("PUT", path, "CREATE", {"overwrite":"true"}, body="probe", ok=(200,201))
+            ok = ("probe" == self.cat(path))
+            self.rm(path)
+            return ok
+        except Exception :
+            self.close()
+            return False
+
+    # closed connections reopen on their next request, so other threads can carry on
+    def close(self) :
+        self.lock.acquire()
+        try :
+            for conn in self.opened :
+                conn.close()
+        finally :
+            self.lock.release()
+
+# file object that sends what's written to it as HTTP/1.1 chunks, a megabyte or so at a time
+class ChunkedWriter :
+    def __init__(self, conn, chunkSize=1024*1024) :
+        self.conn = conn
+        self.chunkSize = chunkSize
+        self.pending = []
+        self.npending = 0
+
+    def write(self, data) :
+        if (data) :
+            self.pending.append(data)
+            self.npending += len(data)
+            if (self.npending >= self.chunkSize) :
+                self.flush()
+
+    def flush(self) :
+        if (self.npending) :
+            self.conn.send("%x\r\n%s\r\n" % (self.npending, "".join(self.pending)))
+            self.pending = []
+            self.npending = 0
+
+    # the empty chunk that ends the body
+    def close(self) :
+        self.flush()
+        self.conn.send("0\r\n\r\n")
+
+#
+# existence and size checks for many files at once: each directory asked about is listed
+# just once (one round trip, or one hadoop JVM), and the listing answers every question
+# about files in it for the rest of the launch
+#
+class StatCache :
+    def __init__(self, fs) :
+        self.fs = fs
+        self.listings = {} # directory -> { path : FileStatus }, or None if no such directory
+        self.changed = set() # paths written since their directory was listed
+        self.lock = threading.Lock()
+
+    def listing(self, directory) :
+        if (not directory in self.listings) :
+            entries = self.fs.ls(directory)
+            if (None != entries) :
+                entries = dict([(e.path, e) for e in entries])
+            self.listings[directory] = entries
+        return self.listings[directory]
+
+    def stat(self, remotePath) :
+        path = hdfsPath(remotePath)
+        if (path in self.changed) :
+            return self.fs.stat(path)
+        self.lock.acquire()
+        try :
+            entries = self.listing(os.path.dirname(path))
+        finally :
+            self.lock.release()
+        return (entries or {}).get(path)
+
+    # we've written or removed this, so the listing no longer speaks for it - for a wildcard
+    # we can't say which entries it hit, so the directory gets listed again when next asked about
+    def forget(self, remotePath) :
+        path = hdfsPath(remotePath)
+        if (("*" in path) or ("?" in path)) :
+            self.lock.acquire()
+            try :
+                self.listings.pop(os.path.dirname(path), None)
+            finally :
+                self.lock.release()
+        else :
+            self.changed.add(path)
+
+#
+# stand-in WebHDFS server over a local directory, for testing without a cluster
+#
+class LocalWebHDFSHandler(BaseHTTPServer.BaseHTTPRequestHandler) :
+    protocol_version = "HTTP/1.1" # keep-alive, like the real thing
+
+    def log_message(self, format, *args) :
+        pass
+
+    def reply(self, status, data="", contentType="application/json", headers={}) :
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        for (key, value) in headers.items() :
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def fail(self, status, exception, message) :
+        self.reply(status, json.dumps({"RemoteException":{"exception":exception,"message":message}}))
+
+    def readChunks(self) :
+        chunks = []
+        while True :
+            size = int(self.rfile.readline().split(";")[0], 16)
+            if (not size) :
+                while (self.rfile.readline().strip()) : # trailers, if any
+                    pass
+                return "".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline() # the CRLF after each chunk
+
+    def status(self, localPath) :
+        st = os.stat(localPath)
+        isDir = os.path.isdir(localPath)
+        return {"pathSuffix":"", "type":(isDir and "DIRECTORY") or "FILE",
+                "length":(not isDir and st.st_size) or 0, "permission":"%o" % (st.st_mode & 0777),
+                "modificationTime":int(st.st_mtime*1000)}
+
+    def handle_request(self, method) :
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        if (not url.path.startswith("/webhdfs/v1")) :
+            return self.fail(404, "FileNotFoundException", url.path)
+        remotePath = urllib.unquote(url.path[len("/webhdfs/v1"):]) or "/"
+        localPath = os.path.join(self.server.root, remotePath.lstrip("/"))
+        op = params.get("op","").upper()
+        body = ""
+        if ("Content-Length" in self.headers) :
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        elif ("chunked" == self.headers.get("Transfer-Encoding","")) :
+            body = self.readChunks()
+        if (("CREATE" == op) and not params.get("datanode")) : # namenode redirects to a "datanode"
+            return self.reply(307, headers={"Location":"http://%s:%d%s&datanode=true" % (self.server.server_address[0], self.server.server_address[1], self.path)})
+        if ("CREATE" == op) :
+            if (os.path.exists(localPath) and ("true" != params.get("overwrite"))) :
+                return self.fail(403, "FileAlreadyExistsException", remotePath)
+            if (not os.path.isdir(os.path.dirname(localPath))) :
+                os.makedirs(os.path.dirname(localPath))
+            f = open(localPath,"wb")
+            f.write(body)
+            f.close()
+            return self.reply(201)
+        if (("MKDIRS" == op)) :
+            if (not os.path.isdir(localPath)) :
+                os.makedirs(localPath)
+            return self.reply(200, json.dumps({"boolean":True}))
+        if (not os.path.exists(localPath)) :
+            return self.fail(404, "FileNotFoundException", "File %s does not exist." % remotePath)
+        if ("OPEN" == op) :
+            f = open(localPath,"rb")
+            f.seek(int(params.get("offset","0")))
+            data = f.read()
+            f.close()
+            return self.reply(200, data, "application/octet-stream")
+        if ("GETFILESTATUS" == op) :
+            return self.reply(200, json.dumps({"FileStatus":self.status(localPath)}))
+        if ("LISTSTATUS" == op) :
+            if (os.path.isdir(localPath)) :
+                entries = []
+                for name in sorted(os.listdir(localPath)) :
+                    s = self.status(os.path.join(localPath, name))
+                    s["pathSuffix"] = name
+                    entries.append(s)
+            else :
+                entries = [self.status(localPath)]
+            return self.reply(200, json.dumps({"FileStatuses":{"FileStatus":entries}}))
+        if ("DELETE" == op) :
+            if (os.path.isdir(localPath)) :
+                shutil.rmtree(localPath)
+            else :
+                os.unlink(localPath)
+            return self.reply(200, json.dumps({"boolean":True}))
+        if ("SETPERMISSION" == op) :
+            os.chmod(localPath, int(params.get("permission","755"),8))
+            return self.reply(200)
+        return self.fail(400, "IllegalArgumentException", "unsupported operation %s" % op)
+
+    def do_GET(self) :
+        self.handle_request("GET")
+
+    def do_PUT(self) :
+        self.handle_request("PUT")
+
+    def do_DELETE(self) :
+        self.handle_request("DELETE")
+
+class LocalWebHDFSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer) :
+    daemon_threads = True
+
+    def __init__(self, root, port=0) :
+        BaseHTTPServer.HTTPServer.__init__(self, ("localhost", port), LocalWebHDFSHandler)
+        self.root = os.path.abspath(root)
+
+    # serve in a background thread, returns "host:port" for WebHDFSFileSystem
+    def start(self) :
+        t = threading.Thread(target=self.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        return "%s:%d" % self.server_address
+
+if (__name__ == "__main__") :
+    if ((len(sys.argv) < 3) or ("serve" != sys.argv[1])) :
+        print "usage: %s serve <directory> [port]" % sys.argv[0]
+        sys.exit(1)
+    server = LocalWebHDFSServer(sys.argv[2], int((sys.argv[3:] or ["50070"])[0]))
+    print "serving %s as WebHDFS on %s:%d" % ((server.root,) + server.server_address)
+    server.serve_forever()
@@ -0,0 +1,374 @@
+#
+# protein database indexing for MR-Tandem: digest a FASTA or .pro database once with the
+# cleavage and modification settings of a search, and keep the resulting peptides sorted by
+# mass, so that repeated searches can see how many candidates fall in a precursor window
+# without redigesting the database.  Index files are named for a hash of the database
+# contents and the digestion settings, so one built for an earlier job is simply reused.
+#
+# Part of the Insilicos Cloud Army Project:
+# see http://sourceforge.net/projects/ica/trunk for latest and greatest
+#
+# Copyright (C) 2011 Insilicos LLC  All Rights Reserved
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import re
+import struct
+import hashlib
+import bisect
+import heapq
+import mmap
+import tempfile
+import simplejson as json
+from array import array
+from xml.etree import ElementTree as ET
+
+import mapreduce_helper as mrh
+
+WATER_MASS = 18.010565
+PROTON_MASS = 1.007276
+
+# monoisotopic residue masses
+residueMasses = {
+    "G":57.021464, "A":71.037114, "S":87.032028, "P":97.052764, "V":99.068414,
+    "T":101.047679, "C":103.009185, "L":113.084064, "I":113.084064, "N":114.042927,
+    "D":115.026943, "Q":128.058578, "K":128.094963, "E":129.042593, "M":131.040485,
+    "H":137.058912, "F":147.068414, "R":156.101111, "Y":163.06332, "W":186.079313,
+    "U":150.95363, "O":237.147727 }
+
+#
+# search settings, as tandem sees them: a parameters file plus the default parameters
+# file it names, with values in the main file taking precedence
+#
+def readParamNotes(path) :
+    notes = {}
+    tree = ET.parse(mrh.cygwinify(path))
+    for note in tree.getiterator("note") :
+        label = note.get("label")
+        if ((None != label) and not (label in notes)) :
+            notes[label] = (note.text or "").strip()
+    return notes
+
+# tandem looks for relative paths in the working directory - we also try next to the referring file
+def resolveParamPath(name, referringPath) :
+    if (os.path.exists(name)) :
+        return mrh.my_abspath(name)
+    return mrh.my_abspath(os.path.join(os.path.dirname(referringPath), name))
+
+def loadSearchParams(paramsPath) :
+    params = readParamNotes(paramsPath)
+    defaultsName = params.get("list path, default parameters","")
+    if (len(defaultsName)) :
+        defaultsPath = resolveParamPath(defaultsName, paramsPath)
+        if (os.path.exists(defaultsPath)) :
+            defaults = readParamNotes(defaultsPath)
+            defaults.update(params)
+            params = defaults
+    return params
+
+# the database files the search's taxon refers to
+def findDatabaseFiles(params, paramsPath) :
+    taxonomyName = params.get("list path, taxonomy information","")
+    taxon = params.get("protein, taxon","")
+    if ((not len(taxonomyName)) or (not len(taxon))) :
+        return []
+    taxonomyPath = resolveParamPath(taxonomyName, paramsPath)
+    paths = []
+    for t in ET.parse(mrh.cygwinify(taxonomyPath)).getiterator("taxon") :
+        if (t.get("label") == taxon) :
+            for f in t.getiterator("file") :
+                paths.append(mrh.my_abspath(f.attrib["URL"]))
+    return paths
+
+# the settings that decide which peptides a digest produces, in a canonical form for hashing
+def getDigestionParams(params) :
+    return {
+        "cleavage" : params.get("protein, cleavage site","") or "[RK]|{P}",
+        "missed" : int(params.get("scoring, maximum missed cleavage sites","") or "1"),
+        "fixedMods" : params.get("residue, modification mass",""),
+        "nTermMod" : params.get("protein, N-terminal residue modification mass",""),
+        "cTermMod" : params.get("protein, C-terminal residue modification mass","") }
+
+def digestionParamsString(digestion) :
+    return ";".join(["%s=%s" % (key, digestion[key]) for key in sorted(digestion.keys())])
+
+# precursor window as (minus, plus, isPPM)
+def getPrecursorTolerance(params) :
+    minus = float(params.get("spectrum, parent monoisotopic mass error minus","") or "2.0")
+    plus = float(params.get("spectrum, parent monoisotopic mass error plus","") or "2.0")
+    isPPM = params.get("spectrum, parent monoisotopic mass error units","").lower().startswith("ppm")
+    return (minus, plus, isPPM)
+
+#
+# digestion
+#
+
+# "[RK]|{P}" -> (N side test, C side test), each a function of one residue; None for nonspecific
+def parseCleavageRule(rule) :
+    sides = rule.split(",")[0].split("|")
+    if (2 != len(sides)) :
+        return None
+    tests = []
+    for side in sides :
+        side = side.strip().upper()
+        residues = side[1:-1]
+        if ("X" in residues) :
+            tests.append(None) # any residue
+        elif (side.startswith("{")) :
+            tests.append(lambda r, residues=residues: not (r in residues))
+        else :
+            tests.append(lambda r, residues=residues: r in residues)
+    if ((None == tests[0]) and (None == tests[1])) :
+        return None # cleaves anywhere, far too many peptides to index
+    return tests
+
+# "57.021464@C,15.994915@M" -> {"C":57.021464, "M":15.994915}, ignoring terminal ("[" and "]") mods
+def parseFixedMods(text) :
+    mods = {}
+    for item in text.split(",") :
+        if ("@" in item) :
+            (mass, residue) = item.strip().split("@",1)
+            if ((1 == len(residue)) and residue.isalpha()) :
+                mods[residue.upper()] = mods.get(residue.upper(),0.0) + float(mass)
+    return mods
+
+# protein terminal modification mass, as a float
+def parseTermMod(text) :
+    try :
+        return float(text or "0")
+    except ValueError :
+        return 0.0
+
+# yield (offset, length, mass) for each peptide of a protein sequence - nTermMod and cTermMod
+# apply to the peptides that start or end the protein
+def digestProtein(sequence, rule, missed, masses, termMass, nTermMod=0.0, cTermMod=0.0) :
+    (nTest, cTest) = rule
+    sites = [0]
+    for i in range(1, len(sequence)) :
+        if (((None == nTest) or nTest(sequence[i-1])) and ((None == cTest) or cTest(sequence[i]))) :
+            sites.append(i)
+    sites.append(len(sequence))
+    # cumulative residue masses make each peptide mass a subtraction
+    cumulative = array("d",[0.0])
+    for r in sequence :
+        cumulative.append(cumulative[-1]+masses.get(r,0.0))
+    for s in range(len(sites)-1) :
+        for e in range(s+1, min(s+missed+2, len(sites))) :
+            start = sites[s]
+            length = sites[e]-start
+            if (length >= 4) :
+                mass = cumulative[sites[e]]-cumulative[start]+termMass
+                if (0 == start) :
+                    mass += nTermMod
+                if (len(sequence) == sites[e]) :
+                    mass += cTermMod
+                yield (start, length, mass)
+
+# yield (description, sequence) for each protein in a FASTA or X!Tandem .pro file
+def readProteins(path) :
+    f = open(path,"rb")
+    try :
+        if (path.endswith(".pro")) :
+            f.seek(256) # fixed size header
+            while True :
+                header = f.read(4)
+                if (len(header) < 4) :
+                    break
+                description = f.read(struct.unpack("<i",header)[0]).rstrip("\0")
+                length = struct.unpack("<i",f.read(4))[0]
+                yield (description, f.read(length).rstrip("\0").upper())
+        else :
+            description = None
+            sequence = []
+            for line in f :
+                line = line.strip()
+                if (line.startswith(">")) :
+                    if (None != description) :
+                        yield (description, "".join(sequence).upper())
+                    description = line[1:]
+                    sequence = []
+                else :
+                    sequence.append(line)
+            if (None != description) :
+                yield (description, "".join(sequence).upper())
+    finally :
+        f.close()
+
+#
+# the index file: header, then peptide records sorted by mass
+#
+INDEX_MAGIC = "MRTPIDX2"
+indexHeader = struct.Struct("<8sII") # magic, peptide count, protein count
+indexRecord = struct.Struct("<dIIH") # peptide mass (M+H), protein ordinal, residue offset, length
+
+def getDatabaseIndexDir() :
+    return mrh.my_abspath(os.path.expanduser(mrh.getConfig("databaseIndexDir","~/.mrtandem_dbindex")))
+
+# md5 of each database, kept with its size and mtime, so that an unchanged database of
+# several GB isn't hashed again on every launch
+databaseDigests = None # loaded on first use
+def getDatabaseDigestsPath() :
+    return os.path.join(getDatabaseIndexDir(),"digests.json")
+
+def databaseDigest(databasePath) :
+    global databaseDigests
+    if (None == databaseDigests) :
+        try :
+            f = open(getDatabaseDigestsPath(),"r")
+            databaseDigests = json.load(f)
+            f.close()
+        except Exception :
+            databaseDigests = {}
+    st = os.stat(databasePath)
+    entry = databaseDigests.get(databasePath)
+    if ((None != entry) and (entry["size"] == st.st_size) and (entry["mtime"] == st.st_mtime)) :
+        return entry["md5"]
+    (hexMD5, b64MD5) = mrh.computeLocalMD5(databasePath)
+    databaseDigests[databasePath] = { "size":st.st_size, "mtime":st.st_mtime, "md5":hexMD5 }
+    try :
+        if (not os.path.exists(getDatabaseIndexDir())) :
+            os.makedirs(getDatabaseIndexDir())
+        f = open(getDatabaseDigestsPath(),"w")
+        json.dump(databaseDigests, f)
+        f.close()
+    except Exception, exception :
+        mrh.debug( "could not save database digests: %s" % exception )
+    return hexMD5
+
+# index files are named for the database contents plus the digestion settings (and the index
+# format, so that indexes built by older code aren't trusted)
+def databaseIndexPath(databasePath, digestion) :
+    key = hashlib.md5(INDEX_MAGIC+databaseDigest(databasePath)+digestionParamsString(digestion)).hexdigest()
+    return "%s/%s.%s.pidx" % (getDatabaseIndexDir(), os.path.basename(databasePath), key)
+
+# how many peptides to sort in memory at once when building an index - bigger databases are
+# sorted in runs of this many, spilled to temp files and merged, so memory stays bounded
+def getDatabaseIndexSortPeptides() :
+    return int(mrh.getConfig("databaseIndexSortPeptides","500000"))
+
+# sort some (mass, protein, offset, length) records and spill them to a temp file
+def writeSortedRun(records) :
+    records.sort()
+    run = tempfile.TemporaryFile()
+    for record in records :
+        run.write(indexRecord.pack(*record))
+    run.seek(0)
+    return run
+
+# yield the records of a spilled run
+def readRun(run) :
+    while True :
+        data = run.read(indexRecord.size)
+        if (len(data) < indexRecord.size) :
+            break
+        yield indexRecord.unpack(data)
+
+def buildDatabaseIndex(databasePath, digestion, indexPath) :
+    rule = parseCleavageRule(digestion["cleavage"])
+    if (None == rule) :
+        mrh.info( "not indexing %s, cleavage rule %s is nonspecific" % (databasePath, digestion["cleavage"]) )
+        return False
+    masses = dict(residueMasses)
+    for (residue, delta) in parseFixedMods(digestion["fixedMods"]).iteritems() :
+        masses[residue] = masses.get(residue,0.0) + delta
+    termMass = WATER_MASS + PROTON_MASS # we index M+H, as tandem reports it
+    nTermMod = parseTermMod(digestion["nTermMod"])
+    cTermMod = parseTermMod(digestion["cTermMod"])
+    limit = getDatabaseIndexSortPeptides()
+    runs = []
+    records = []
+    count = 0
+    nproteins = 0
+    for (description, sequence) in readProteins(databasePath) :
+        for (offset, length, mass) in digestProtein(sequence, rule, digestion["missed"], masses, termMass, nTermMod, cTermMod) :
+            records.append((mass, nproteins, offset, min(length,0xffff)))
+            count += 1
+            if (len(records) >= limit) :
+                runs.append(writeSortedRun(records))
+                records = []
+        nproteins += 1
+    records.sort()
+    if (not os.path.exists(os.path.dirname(indexPath))) :
+        os.makedirs(os.path.dirname(indexPath))
+    tmpPath = indexPath+".tmp"
+    out = open(tmpPath,"wb")
+    out.write(indexHeader.pack(INDEX_MAGIC, count, nproteins))
+    for record in heapq.merge(iter(records), *[readRun(run) for run in runs]) :
+        out.write(indexRecord.pack(*record))
+    out.close()
+    for run in runs :
+        run.close()
+    os.rename(tmpPath, indexPath) # never leave a partial index where it would be trusted
+    mrh.info( "indexed %d peptides from %d proteins in %s as %s" % (count, nproteins, databasePath, indexPath) )
+    return True
+
+# path of the mass sorted peptide index for this database and digestion, building it if
+# need be - or None if this database can't usefully be indexed
+def getDatabaseIndex(databasePath, digestion) :
+    indexPath = databaseIndexPath(databasePath, digestion)
+    if (os.path.exists(indexPath)) :
+        mrh.debug( "using existing database index %s" % indexPath )
+        return indexPath
+    if (buildDatabaseIndex(databasePath, digestion, indexPath)) :
+        return indexPath
+    return None
+
+# just the sorted peptide masses from an index file, 8 bytes apiece
+def readIndexMasses(indexPath) :
+    f = open(indexPath,"rb")
+    try :
+        (magic, count, nproteins) = indexHeader.unpack(f.read(indexHeader.size))
+        if (INDEX_MAGIC != magic) :
+            raise Exception("%s is not a database index file" % indexPath)
+        masses = array("d")
+        if (count) :
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # so the records aren't all read in at once
+            try :
+                for n in xrange(count) :
+                    masses.append(indexRecord.unpack_from(data, indexHeader.size+(n*indexRecord.size))[0])
+            finally :
+                data.close()
+    finally :
+        f.close()
+    return masses
+
+# returns a function that gives the number of candidate peptides within the search's precursor
+# window of a given neutral mass (for spectrum_index.estimateCost), or None if the search's
+# databases can't be indexed.  Each database's masses are already sorted, so rather than merge
+# them we just count within each one
+def getCandidateCounter(paramsPath) :
+    params = loadSearchParams(paramsPath)
+    digestion = getDigestionParams(params)
+    indexes = []
+    for databasePath in findDatabaseFiles(params, paramsPath) :
+        if (not os.path.exists(databasePath)) :
+            return None
+        indexPath = getDatabaseIndex(databasePath, digestion)
+        if (None == indexPath) :
+            return None
+        masses = readIndexMasses(indexPath)
+        if (len(masses)) :
+            indexes.append(masses)
+    if (not len(indexes)) :
+        return None
+    (minus, plus, isPPM) = getPrecursorTolerance(params)
+    def candidateCount(mass) :
+        mh = mass+PROTON_MASS
+        if (isPPM) :
+            (low, high) = (mh-(mh*minus*1e-6), mh+(mh*plus*1e-6))
+        else :
+            (low, high) = (mh-minus, mh+plus)
+        return sum([bisect.bisect_right(masses, high) - bisect.bisect_left(masses, low) for masses in indexes])
+    return candidateCount
@@ -0,0 +1,195 @@
+#
+# database sharding for MR-Tandem: rather than splitting the spectra among mappers, split
+# a (large) protein database into shards of about equal residue count, and search the full
+# spectrum set against each shard as its own job in a multi-config run.  Per-shard results
+# are then merged by spectrum, keeping each spectrum's best match across the shards.
+# This keeps memory per mapper bounded as the database grows.
+#
+# Part of the Insilicos Cloud Army Project:
+# see http://sourceforge.net/projects/ica/trunk for latest and greatest
+#
+# Copyright (C) 2011 Insilicos LLC  All Rights Reserved
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import math
+import struct
+from xml.etree import ElementTree as ET
+
+import mapreduce_helper as mrh
+import database_index
+
+if (hasattr(ET, "register_namespace")) : # keep tandem's prefix on the spectrum traces when we rewrite results
+    ET.register_namespace("GAML", "http://www.bioml.com/gaml/")
+
+# "foo.fasta.pro" -> "foo.fasta.shard2of4.pro", keeping the extension tandem goes by
+def shardName(path, shard, nshards) :
+    (base, ext) = os.path.splitext(path)
+    return "%s.shard%dof%d%s" % (base, shard+1, nshards, ext)
+
+def isUpToDate(path, sourcePath) :
+    return os.path.exists(path) and (os.path.getmtime(path) >= os.path.getmtime(sourcePath))
+
+def writeProtein(out, isPro, description, sequence) :
+    if (isPro) :
+        out.write(struct.pack("<i",len(description)+1)+description+"\0")
+        out.write(struct.pack("<i",len(sequence)+1)+sequence+"\0")
+    else :
+        out.write(">"+description+"\n")
+        for n in range(0, len(sequence), 60) :
+            out.write(sequence[n:n+60]+"\n")
+
+# split a FASTA or .pro database into nshards files of about equal residue count, each protein
+# going to whichever shard is lightest so far - returns the list of shard paths
+def splitDatabase(databasePath, nshards) :
+    shardPaths = [shardName(databasePath, n, nshards) for n in range(nshards)]
+    if (not [p for p in shardPaths if not isUpToDate(p, databasePath)]) :
+        mrh.info( "using existing %d shards of %s" % (nshards, databasePath) )
+        return shardPaths
+    mrh.info( "splitting %s into %d shards" % (databasePath, nshards) )
+    isPro = databasePath.endswith(".pro")
+    outs = [open(p+".tmp","wb") for p in shardPaths]
+    if (isPro) : # keep the fixed size header
+        f = open(databasePath,"rb")
+        header = f.read(256)
+        f.close()
+        for out in outs :
+            out.write(header)
+    residues = [0]*nshards
+    for (description, sequence) in database_index.readProteins(databasePath) :
+        n = residues.index(min(residues))
+        writeProtein(outs[n], isPro, description, sequence)
+        residues[n] += len(sequence)
+    for n in range(nshards) :
+        outs[n].close()
+        os.rename(shardPaths[n]+".tmp", shardPaths[n]) # never leave a partial shard where it would be trusted
+    mrh.info( "shard residue counts for %s: %s" % (databasePath, ", ".join([str(r) for r in residues])) )
+    return shardPaths
+
+# write a copy of the taxonomy file with the given taxon's databases replaced by their nth shards
+def writeShardTaxonomy(taxonomyPath, taxon, shard, nshards) :
+    tree = ET.parse(mrh.cygwinify(taxonomyPath))
+    for t in tree.getiterator("taxon") :
+        if (t.get("label") == taxon) :
+            for f in t.getiterator("file") :
+                shards = splitDatabase(mrh.my_abspath(f.attrib["URL"]), nshards)
+                f.attrib["URL"] = shards[shard]
+    shardPath = shardName(taxonomyPath, shard, nshards)
+    tree.write(shardPath)
+    return shardPath
+
+# set a note in a tandem parameters tree, adding it if need be
+def setParamNote(tree, label, text) :
+    for note in tree.getiterator("note") :
+        if (note.get("label") == label) :
+            note.text = text
+            return
+    note = ET.SubElement(tree.getroot(), "note", {"type":"input", "label":label})
+    note.text = text
+
+# set up a database sharded search: returns (shard params files, output path, shard output paths)
+# so the shard searches can run as a multi-config job and be merged with mergeShardResults()
+def shardSearch(paramsPath, nshards) :
+    params = database_index.loadSearchParams(paramsPath)
+    taxonomyPath = database_index.resolveParamPath(params.get("list path, taxonomy information",""), paramsPath)
+    taxon = params.get("protein, taxon","")
+    outputPath = mrh.my_abspath(params.get("output, path","output.xml"))
+    shardParams = []
+    shardOutputs = []
+    for shard in range(nshards) :
+        tree = ET.parse(mrh.cygwinify(paramsPath))
+        setParamNote(tree, "list path, taxonomy information", writeShardTaxonomy(taxonomyPath, taxon, shard, nshards))
+        shardOutputs.append(shardName(outputPath, shard, nshards))
+        setParamNote(tree, "output, path", shardOutputs[-1])
+        setParamNote(tree, "output, path hashing", "no") # so we know what to merge
+        shardParams.append(shardName(mrh.my_abspath(paramsPath), shard, nshards))
+        tree.write(shardParams[-1])
+    mrh.log( "searching %s as %d database shards" % (paramsPath, nshards) )
+    return (shardParams, outputPath, shardOutputs)
+
+def expectValue(group) :
+    try :
+        return float(group.get("expect"))
+    except (TypeError, ValueError) :
+        return float("inf")
+
+def groupOrder(group) :
+    try :
+        return (0, int(group.get("id")), "")
+    except (TypeError, ValueError) :
+        return (1, 0, group.get("id"))
+
+# tandem's expectation values count the candidates a spectrum was scored against, so a shard's
+# are too small by about the ratio of database to shard size - put that back into a model's
+# expect values, and the protein expect (a log10) likewise
+def rescaleExpect(group, factor) :
+    if (None != group.get("expect")) :
+        group.set("expect", "%.1e" % (expectValue(group)*factor))
+    for protein in group.getiterator("protein") :
+        try :
+            protein.set("expect", "%.1f" % (float(protein.get("expect"))+math.log10(factor)))
+        except (TypeError, ValueError) :
+            pass
+    for domain in group.getiterator("domain") :
+        try :
+            domain.set("expect", "%.1e" % (float(domain.get("expect"))*factor))
+        except (TypeError, ValueError) :
+            pass
+
+# merge tandem result files from the shards of a database sharded search: for each spectrum
+# keep the best (lowest expectation value) model found in any shard, with its expectation
+# values scaled up from shard to full database (shards have about equal residue counts, so by
+# the number of shards - approximate, since it assumes candidates spread evenly over shards)
+def mergeShardResults(shardOutputs, outputPath) :
+    best = {} # spectrum id -> model group
+    others = None # parameter and performance groups, taken from the first shard
+    root = None
+    prolog = ""
+    for path in shardOutputs :
+        if (not os.path.exists(path)) :
+            mrh.log( "error: no result file %s for database shard, merged result will be incomplete" % path )
+            continue
+        if (None == root) : # keep the xml declaration and stylesheet reference as is
+            f = open(path,"rb")
+            head = f.read(4096)
+            f.close()
+            if (head.find("<bioml") > 0) :
+                prolog = head[:head.find("<bioml")]
+        tree = ET.parse(path)
+        groups = tree.getroot().findall("group")
+        if (None == root) :
+            root = tree.getroot()
+            others = [g for g in groups if ("model" != g.get("type"))]
+        for g in groups :
+            if ("model" == g.get("type")) :
+                previous = best.get(g.get("id"))
+                if ((None == previous) or (expectValue(g) < expectValue(previous))) :
+                    best[g.get("id")] = g
+    if (None == root) :
+        mrh.log( "error: no database shard results to merge for %s" % outputPath )
+        return
+    for g in list(root) :
+        root.remove(g)
+    for g in sorted(best.values(), key=groupOrder) :
+        rescaleExpect(g, len(shardOutputs))
+        root.append(g)
+    for g in others :
+        root.append(g)
+    out = open(outputPath,"wb")
+    out.write(prolog or '<?xml version="1.0"?>\n')
+    out.write(ET.tostring(root))
+    out.close()
+    mrh.log( "merged %d database shard results into %s (%d spectra with models)" % (len(shardOutputs), outputPath, len(best)) )
+    mrh.log( "note: expectation values in %s are scaled up by %d from the shard searches, and are approximate" % (outputPath, len(shardOutputs)) )
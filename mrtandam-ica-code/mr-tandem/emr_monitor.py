@@ -0,0 +1,109 @@
+#
+# EMR job flow monitoring for MR-Tandem: watch a job flow's overall and per-step state,
+# reporting transitions as they happen, and back off (with jitter, so many launchers don't
+# poll in lockstep) while nothing is changing.  Per-config results are fetched only once
+# the step that writes them has finished, and each result part is downloaded exactly once.
+#
+# Part of the Insilicos Cloud Army Project:
+# see http://sourceforge.net/projects/ica/trunk for latest and greatest
+#
+# Copyright (C) 2011 Insilicos LLC  All Rights Reserved
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import random
+from time import sleep
+
+import mapreduce_helper as mrh
+
+FINISHED_JOBFLOW_STATES = ["COMPLETED", "FAILED", "TERMINATED"]
+FINISHED_STEP_STATES = ["COMPLETED", "FAILED", "CANCELLED", "INTERRUPTED"]
+
+# much less than 10 sec and AWS gets irritated and throttles you back
+def getMonitorMinWait() :
+    return max(10,int(mrh.getConfig("monitorMinWaitSeconds","15")))
+
+def getMonitorMaxWait() :
+    return max(getMonitorMinWait(),int(mrh.getConfig("monitorMaxWaitSeconds","120")))
+
+class JobflowMonitor :
+    # nsteps is the number of steps we submitted, which EMR lists after any of its own (debug setup),
+    # or starting at firstStep if we added them to a job flow that already had some
+    def __init__(self, conn, jobflowId, nsteps, firstStep=None) :
+        self.conn = conn
+        self.jobflowId = jobflowId
+        self.nsteps = nsteps
+        self.firstStep = firstStep
+        self.state = ""
+        self.stepStates = []
+        self.minWait = getMonitorMinWait()
+        self.maxWait = getMonitorMaxWait()
+        self.wait = self.minWait
+
+    # ask EMR how things stand, logging any changes - returns True if anything changed
+    def poll(self) :
+        jf = self.conn.describe_jobflow(self.jobflowId)
+        changed = False
+        if (self.state != jf.state) :
+            mrh.log("cluster status: "+jf.state)
+            self.state = jf.state
+            changed = True
+        steps = getattr(jf, "steps", [])
+        if (None == self.firstStep) :
+            ours = steps[max(0,len(steps)-self.nsteps):]
+        else :
+            ours = steps[self.firstStep:self.firstStep+self.nsteps]
+        states = [getattr(s, "state", "") for s in ours]
+        for n in range(len(states)) :
+            old = ((n < len(self.stepStates)) and self.stepStates[n]) or ""
+            if (old != states[n]) :
+                mrh.log("step %d of %d (%s): %s" % (n+1, self.nsteps, getattr(ours[n], "name", ""), states[n]))
+                changed = True
+        self.stepStates = states
+        if (not changed) :
+            mrh.log_progress() # just put a dot
+        return changed
+
+    # state of the nth step we submitted, "" if EMR hasn't listed it yet
+    def stepState(self, n) :
+        if (n < len(self.stepStates)) :
+            return self.stepStates[n]
+        return ""
+
+    def isStepFinished(self, n) :
+        return self.stepState(n) in FINISHED_STEP_STATES
+
+    def isFinished(self) :
+        if (self.state in FINISHED_JOBFLOW_STATES) :
+            return True
+        # a kept alive job flow just goes to WAITING when it runs out of steps, and one we
+        # share may have others' steps to run after ours
+        ourStepsDone = ((len(self.stepStates) == self.nsteps) and
+                        not [s for s in self.stepStates if not (s in FINISHED_STEP_STATES)])
+        return ourStepsDone and (("WAITING" == self.state) or (None != self.firstStep))
+
+    # sleep till the next poll: back to the minimum after a change, doubling while quiet
+    def pause(self, changed) :
+        if (changed) :
+            self.wait = self.minWait
+        else :
+            self.wait = min(self.maxWait, self.wait*2)
+        sleep(random.uniform(max(self.minWait, self.wait/2.0), self.wait))
+
+# the concatenated contents of the result parts under an S3 prefix, in name order - called
+# once the step writing them has finished, so each part is listed and downloaded just once
+def fetchParts(bucket, prefix) :
+    from boto.s3.bucketlistresultset import BucketListResultSet
+    names = sorted([part.name for part in BucketListResultSet(bucket, prefix=prefix)])
+    return "".join([mrh.get_contents_as_string(name) for name in names])
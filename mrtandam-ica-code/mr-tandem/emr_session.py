@@ -0,0 +1,89 @@
+#
+# warm EMR sessions for MR-Tandem: rather than starting a job flow for every search (bootstrap,
+# copy the databases from S3 to HDFS, tear down), a run can attach to a kept alive job flow by
+# setting "jobflowId", and just add its search steps.  What copier steps have already put in
+# that job flow's HDFS is recorded in a manifest kept in S3 next to it, so each data file is
+# copied to a given cluster only once - or again, if its S3 copy has changed since.
+#
+# Part of the Insilicos Cloud Army Project:
+# see http://sourceforge.net/projects/ica/trunk for latest and greatest
+#
+# Copyright (C) 2011 Insilicos LLC  All Rights Reserved
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import simplejson as json
+
+import mapreduce_helper as mrh
+
+ATTACHABLE_JOBFLOW_STATES = ["STARTING", "BOOTSTRAPPING", "RUNNING", "WAITING"]
+
+# the kept alive job flow to run on, or "" to start a new one
+def getSessionJobflow() :
+    return mrh.getConfig("jobflowId","")
+
+# will the job flow outlive this run, so that later runs can use it?
+def isSession() :
+    return ("" != getSessionJobflow()) or ("True" == mrh.getConfig("keepHead","False"))
+
+# make sure the job flow can take more steps - returns the number of steps it has so far,
+# which is where ours will start
+def attachJobflow(conn, jobflowId) :
+    try :
+        jf = conn.describe_jobflow(jobflowId)
+    except Exception, exception :
+        mrh.log( "can't find job flow %s: %s" % (jobflowId, exception) )
+        mrh.log( "exiting with error" )
+        exit(-1)
+    if (not jf.state in ATTACHABLE_JOBFLOW_STATES) :
+        mrh.log( "job flow %s is %s, and can't take any more steps" % (jobflowId, jf.state) )
+        mrh.log( "exiting with error" )
+        exit(-1)
+    nsteps = len(getattr(jf, "steps", []))
+    mrh.log( "adding steps to job flow %s (%s, %d steps so far)" % (jobflowId, jf.state, nsteps) )
+    return nsteps
+
+def getManifestName(jobflowId) :
+    return "mrtandem-sessions/%s-staged.json" % jobflowId
+
+#
+# the data files in a job flow's HDFS, each with the etag of the S3 object it was copied from
+#
+class StagingManifest :
+    def __init__(self, jobflowId) :
+        self.staged = {}
+        self.pending = {} # copies we're asking for in this run
+        if ("" != jobflowId) :
+            key = mrh.s3bucket.get_key(getManifestName(jobflowId))
+            if (None != key) :
+                try :
+                    self.staged = json.loads(key.get_contents_as_string())
+                except Exception, exception :
+                    mrh.log( "ignoring unreadable staging manifest for %s: %s" % (jobflowId, exception) )
+            mrh.info( "%d data files already staged in job flow %s" % (len(self.staged), jobflowId) )
+
+    # is the HDFS copy current, given the etag of the S3 object?  if not, we'll note it as being
+    # copied in this run
+    def isStaged(self, hdfsName, etag) :
+        if (("" != etag) and (self.staged.get(hdfsName) == etag)) :
+            mrh.info( "%s is already staged in HDFS" % hdfsName )
+            return True
+        self.pending[hdfsName] = etag
+        return False
+
+    # the copier step completed, which it only does if every copy succeeded, so record what it copied
+    def save(self, jobflowId) :
+        self.staged.update(self.pending)
+        self.pending = {}
+        mrh.set_contents_from_string(getManifestName(jobflowId), json.dumps(self.staged))
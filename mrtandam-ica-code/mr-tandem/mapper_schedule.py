@@ -0,0 +1,144 @@
+#
+# mapper work scheduling for MR-Tandem: how finely to cut the spectra up among mapper tasks.
+# Each line of mapper input says "take the nth of every m spectra"; we write (mappers times
+# mapperMultiplier) of those, so that a slow task holds up less of the job.  The multiplier
+# is 4 unless set, or with "mapperMultiplier":"auto" it is worked out from the number of
+# spectra and their estimated search cost, using the seconds per unit of estimated cost seen
+# in earlier local runs to aim for tasks of about targetTaskSeconds each.
+#
+# Part of the Insilicos Cloud Army Project:
+# see http://sourceforge.net/projects/ica/trunk for latest and greatest
+#
+# Copyright (C) 2011 Insilicos LLC  All Rights Reserved
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import re
+import math
+import simplejson as json
+
+import mapreduce_helper as mrh
+import spectrum_index
+
+DEFAULT_MAPPER_MULTIPLIER = 4
+
+# the configured multiplier, or None for "auto"
+def getMapperMultiplier() :
+    value = mrh.getConfig("mapperMultiplier",str(DEFAULT_MAPPER_MULTIPLIER))
+    if ("auto" == value) :
+        return None
+    return max(1,int(value))
+
+def getTargetTaskSeconds() :
+    return max(1,int(mrh.getConfig("targetTaskSeconds","60")))
+
+def getMaxMapperMultiplier() :
+    return max(1,int(mrh.getConfig("maxMapperMultiplier","16")))
+
+def getMinSpectraPerTask() :
+    return max(1,int(mrh.getConfig("minSpectraPerTask","20")))
+
+#
+# measured cost: seconds of mapper time per unit of spectrum_index.estimateCost, kept as a
+# running average across local runs
+#
+def getTaskHistoryPath() :
+    return mrh.getConfig("taskHistory",os.path.join(os.path.expanduser("~"),".mrtandem_task_history.json"))
+
+def loadTaskHistory() :
+    try :
+        f = open(getTaskHistoryPath(),"r")
+        history = json.load(f)
+        f.close()
+        return history
+    except Exception :
+        return {}
+
+def getSecondsPerCostUnit() :
+    if ("" != mrh.getConfig("secondsPerCostUnit","")) :
+        return float(mrh.getConfig("secondsPerCostUnit"))
+    return loadTaskHistory().get("secondsPerCostUnit")
+
+def noteMeasuredCost(estimatedCost, mapperSeconds) :
+    if ((estimatedCost <= 0) or (mapperSeconds <= 0)) :
+        return
+    history = loadTaskHistory()
+    rate = mapperSeconds/estimatedCost
+    if (history.get("secondsPerCostUnit")) : # weight recent runs, but don't forget old ones
+        rate = (0.5*rate) + (0.5*history["secondsPerCostUnit"])
+    history["secondsPerCostUnit"] = rate
+    history["runs"] = history.get("runs",0)+1
+    try :
+        f = open(getTaskHistoryPath(),"w")
+        json.dump(history, f)
+        f.close()
+    except Exception, exception :
+        mrh.debug( "could not save task history: %s" % exception )
+
+# (spectrum count, total estimated search cost) of a spectrum file, or None if we can't index it
+searchCosts = {} # (path, mtime, candidateCount) -> estimate, so we only index each file once
+def estimateSearchCost(spectrumPath, candidateCount=None) :
+    key = (spectrumPath, os.path.getmtime(spectrumPath), candidateCount)
+    if (not key in searchCosts) :
+        entries = spectrum_index.indexSpectrumFile(spectrumPath)
+        if (None == entries) :
+            searchCosts[key] = None
+        else :
+            searchCosts[key] = (len(entries), sum([spectrum_index.estimateCost(e, candidateCount) for e in entries]))
+    return searchCosts[key]
+
+# pick an over-decomposition factor for searching this spectrum file with nmappers mappers
+def chooseMapperMultiplier(spectrumPath, nmappers, candidateCount=None) :
+    estimate = estimateSearchCost(spectrumPath, candidateCount)
+    if (None == estimate) :
+        mrh.info( "can't estimate search cost of %s, using mapper multiplier %d" % (spectrumPath, DEFAULT_MAPPER_MULTIPLIER) )
+        return DEFAULT_MAPPER_MULTIPLIER
+    (nspectra, cost) = estimate
+    rate = getSecondsPerCostUnit()
+    if (None == rate) : # no experience yet
+        mult = DEFAULT_MAPPER_MULTIPLIER
+    else :
+        mult = int(math.ceil((rate*cost)/(nmappers*getTargetTaskSeconds())))
+    mult = min(mult, getMaxMapperMultiplier(), nspectra/(nmappers*getMinSpectraPerTask()))
+    mult = max(1, mult)
+    if (None == rate) :
+        mrh.info( "%d spectra in %s, no measured search rate yet - mapper multiplier %d" % (nspectra, spectrumPath, mult) )
+    else :
+        mrh.info( "%d spectra in %s, estimated %.0f mapper seconds - mapper multiplier %d" % (nspectra, spectrumPath, rate*cost, mult) )
+    return mult
+
+#
+# mapper input lines are "n m": take the nth of every m spectra
+#
+sliceLine = re.compile(r"^\s*(\d+)\s+(\d+)\s*$")
+
+# a slice line cut in two: every other one of its spectra each, or None if it isn't a slice line
+def splitSliceLine(line) :
+    match = sliceLine.match(line)
+    if (None == match) :
+        return None
+    (n, m) = (int(match.group(1)), int(match.group(2)))
+    return ('%5d %5d' % (n, 2*m), '%5d %5d' % (n+m, 2*m))
+
+# log a summary of how long the mapper tasks of a step took
+def summarizeTaskRuntimes(step, runtimes) :
+    if (not len(runtimes)) :
+        return
+    seconds = sorted([t for (label, t) in runtimes])
+    median = seconds[len(seconds)/2]
+    mrh.log( "step %d: %d mapper tasks, runtime min %.1fs median %.1fs max %.1fs, total %.1fs (max/median %.2f)" %
+             (step, len(seconds), seconds[0], median, seconds[-1], sum(seconds), seconds[-1]/max(median,0.001)) )
+    slowest = sorted(runtimes, key=lambda r: -r[1])[:3]
+    mrh.info( "slowest tasks: " + ", ".join(["%s %.1fs" % (label.strip(), t) for (label, t) in slowest]) )
@@ -32,9 +32,19 @@ import shlex
 import tempfile
 import platform
 import simplejson as json
-from gzip import GzipFile
 import datetime
 import string
+import hashlib
+import base64
+import binascii
+import threading
+import Queue
+import multiprocessing
+import heapq
+import collections
+import zlib
+import struct
+import cStringIO
 from time import sleep
 
 import boto
@@ -45,6 +55,8 @@ from boto.ec2.regioninfo import RegionInfo
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 
+import hadoop_fs
+
 cfgCore={"mrh_launch_helper_version":"0.2"}
 cfgStack=[]
 currentCfgID=-1  # cfgstack member -1 is the core config
@@ -175,6 +187,28 @@ def runAWS() :
 
 
 
+# reorder MGF spectra for even mapper loads?  Note that spectrum ids in the results then
+# follow the new order, though titles are unchanged.  X!!Tandem doesn't split work that way.
+def balanceSpectra() :
+    return ("True" == getConfig( "balanceSpectra", "False" )) and not runBangBang()
+
+# build (or reuse) a mass sorted peptide index of each search database, see database_index.py
+def indexDatabases() :
+    return ("True" == getConfig( "databaseIndex", "False" ))
+
+# how many mapper tasks we expect the cluster to run, without settling numberOfClientNodes
+def getMapperCount() :
+    if (runBangBang() or runOldSkool()) :
+        return 1
+    if (runLocal()) :
+        return getLocalMapperCount()
+    if (runAWS()) :
+        nodecount = int(getConfig( "numberOfClientNodes","0" ))
+        if (0==nodecount) : # perhaps they specified mapper count instead
+            return int(getConfig("numberOfMappers","0")) or 8
+        return nodecount*int(getConfig("numberOfTasksPerClient"))
+    return int(getConfig( "numberOfMappers" ))
+
 # are we running in old-school (not, mapreduce, not mpi) mode?
 def runOldSkool() :
     value = getConfig( "oldSkool", "False" )
@@ -224,48 +258,277 @@ def info(obj) :
     if (verbose()) :
         log(obj)
 
-def runCommand(cmd, outputfilter=None) :
+def runCommand(cmd, outputfilter=None, logFile=None, lineCallback=None) :
     debug(cmd)
     args = cmd.split()
     debug(args)
-    return runPipeCommand(args, outputfilter)
+    return runPipeCommand(args, outputfilter, logFile, lineCallback)
 
-def runPipeCommand(args, outputfilter=None) :
+# run a command, streaming its output: lines matching outputfilter are logged as they come,
+# all of it goes to logFile if given, each line is handed to lineCallback if given, and only
+# the last keepLines lines are held on to, for the error report if the command fails
+def runPipeCommand(args, outputfilter=None, logFile=None, lineCallback=None, keepLines=200) :
     chatty = getDebug() 
     if (chatty) :
         log( args )
-    starttime = datetime.datetime.utcnow()
     p = subprocess.Popen(args,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-    result = ""
-    while True:
-        line = p.stdout.readline()
-        if (line != None) :
-            line = line.rstrip()
-            if (line != "") :
-                if (chatty or (outputfilter and re.search(outputfilter,line))) :
-                    log(line)
-                if (result != "") :
-                    result = result + "\n" + line
-                else :
-                    result = line
-        if (None != p.poll()) :
-            break
+    tail = collections.deque(maxlen=keepLines)
+    nlines = 0
+    tee = None
+    if (logFile) :
+        tee = open(logFile,"ab")
+    for line in iter(p.stdout.readline, "") : # blocks until there's a line, no need to poll
+        if (tee) :
+            tee.write(line)
+        line = line.rstrip()
+        if (line != "") :
+            if (chatty or (outputfilter and re.search(outputfilter,line))) :
+                log(line)
+            if (lineCallback) :
+                lineCallback(line)
+            tail.append(line)
+            nlines += 1
         # show some life on long commands - print a dot once in a while
         if (not chatty) :
             log_progress()
+    p.stdout.close()
+    ret = p.wait()
+    if (tee) :
+        tee.close()
 
-    ret = p.returncode
     if (ret != 0):
         log("problem running command:")
         if (not chatty) : # have we already shown what's being attempted?
             log(args)
-            if (len(result)>0) :
-                log( result )
+            if (nlines > len(tail)) :
+                log( "(last %d of %d lines of output%s)" % (len(tail), nlines, (logFile and (", all in "+logFile)) or "") )
+            if (len(tail)>0) :
+                log( "\n".join(tail) )
             log("return code %d" % ret )
     else :
         debug( "return code %d" % ret )
     return ret
 
+#
+# local mapreduce: run several mapper processes at once over the input lines, shuffle their
+# output by key, and stream that into a single reducer - so a multicore workstation gets
+# used without hadoop
+#
+def getLocalMapperCount() :
+    if (runOldSkool()) :
+        return 1
+    return max(1,int(getConfig("localMappers",str(multiprocessing.cpu_count()))))
+
+# should local mode run halves of straggling mapper tasks alongside them?
+def resplitStragglers() :
+    return ("True" == getConfig("resplitStragglers","False"))
+
+# hadoop streaming's notion of a record's key: everything up to the first tab
+def recordKey(line) :
+    return line.split("\t",1)[0]
+
+# how much of a run to sort in memory at once
+def getLocalSortBytes() :
+    return int(getConfig("localSortBytes",str(64*1024*1024)))
+
+# sort a run of records in place, bytewise like hadoop's shuffle rather than locale-aware like sort(1).
+# Like sort(1) this only holds so much in memory: the run is cut into chunks of about
+# localSortBytes, each sorted and spilled to a temp file, and the chunks merged back into the run
+def sortRun(run) :
+    limit = getLocalSortBytes()
+    run.seek(0)
+    chunks = []
+    lines = []
+    size = 0
+    for line in run :
+        line = line.rstrip("\r\n")
+        lines.append(line+"\n")
+        size += len(line)+1
+        if (size >= limit) :
+            lines.sort()
+            chunk = tempfile.TemporaryFile()
+            chunk.writelines(lines)
+            chunk.seek(0)
+            chunks.append(chunk)
+            lines = []
+            size = 0
+    lines.sort()
+    run.seek(0)
+    run.truncate()
+    if (not len(chunks)) :
+        run.writelines(lines)
+    else :
+        for line in heapq.merge(iter(lines), *chunks) :
+            run.write(line)
+        for chunk in chunks :
+            chunk.close()
+    run.seek(0)
+
+# number of distinct keys in a set of runs, not bothering to count past limit
+def countKeys(runs, limit=2) :
+    keys = set()
+    for run in runs :
+        run.seek(0)
+        for line in run :
+            keys.add(recordKey(line.rstrip("\r\n")))
+            if (len(keys) >= limit) :
+                return len(keys)
+    return len(keys)
+
+# pass mapper output runs to write() grouped by key: with a single key there is nothing to
+# sort, so records just stream through - otherwise they are hash partitioned by key, each
+# (much smaller) partition is sorted on its own, within localSortBytes of memory, and the
+# partitions merged back in key order
+def shuffleRuns(runs, write, nkeys=None) :
+    if (None == nkeys) :
+        nkeys = countKeys(runs)
+    for run in runs :
+        run.seek(0)
+    if (nkeys <= 1) :
+        for run in runs :
+            for line in run :
+                write(line.rstrip("\r\n")+"\n")
+        return
+    parts = [tempfile.TemporaryFile() for run in runs]
+    for run in runs :
+        for line in run :
+            line = line.rstrip("\r\n")
+            parts[hash(recordKey(line)) % len(parts)].write(line+"\n")
+    for part in parts :
+        sortRun(part)
+    for line in heapq.merge(*parts) :
+        write(line)
+    for part in parts :
+        part.close()
+
+def getStragglerFactor() :
+    return float(getConfig("stragglerFactor","2.0"))
+
+# one mapper process on some input lines, its output going to a temp file
+class LocalMapperTask :
+    def __init__(self, mapper, lines, label, original=None) :
+        self.lines = lines
+        self.label = label
+        self.original = original # for the halves of a re-split task
+        self.halves = []
+        self.resplit = False # have we tried running this one's halves alongside it?
+        self.run = tempfile.TemporaryFile()
+        self.start = datetime.datetime.utcnow()
+        self.proc = subprocess.Popen(mapper.split(),stdin=subprocess.PIPE,stdout=self.run)
+        self.proc.stdin.write("\n".join(lines))
+        self.proc.stdin.close() # output goes to a file so nothing blocks
+        self.seconds = None
+
+    def elapsed(self) :
+        delta = datetime.datetime.utcnow() - self.start
+        return delta.seconds + (delta.microseconds/1000000.0) + (delta.days*86400)
+
+    def kill(self) :
+        if (None == self.proc.poll()) :
+            self.proc.kill()
+            self.proc.wait()
+        self.run.close()
+
+# each line of input is a mapper task, with up to nprocs of them running at once and the next
+# one starting as soon as a process finishes.  If splitTask is given (a function that cuts
+# an input line in two, or returns None if it can't) then once there's nothing left to start,
+# a task running longer than stragglerFactor times the median gets its halves run alongside
+# it (when both fit within nprocs), and whichever finishes first - the original, or both
+# halves - is used.  A half that fails just loses the race, leaving the original to finish
+# the work.  Task runtimes are appended to runtimes as (input line, seconds) if it's given.
+# nkeys is the number of distinct mapper output keys, if known - otherwise we go look
+def runLocalMapReduce(mapper, reducer, inputFile, outputFile, nprocs, nkeys=None, runtimes=None, splitTask=None) :
+    f = open(inputFile,"rb")
+    pending = [line for line in f.read().split("\n") if (line.strip() != "")]
+    f.close()
+    debug( "running %d local mapper tasks, %d at a time: %s" % (len(pending), nprocs, mapper) )
+    lines = list(pending)
+    pending.reverse() # so pop() takes them in order
+    running = []
+    done = {} # input line -> list of finished tasks whose output stands for it
+    finished = [] # runtimes of finished tasks, for spotting stragglers
+    failed = 0
+    while (len(pending) or len(running)) and (0 == failed) :
+        while (len(pending) and (len(running) < nprocs)) :
+            line = pending.pop()
+            running.append(LocalMapperTask(mapper, [line], line))
+        for task in list(running) :
+            if (not task in running) : # killed as we went
+                continue
+            ret = task.proc.poll()
+            if (None == ret) :
+                continue
+            running.remove(task)
+            task.seconds = task.elapsed()
+            if ((ret != 0) and (None != task.original)) : # speculation lost, the original carries on
+                info( "re-split half %s of task %s failed (return code %d), waiting on the original" % (task.label.strip(), task.original.label.strip(), ret) )
+                for half in task.original.halves :
+                    if (half in running) :
+                        running.remove(half)
+                    half.kill()
+                task.original.halves = []
+                continue
+            if (ret != 0) :
+                log( "problem running command:" )
+                log( mapper.split() )
+                log( "return code %d" % ret )
+                failed = ret
+                break
+            finished.append(task.seconds)
+            original = task.original or task
+            if (original.label in done) : # the other way of doing this one already won
+                task.run.close()
+                continue
+            if (task == original) :
+                for half in task.halves : # speculation lost
+                    if (half in running) :
+                        running.remove(half)
+                    half.kill()
+                done[task.label] = [task]
+            elif (not [h for h in original.halves if (None == h.seconds)]) : # both halves are in
+                info( "re-split task %s beat the original" % original.label.strip() )
+                running.remove(original)
+                original.kill()
+                done[original.label] = original.halves
+        if ((None != splitTask) and (0 == failed) and (not len(pending)) and (len(running)+2 <= nprocs) and len(finished)) :
+            limit = getStragglerFactor()*sorted(finished)[len(finished)/2]
+            for task in list(running) :
+                if ((None == task.original) and (not task.resplit) and (task.elapsed() > limit) and (len(running)+2 <= nprocs)) : # room for both halves
+                    halves = splitTask(task.label)
+                    task.resplit = True
+                    if (None != halves) :
+                        info( "task %s has run %.0fs, splitting it as %s and %s" % (task.label.strip(), task.elapsed(), halves[0].strip(), halves[1].strip()) )
+                        for half in halves :
+                            task.halves.append(LocalMapperTask(mapper, [half], half, task))
+                        running.extend(task.halves)
+        sleep(0.1)
+    for task in running :
+        task.kill()
+    if (failed != 0) :
+        return failed
+    runs = []
+    for line in lines :
+        for task in done[line] :
+            runs.append(task.run)
+            if (None != runtimes) :
+                runtimes.append((task.label, task.seconds))
+    out = open(outputFile,"wb")
+    p = subprocess.Popen(reducer.split(),stdin=subprocess.PIPE,stdout=out)
+    def feed(line) :
+        p.stdin.write(line)
+        log_progress()
+    shuffleRuns(runs, feed, nkeys)
+    p.stdin.close()
+    ret = p.wait()
+    out.close()
+    for run in runs :
+        run.close()
+    if (ret != 0) :
+        log( "problem running command:" )
+        log( reducer.split() )
+        log( "return code %d" % ret )
+    return ret
+
 
 # routine to retrieve config, with error checking
 def loadConfig() :
@@ -390,6 +653,39 @@ def getHadoopHome() :
 def getHadoopBinary() :
     return getHadoopHome()+"/bin/hadoop"
 
+# file transfers to and from the hadoop cluster go over WebHDFS when the namenode offers it
+# and its datanodes are reachable from here, instead of starting a hadoop JVM for each
+# operation - hadoopFileSystem can be "webhdfs", "cli" (the hadoop command line, as before),
+# or "auto" to try WebHDFS first
+hadoopFS = None
+def getHadoopFS() :
+    global hadoopFS
+    if (None == hadoopFS) :
+        choice = getConfig("hadoopFileSystem","auto")
+        address = getConfig("webhdfs_address","")
+        if ("" == address) : # namenode's web port, if hadoop_dir names the namenode
+            authority = getHadoopDir().replace("hdfs://","").split("/")[0]
+            if (":" in authority) :
+                address = authority.split(":")[0]+":50070"
+        if (("cli" != choice) and ("" != address)) :
+            fs = hadoop_fs.WebHDFSFileSystem(address, getConfig("hadoop_user","") or None)
+            if (("webhdfs" == choice) or (fs.ping() and fs.probe(hadoop_fs.hdfsPath(getHadoopDir())))) :
+                hadoopFS = fs
+            else :
+                info( "WebHDFS at %s not usable from here, using hadoop command line for file transfers" % address )
+        if (None == hadoopFS) :
+            hadoopFS = hadoop_fs.HadoopCLIFileSystem(getHadoopBinary())
+        debug( "using %s for hadoop file transfers" % hadoopFS.name )
+    return hadoopFS
+
+# existence and size of files on the hadoop cluster, from one listing per directory per launch
+hadoopStatCache = None
+def getHadoopStatCache() :
+    global hadoopStatCache
+    if (None == hadoopStatCache) :
+        hadoopStatCache = hadoop_fs.StatCache(getHadoopFS())
+    return hadoopStatCache
+
 def testHadoopConnection() :
      if ( runHadoop() ):
         info("testing Hadoop setup")
@@ -400,8 +696,8 @@ def testHadoopConnection() :
             exit(1)         
         hadoopOK = False
         try:
-            args = [getHadoopBinary(),"dfs","-test","-d","hdfs://%s"%getHadoopDir()]
-            hadoopOK = (0==runPipeCommand( args ))
+            status = getHadoopFS().stat("hdfs://%s"%getHadoopDir())
+            hadoopOK = ((None != status) and status.isDir)
         except Exception, exception:
             log( exception )
             
@@ -580,18 +876,50 @@ def setSharedDir() :
     else :
         setConfig("sharedDir",getConfig("hadoop_dir")) # provoke an error if this isn't specified for hadoop cluster
 
-# helps prepare a list of copy commands to be passed out to mappers
-def constructHadoopCacheFileCopyCommand(cfgKey) :
+# the md5 (or for a multipart upload, the etag) and size of an S3 object, as we'd expect to
+# find them for an up to date HDFS copy of it
+def getS3FileIdentity(key) :
+    if (None == key) :
+        return ("", 0)
+    return (key.etag.strip('"'), key.size)
+
+# the same for a file uploadFile() put in S3 (or found already there) - from the upload
+# manifest if it has them, else from S3.  after finishUploadBatch(), so the upload has happened
+def getUploadedFileIdentity(s3Name) :
+    entry = loadUploadManifest().get(uploadManifestKey(bucketName, s3Name), {})
+    if (entry.get("etag") and (None != entry.get("remoteSize"))) :
+        return (entry["etag"], entry["remoteSize"])
+    return getS3FileIdentity(s3bucket.get_key(s3Name))
+
+# helps prepare a list of copy commands to be passed out to mappers - the copy is skipped if
+# HDFS already has a file of the right size, with a .md5 sidecar matching the S3 object,
+# whose md5 (or etag) and size are given
+def constructHadoopCacheFileCopyCommand(s3Name, md5, size) :
     if ( runBangBang() ) :
         copierCommand = ""
         log( "shouldn't be here..." )
     else :
-        hdfsname = HadoopCacheFileName(getConfig(cfgKey))
+        hdfsname = HadoopCacheFileName(s3Name)
         hadoopCopyCmd = "hadoop dfs -cp "
-        copierCommand = '%s s3n://%s/%s %s\n' % ( hadoopCopyCmd, bucketName, getConfig(cfgKey), hdfsname )
-        setConfig(cfgKey,hdfsname) # side effect - transform filename in config for use on cluster
+        copierCommand = '%s s3n://%s/%s %s' % ( hadoopCopyCmd, bucketName, s3Name, hdfsname )
+        if ("" != md5) :
+            check = '[ "$(hadoop dfs -cat %s.md5 2>/dev/null)" = "%s" ] && [ "$(hadoop dfs -stat %%b %s 2>/dev/null)" = "%d" ]' % (hdfsname, md5, hdfsname, size)
+            copy = 'hadoop dfs -rm %s ; hadoop dfs -rm %s.md5 ; %s && echo %s | hadoop dfs -put - %s.md5' % (hdfsname, hdfsname, copierCommand, md5, hdfsname)
+            copierCommand = 'if %s ; then echo %s is up to date ; else %s ; fi' % (check, hdfsname, copy)
+        copierCommand = copierCommand + "\n"
     return copierCommand
 
+# group the copier step's copy commands, given as (bytes to copy, command), into at most nlines
+# lines of about equal total size, biggest files first - each line gets a mapper of its own, and
+# fails if any of its copies does
+def balanceCopyCommands(commands, nlines) :
+    lines = [[0, []] for n in range(max(1,min(nlines, len(commands))))]
+    for (size, cmd) in sorted(commands, key=lambda c: -c[0]) :
+        lightest = min(lines, key=lambda l: l[0])
+        lightest[0] += size
+        lightest[1].append(cmd.strip())
+    return "".join([" && ".join(l[1])+"\n" for l in lines if len(l[1])])
+
 # make string both S3 and URL compatible
 def S3CompatibleString( instr , isBucketName=False) :
     if ( runLocal() ) :
@@ -695,13 +1023,18 @@ def getHadoopWorkDir() :
 
 def createRemoteDir(dirname) :
     if (runHadoop()) :
-        args = [getHadoopBinary(),"fs","-mkdir",dirname]
-        runPipeCommand( args )
+        try :
+            getHadoopFS().mkdir(dirname)
+        except Exception, exception:
+            log( exception )
 
 def removeRemoteFile(filename) :
     if (runHadoop()) :
-        args = [getHadoopBinary(),"fs","-rm",filename]
-        runPipeCommand( args )
+        try :
+            getHadoopStatCache().forget(filename)
+            getHadoopFS().rm(filename)
+        except Exception, exception:
+            log( exception )
 
 
 # make name suitable for hadoop cachefile mechanism - convert path to a long string
@@ -714,6 +1047,101 @@ def HadoopCacheFileName( name ) :
         return "hdfs://"+getHadoopDir()+"/"+name
 
 # gzip a file if it needs it
+#
+# block-parallel gzip, pigz style: the input is cut into fixed size blocks which are deflated
+# independently on a pool of threads (zlib lets go of the interpreter lock while it works),
+# then written out in order as a single gzip member that any gunzip can read
+#
+def getGZipThreadCount() :
+    return max(1,int(getConfig("gzipThreads",str(multiprocessing.cpu_count()))))
+
+def getGZipBlockSize() :
+    return max(32,int(getConfig("gzipBlockSizeKB","1024")))*1024
+
+def getGZipLevel() :
+    return int(getConfig("gzipLevel","6"))
+
+# keep a .gz copy next to the original?  If not, it gets compressed on the fly as it's uploaded.
+# local runs read the .gz directly, so they always keep it
+def keepGZipCopies() :
+    return runLocal() or ("True" == getConfig("keepGZipCopies","True"))
+
+# write a gzipped copy of sourcePath to out, which need only have a write() method
+def gzipStream(sourcePath, out) :
+    nthreads = getGZipThreadCount()
+    blockSize = getGZipBlockSize()
+    level = getGZipLevel()
+    jobs = Queue.Queue()
+    done = {} # block number -> deflated block (or the exception that stopped it)
+    ready = threading.Condition()
+    def worker() :
+        while True :
+            (n, block) = jobs.get()
+            if (None == block) :
+                return
+            try :
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS) # raw deflate, we write the header
+                result = compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH) # byte aligned, so blocks concatenate
+            except Exception, exception :
+                result = exception
+            ready.acquire()
+            done[n] = result
+            ready.notify()
+            ready.release()
+    def writeBlock(n) :
+        ready.acquire()
+        while (not n in done) :
+            ready.wait(1)
+        result = done.pop(n)
+        ready.release()
+        if (isinstance(result, Exception)) :
+            raise result
+        out.write(result)
+
+    threads = []
+    for n in range(nthreads) :
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    src = open(sourcePath,"rb")
+    try :
+        # gzip header, stamped with the source mtime rather than the time now so output is repeatable
+        out.write("\037\213\010\000"+struct.pack("<I",int(os.path.getmtime(sourcePath)))+"\000\377")
+        crc = zlib.crc32("")
+        size = 0
+        nRead = 0
+        nWritten = 0
+        while True :
+            block = src.read(blockSize)
+            if (not block) :
+                break
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            jobs.put((nRead, block))
+            nRead += 1
+            while (nRead - nWritten >= 2*nthreads) : # don't let the reader get too far ahead
+                writeBlock(nWritten)
+                nWritten += 1
+        while (nWritten < nRead) :
+            writeBlock(nWritten)
+            nWritten += 1
+    finally :
+        src.close()
+        for t in threads :
+            jobs.put((0, None))
+        for t in threads :
+            t.join()
+    out.write(zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH)) # empty last block
+    out.write(struct.pack("<II", crc & 0xffffffffL, size & 0xffffffffL))
+
+# if localPath is a .gz that attemptGZip() decided not to keep on disk, returns the
+# uncompressed original that gets compressed as it's uploaded, else None
+def gzipStreamSource(localPath) :
+    if (localPath.endswith(".gz") and (not os.path.exists(localPath)) and os.path.exists(localPath[:-3])) :
+        return localPath[:-3]
+    return None
+
 def attemptGZip( inputPath ) :
     localPath = inputPath
     if (  not localPath.endswith(".gz") ) :
@@ -721,17 +1149,23 @@ def attemptGZip( inputPath ) :
         oldPath = localPath
         localPath = localPath+".gz"
         if (not os.path.exists(localPath)) :
+            if (not os.path.exists(oldPath)) :
+                return oldPath # let the caller complain about it
+            if (not keepGZipCopies()) :
+                info( oldPath+" will be gzipped on the fly as it's uploaded, not keeping a local copy" )
+                return localPath
             info( "creating gzipped copy of "+oldPath+" as "+localPath+" for transfer to S3" )
+            tmpPath = localPath+".tmp"
             try:
-                file = open(oldPath,"rb")
-                zipper = GzipFile(localPath,"wb")
-                for line in file :
-                    zipper.write(line)
+                zipper = open(tmpPath,"wb")
+                gzipStream(oldPath,zipper)
                 zipper.close()
-                file.close()
+                os.rename(tmpPath,localPath) # so an interrupted run can't leave a truncated .gz to be trusted later
             except Exception, exception:
                 log( exception )
                 log( "Failed to create gzipped copy of %s, using original.  This will work but is less efficient" % oldPath)
+                if (os.path.exists(tmpPath)) :
+                    os.unlink(tmpPath)
                 localPath = oldPath
         else :
             info( "based on filename, "+localPath+" appears to be gzipped copy of "+oldPath+" so we'll use that" )
@@ -739,30 +1173,30 @@ def attemptGZip( inputPath ) :
 
 # put a file to the target system via the SOCKS proxy
 def copyFileToHDFS(local_filename,target_filename,filemode="") :
-    ret = -7777 # magic number used below 
     try:
         local_filename = decygwinify(local_filename) # for windows, remove cygwin hoo-hah if any
         if (not target_filename.startswith(getHadoopDir())) :
             target_filename = getHadoopDir()+"/"+target_filename
-        args = [getHadoopBinary(),"fs","-put",local_filename,target_filename]
-        
-        if (0 != runPipeCommand( args )) :
-            if (not getDebug()) :
-                log( args )
-            log("problem with hadoop fs -put (have you configured core-site.xml and mapred-site.xml?)")
-            explain_hadoop()
-            exit(ret)
+        getHadoopStatCache().forget(target_filename)
+        getHadoopFS().put(local_filename,target_filename)
         if ( "" != filemode ) :
-            args = [getHadoopBinary(),"dfs","-chmod",filemode,target_filename]
-            runPipeCommand( args ) 
+            getHadoopFS().chmod(filemode,target_filename)
             
     except Exception, exception:
-        if (-7777 == ret) : # process never got started
-            log("unable to invoke local copy of hadoop for file transfer purposes")
         log( exception )
+        log("problem copying %s to hadoop (have you configured core-site.xml and mapred-site.xml?)" % local_filename)
         explain_hadoop()
         exit(1)
 
+# put whatever writeContents(fp) writes to a file on the target system via the SOCKS proxy
+def copyStreamToHDFS(writeContents,target_filename,filemode="") :
+    if (not target_filename.startswith(getHadoopDir())) :
+        target_filename = getHadoopDir()+"/"+target_filename
+    getHadoopStatCache().forget(target_filename)
+    getHadoopFS().putStream(writeContents,target_filename)
+    if ( "" != filemode ) :
+        getHadoopFS().chmod(filemode,target_filename)
+
 # run a hadoop job via the proxy (that is, on a generic Hadoop cluster, not AWS EMR)
 def doHadoopStep(workstep) :
     if ( None != workstep ) :
@@ -772,7 +1206,67 @@ def doHadoopStep(workstep) :
         args = [getHadoopBinary(),"jar",hadoopStreamingJar]
         args.extend(workstep.args())
         log("running Hadoop step %s" % workstep.name)
-        runPipeCommand(args, "Running job|StreamJob:  map|Job complete") # show output lines with "Running job:" in them
+        return runPipeCommand(args, "Running job|StreamJob:  map|Job complete") # show output lines with "Running job:" in them
+    return 0
+
+# how many hadoop steps of independent searches we let run on the cluster at once
+def getConcurrentSteps() :
+    return max(1,int(getConfig("concurrentSteps","2")))
+
+# without refinement, run the condition and process steps as a single hadoop step: mapper1 is
+# spread across the mappers as usual, and the one reduce task runs reducer1, then mapper2 on
+# its output (fusedProcessTasks copies at once), then reducer2 - saving a job startup and shuffle
+def fuseSteps() :
+    return ("True" == getConfig("fuseSteps","False"))
+
+def getFusedProcessTasks() :
+    return max(1,int(getConfig("fusedProcessTasks",getConfig("numberOfTasksPerClient","2"))))
+
+# run a graph of steps, each given as (name, names of steps it depends on, function returning
+# 0 on success), with up to capacity of them going at once.  onDone(name) is called from this
+# (the calling) thread as each step succeeds, so it's free to selectConfig() and the like.
+# Steps depending on a failed step are skipped.  Returns the names of steps that didn't succeed.
+def runStepGraph(steps, capacity, onDone=None) :
+    pending = list(steps)
+    succeeded = set()
+    failed = set()
+    completions = Queue.Queue()
+    def runStep(name, function) :
+        try :
+            ret = function()
+        except Exception, exception :
+            log( exception )
+            ret = -1
+        completions.put((name, ret))
+    nrunning = 0
+    while (len(pending) or nrunning) :
+        for step in list(pending) :
+            (name, deps, function) = step
+            if ([d for d in deps if (d in failed)]) :
+                log( "skipping step %s, a step it depends on failed" % name )
+                pending.remove(step)
+                failed.add(name)
+            elif ((nrunning < capacity) and not [d for d in deps if not (d in succeeded)]) :
+                pending.remove(step)
+                t = threading.Thread(target=runStep, args=(name, function))
+                t.setDaemon(True)
+                t.start()
+                nrunning += 1
+        if (not nrunning) :
+            for (name, deps, function) in pending : # waiting on steps that will never run
+                log( "skipping step %s, its dependencies can't be met" % name )
+                failed.add(name)
+            break
+        (name, ret) = completions.get()
+        nrunning -= 1
+        if (0 == ret) :
+            succeeded.add(name)
+            if (None != onDone) :
+                onDone(name)
+        else :
+            log( "step %s failed, return code %d" % (name, ret) )
+            failed.add(name)
+    return failed
 
 # put a file to the target system (S3 or hadoop cluster)
 def set_contents_from_string(target_filename, contents) :
@@ -811,8 +1305,7 @@ def copyFileFromHDFS(remoteName, localName) :
                 log("overwriting existing file named "+localName)
                 os.unlink(my_abspath(localName))
             localName = decygwinify(localName)
-            args = [getHadoopBinary(),"fs","-copyToLocal",remoteName,localName]
-            runPipeCommand( args )
+            getHadoopFS().get(remoteName,localName)
         except Exception, exception:
             log( exception )
             log("failed saving "+remoteName+" to " + localName)
@@ -834,19 +1327,151 @@ def get_contents_as_string(target_filename) :
         os.unlink(tmpfnm)
         return linestring
 
-# read a file from S3 or hadoop cluster into a local file
-def get_contents_to_filename(target_filename, local_filename) :
+# passes a download on to a consumer (anything with a write method) exactly once, in order,
+# however many attempts and resumptions it takes to get the whole file.  if the consumer
+# won't take any more, or has been given bytes that turn out to be bad, it gets nothing
+# further - the download carries on regardless, and complete() says whether it got it all
+class DownloadConsumer :
+    def __init__(self, consumer) :
+        self.consumer = consumer
+        self.delivered = 0
+        self.failure = None # why we stopped feeding it, if we did
+
+    def feed(self, position, data) :
+        if (None != self.failure) :
+            return
+        skip = self.delivered - position
+        if (skip < len(data)) :
+            try :
+                self.consumer.write(data[max(0,skip):])
+            except (IOError, OSError, ValueError), exception : # eg EPIPE, it exited early
+                self.abort(str(exception))
+                return
+            self.delivered = position+len(data)
+
+    def abort(self, reason) :
+        if (None == self.failure) :
+            log( "no longer passing download on as it arrives: %s" % reason )
+            self.failure = reason
+
+    # the download is starting over, so what it's had so far (if anything) was no good
+    def discard(self, reason) :
+        if (self.delivered > 0) :
+            self.abort(reason)
+
+    # did it get exactly the whole of a download of this size, with nothing bad along the way?
+    def complete(self, size) :
+        return (None == self.failure) and (self.delivered == size)
+
+# where a download goes: the local file, its running md5, and any DownloadConsumer
+class DownloadSink :
+    def __init__(self, out, consumer=None) :
+        self.out = out
+        self.consumer = consumer
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    # data we already have, from an earlier attempt
+    def account(self, data) :
+        self.md5.update(data)
+        if (None != self.consumer) :
+            self.consumer.feed(self.size, data)
+        self.size += len(data)
+
+    def write(self, data) :
+        self.out.write(data)
+        self.account(data)
+
+# fetch a remote file to localPath by way of localPath.part, picking up where any earlier
+# attempt left off (S3 range request, or WebHDFS offset read), and checking size and md5
+# against the remote copy before putting it in place - raises an exception on failure.
+# localPath.part.id names the remote file the .part came from, so that we only ever resume
+# a download of the very same remote file
+def downloadRemoteFile(target_filename, local_filename, consumer=None) :
+    partPath = local_filename+".part"
+    identityPath = partPath+".id"
+    if (runAWS()) :
+        key = s3handle.bucket.get_key(target_filename)
+        if (None == key) :
+            raise Exception("no file %s on S3" % target_filename)
+        remoteSize = key.size
+        remoteMD5 = key.etag.replace('"','')
+        remoteIdentity = "s3://%s/%s %d %s" % (bucketName, target_filename, remoteSize, remoteMD5)
+    else :
+        status = getHadoopFS().stat(target_filename)
+        if (None == status) :
+            raise Exception("no file %s on hadoop" % target_filename)
+        remoteSize = status.size
+        remoteMD5 = None # hadoop checksums are crc based, size and modification time will have to do
+        remoteIdentity = "%s %d %s" % (hadoop_fs.hdfsPath(target_filename), remoteSize, status.mtime)
+    if (os.path.exists(partPath)) :
+        try :
+            f = open(identityPath,"r")
+            partIdentity = f.read().strip()
+            f.close()
+        except Exception :
+            partIdentity = None
+        if ((partIdentity != remoteIdentity) or (os.path.getsize(partPath) > remoteSize)) :
+            os.unlink(partPath) # not from this version of the file
+            if (None != consumer) :
+                consumer.discard("%s changed during download" % target_filename)
+    f = open(identityPath,"w")
+    f.write(remoteIdentity+"\n")
+    f.close()
+    out = open(partPath,"ab")
+    sink = DownloadSink(out, consumer)
+    # the md5 has to cover what we got last time
+    f = open(partPath,"rb")
+    for block in iter(lambda: f.read(1024*1024), "") :
+        sink.account(block)
+    f.close()
+    if (sink.size > 0) :
+        info( "resuming download of %s at byte %d of %d" % (target_filename, sink.size, remoteSize) )
+    try :
+        if (sink.size < remoteSize) :
+            if (runAWS()) :
+                key.open_read(headers={"Range":"bytes=%d-" % sink.size})
+                try :
+                    for block in iter(lambda: key.read(1024*1024), "") :
+                        sink.write(block)
+                finally :
+                    key.close()
+            else :
+                getHadoopFS().getStream(target_filename, sink, sink.size)
+    finally :
+        out.close()
+    if (sink.size != remoteSize) :
+        raise Exception("download of %s stopped at %d of %d bytes" % (target_filename, sink.size, remoteSize))
+    if (None != remoteMD5) :
+        if ("-" in remoteMD5) : # multipart upload, try the part sizes it could have used
+            check = MultipartDigestSink(multipartPartSizes(remoteSize, int(remoteMD5.split("-")[1]), getRecordedPartSize(bucketName, target_filename)))
+            f = open(partPath,"rb")
+            for block in iter(lambda: f.read(1024*1024), "") :
+                check.write(block)
+            f.close()
+            if (None == check.partSizeFor(remoteMD5)) :
+                log( "warning: could not verify multipart checksum of "+target_filename )
+        elif (sink.md5.hexdigest() != remoteMD5) :
+            os.unlink(partPath) # start over next time
+            if (None != consumer) : # it's had the bad bytes already
+                consumer.discard("checksum mismatch downloading %s" % target_filename)
+            raise Exception("checksum mismatch downloading %s" % target_filename)
+    if (os.path.exists(local_filename)) :
+        os.unlink(local_filename)
+    os.rename(partPath, local_filename)
+    os.unlink(identityPath)
+
+# read a file from S3 or hadoop cluster into a local file, retrying (and resuming) as needed,
+# passing it to any DownloadConsumer as it arrives - returns True on success
+def get_contents_to_filename(target_filename, local_filename, consumer=None) :
     max_retry = 3
     for retry in range(max_retry+1) :
+        exception = "empty file"
         try:       
-            if (runAWS()) :
-                s3handle.key = target_filename
-                s3handle.get_contents_to_filename(local_filename)
-            else :
-                copyFileFromHDFS(target_filename,local_filename)
+            downloadRemoteFile(target_filename, local_filename, consumer)
             debug("copy %s to %s %d bytes" %(target_filename,local_filename,os.path.getsize(local_filename)))
             if (os.path.getsize(local_filename) > 0) :
-                break
+                return True
         except Exception, exception:
             pass
         if (max_retry == retry) :
@@ -854,12 +1479,470 @@ def get_contents_to_filename(target_filename, local_filename) :
             log("failed saving remote file "+target_filename+" to " + local_filename)
         else :
             sleep(10)
+    return False
+
+# fetch the final tandem report - if reportPostProcessor is set, that shell command gets the
+# report on its stdin as it downloads ("{report}" in the command is replaced with the local
+# report path), so eg conversion to pepXML overlaps the transfer
+def get_report_to_filename(target_filename, local_filename) :
+    cmd = getConfig("reportPostProcessor","")
+    if ("" == cmd) :
+        return get_contents_to_filename(target_filename, local_filename)
+    cmd = cmd.replace("{report}", local_filename)
+    info( "post processing report with: "+cmd )
+    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+    consumer = DownloadConsumer(p.stdin)
+    try :
+        ok = get_contents_to_filename(target_filename, local_filename, consumer)
+    finally :
+        try :
+            p.stdin.close()
+        except (IOError, OSError) :
+            pass
+    ret = p.wait()
+    if (not ok) :
+        log( "report post processor %s did not get the whole report, as it did not download" % cmd )
+        return
+    if (not consumer.complete(os.path.getsize(local_filename))) : # give it another go, from the saved report
+        log( "report post processor %s did not get the whole report as it downloaded, running it again on %s" % (cmd, local_filename) )
+        f = open(local_filename,"rb")
+        ret = subprocess.call(cmd, shell=True, stdin=f)
+        f.close()
+    if (ret != 0) :
+        log( "problem running report post processor %s, return code %d" % (cmd, ret) )
+
+# persistent record of what we've already uploaded, so repeat launches don't have to
+# re-read multi-GB databases to compute md5 sums.  entries are keyed by bucket or cluster and
+# remote name, and are only trusted if the local file's path, size, mtime and inode all still
+# match what we saw when we recorded it - and the remote copy is still there, which is one
+# HEAD request on S3, or one directory listing per launch on hadoop.
+# set "verifyUploads":"True" to ignore the manifest and do the full remote check.
+uploadManifest = None # loaded on first use
+
+def verifyUploads() :
+    return ("True" == getConfig( "verifyUploads", "False" ) )
+
+def getUploadManifestPath() :
+    return getConfig("uploadManifest",os.path.join(os.path.expanduser("~"),".mrtandem_upload_manifest.json"))
+
+def loadUploadManifest() :
+    global uploadManifest
+    if (None == uploadManifest) :
+        uploadManifest = {}
+        manifestPath = getUploadManifestPath()
+        if (os.path.exists(manifestPath)) :
+            try:
+                f = open(manifestPath,"r")
+                uploadManifest = json.load(f)
+                f.close()
+            except Exception, exception:
+                log( exception )
+                log( "upload manifest %s is unreadable, ignoring it" % manifestPath )
+                uploadManifest = {}
+    return uploadManifest
+
+def saveUploadManifest() :
+    manifestPath = getUploadManifestPath()
+    try:
+        tmpPath = manifestPath+".tmp"
+        f = open(tmpPath,"w")
+        json.dump(loadUploadManifest(),f,indent=1)
+        f.close()
+        if (os.path.exists(manifestPath) and ("Windows" == platform.system())) :
+            os.unlink(manifestPath) # no atomic replace on windows
+        os.rename(tmpPath,manifestPath)
+    except Exception, exception:
+        log( exception )
+        log( "failed to save upload manifest %s, next launch will recheck remote copies" % manifestPath )
+
+# the things we expect to change if a local file's content changes
+def localFileSignature(localPath) :
+    st = os.stat(localPath)
+    return {"path":localPath, "size":st.st_size, "mtime":int(st.st_mtime), "inode":st.st_ino}
+
+def sameLocalFile(entry, localPath) :
+    sig = localFileSignature(localPath)
+    for key,val in sig.iteritems() :
+        if (not key in entry) or (entry[key] != val) :
+            return False
+    return True
+
+# which bucket or cluster remoteStore is on - on hadoop it's just a path, so add the namenode
+# from hadoop_dir or webhdfs_address, or failing that the hadoop installation we talk to it with
+def remoteStoreIdentity(remoteStore) :
+    if (runAWS()) :
+        return "s3://"+remoteStore
+    if (runHadoop()) :
+        cluster = getHadoopDir().replace("hdfs://","").split("/")[0]
+        if (not ":" in cluster) :
+            cluster = getConfig("webhdfs_address","")
+        if ("" == cluster) :
+            return "hadoop at %s:%s" % (getConfig("hadoop_home",os.environ.get("HADOOP_HOME","")), hadoop_fs.hdfsPath(remoteStore))
+        return "hdfs://%s%s" % (cluster, hadoop_fs.hdfsPath(remoteStore))
+    return remoteStore
+
+def uploadManifestKey(remoteStore, remoteName) :
+    return "%s/%s" % (remoteStoreIdentity(remoteStore), remoteName)
+
+# returns the manifest entry for this local/remote pair if it's still good, else None
+def lookupUploadManifest(localPath, remoteStore, remoteName) :
+    if (verifyUploads()) :
+        return None
+    entry = loadUploadManifest().get(uploadManifestKey(remoteStore, remoteName))
+    if (None != entry) and sameLocalFile(entry, localPath) :
+        return entry
+    return None
+
+def noteUploadManifest(localPath, remoteStore, remoteName, md5=None, etag=None, partSize=None, remoteSize=None) :
+    entry = localFileSignature(localPath)
+    entry["remote"] = uploadManifestKey(remoteStore, remoteName)
+    entry["md5"] = md5
+    entry["etag"] = etag
+    entry["partSize"] = partSize # for a multipart upload, so its etag can be checked later
+    entry["remoteSize"] = remoteSize # size of the remote copy, which isn't the local size if it was gzipped on the way
+    loadUploadManifest()[entry["remote"]] = entry
+    saveUploadManifest()
+
+# md5 of a local file as (hexdigest, base64digest), as boto's Key.compute_md5 does,
+# but reusing any md5 the manifest already has for an unchanged copy of the file
+def computeLocalMD5(localPath) :
+    if (not verifyUploads()) :
+        for entry in loadUploadManifest().itervalues() :
+            if entry.get("md5") and (entry.get("path") == localPath) and sameLocalFile(entry, localPath) :
+                debug( "using recorded md5 for unchanged file "+localPath )
+                hexMD5 = entry["md5"]
+                return (hexMD5, base64.b64encode(binascii.unhexlify(hexMD5)))
+    debug( "calculating local md5 hash of "+localPath+"..." )
+    m = hashlib.md5()
+    fp = open(localPath,"rb")
+    while True :
+        block = fp.read(1024*1024)
+        if (not block) :
+            break
+        m.update(block)
+    fp.close()
+    debug( "done" )
+    return (m.hexdigest(), base64.b64encode(m.digest()))
+
+# the part size we used for a multipart upload, if we recorded one
+def getRecordedPartSize(remoteStore, remoteName) :
+    return loadUploadManifest().get(uploadManifestKey(remoteStore, remoteName),{}).get("partSize")
+
+# a multipart etag depends on the part size the object was uploaded with, which S3 doesn't tell
+# us - so the part sizes that fit an object of this size in nParts parts: the one we recorded at
+# upload if it fits, else the current setting, whole MB parts, and the usual tool defaults
+def multipartPartSizes(size, nParts, knownPartSize=None) :
+    MB = 1024*1024
+    if (nParts <= 1) : # one part is the whole object, whatever the part size
+        return [max(size,1)]
+    candidates = [knownPartSize, getUploadPartSize(), (((size+nParts-1)/nParts+MB-1)/MB)*MB]
+    candidates.extend([n*MB for n in (5, 8, 15, 16, 32, 64, 100, 128, 256, 512, 1024)])
+    partSizes = []
+    for p in candidates :
+        if (p and ((nParts-1)*p < size <= nParts*p) and not (p in partSizes)) :
+            partSizes.append(p)
+    if (knownPartSize in partSizes) :
+        return [knownPartSize]
+    return partSizes or [getUploadPartSize()]
+
+#
+# concurrent upload engine - a bounded pool of worker threads, with large S3 objects
+# broken into multipart chunks that upload (and retry) independently
+#
+def getUploadThreadCount() :
+    return max(1,int(getConfig("uploadThreads","4")))
+
+def getUploadPartSize() :
+    return max(5,int(getConfig("uploadPartSizeMB","64")))*1024*1024 # S3 won't take parts under 5MB
+
+# a read-only window onto part of a file, so boto can treat a multipart chunk as a whole file
+class FileChunk :
+    def __init__(self, filename, offset, length) :
+        self.fp = open(filename,"rb")
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+        self.name = filename
+        self.fp.seek(offset)
+
+    def read(self, size=-1) :
+        remaining = self.length - self.pos
+        if (size < 0) or (size > remaining) :
+            size = remaining
+        data = self.fp.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET) :
+        if (os.SEEK_CUR == whence) :
+            pos += self.pos
+        elif (os.SEEK_END == whence) :
+            pos += self.length
+        self.pos = max(0,min(pos,self.length))
+        self.fp.seek(self.offset+self.pos)
+
+    def tell(self) :
+        return self.pos
+
+    def close(self) :
+        self.fp.close()
+
+# write-only sink that tallies what would have been written: size, md5, and the etag S3
+# would give it as a multipart upload - for comparing a compressed stream with a remote copy
+class DigestSink :
+    def __init__(self, partSize) :
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.partSize = partSize
+        self.partMD5 = hashlib.md5()
+        self.partFill = 0
+        self.partDigests = []
+
+    def write(self, data) :
+        self.size += len(data)
+        self.md5.update(data)
+        while len(data) :
+            n = min(len(data), self.partSize-self.partFill)
+            self.partMD5.update(data[:n])
+            self.partFill += n
+            data = data[n:]
+            if (self.partFill == self.partSize) :
+                self.partDigests.append(self.partMD5.digest())
+                self.partMD5 = hashlib.md5()
+                self.partFill = 0
+
+    def etag(self) :
+        digests = list(self.partDigests)
+        if (self.partFill or (0 == len(digests))) :
+            digests.append(self.partMD5.digest())
+        return "%s-%d" % (hashlib.md5("".join(digests)).hexdigest(), len(digests))
+
+# DigestSinks for several part sizes at once, so one pass over the data can check a multipart etag
+class MultipartDigestSink :
+    def __init__(self, partSizes) :
+        self.sinks = [DigestSink(p) for p in partSizes]
+        self.md5 = self.sinks[0].md5
+        self.size = 0
+
+    def write(self, data) :
+        for sink in self.sinks :
+            sink.write(data)
+        self.size = self.sinks[0].size
+
+    # the part size that gives these contents this etag, or None
+    def partSizeFor(self, etag) :
+        for sink in self.sinks :
+            if (sink.etag() == etag) :
+                return sink.partSize
+        return None
+
+# write-only sink that sends what it's given to S3 as a multipart upload, a part at a time
+class S3MultipartSink :
+    def __init__(self, bucket, keyName, partSize) :
+        self.mp = bucket.initiate_multipart_upload(keyName)
+        self.partSize = partSize
+        self.buffer = []
+        self.buffered = 0
+        self.nParts = 0
+        self.size = 0 # bytes written so far
+
+    def write(self, data) :
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        while (self.buffered >= self.partSize) :
+            data = "".join(self.buffer)
+            self.uploadPart(data[:self.partSize])
+            self.buffer = [data[self.partSize:]]
+            self.buffered = len(self.buffer[0])
+
+    def uploadPart(self, data) :
+        self.nParts += 1
+        self.mp.upload_part_from_file(cStringIO.StringIO(data), self.nParts)
+
+    # finish the upload, returning the etag S3 gives it
+    def close(self) :
+        if (self.buffered or (0 == self.nParts)) :
+            self.uploadPart("".join(self.buffer))
+        return str(self.mp.complete_upload().etag).replace('\"','')
+
+    def cancel(self) :
+        self.mp.cancel_upload()
+
+# each worker thread gets its own S3 connection, boto connections aren't thread safe
+workerState = threading.local()
+def getWorkerBucket() :
+    if (None == getattr(workerState,"bucket",None)) :
+        conn = S3Connection(aws_access_key_id=getConfig("aws_access_key_id"), aws_secret_access_key=getConfig("aws_secret_access_key"))
+        workerState.bucket = conn.get_bucket(bucketName, validate=False)
+    return workerState.bucket
+
+# run a list of (description, callable) tasks on a bounded thread pool, retrying each
+# failed task with increasing delay - returns the list of descriptions that never succeeded
+def runConcurrently(tasks, nthreads, maxRetry=3) :
+    taskQueue = Queue.Queue()
+    for task in tasks :
+        taskQueue.put(task)
+    failures = []
+    lock = threading.Lock()
+    def worker() :
+        while True :
+            try :
+                (description, task) = taskQueue.get_nowait()
+            except Queue.Empty :
+                return
+            for retry in range(maxRetry+1) :
+                try :
+                    task()
+                    debug( "done: %s" % description )
+                    break
+                except (Exception, SystemExit), exception :
+                    if (retry < maxRetry) :
+                        debug( "retry %s: %s" % (description, exception) )
+                        sleep(2**retry)
+                    else :
+                        lock.acquire()
+                        log( exception )
+                        failures.append(description)
+                        lock.release()
+    threads = []
+    for n in range(min(nthreads,len(tasks))) :
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    while len(threads) :
+        threads[0].join(1)
+        if (not threads[0].isAlive()) :
+            threads.pop(0)
+        else :
+            log_progress() # show some life on long uploads
+    return failures
+
+# uploads queued by uploadFile() while a batch is open
+pendingUploads = None
+
+def beginUploadBatch() :
+    global pendingUploads
+    pendingUploads = []
+
+# push everything queued since beginUploadBatch(), largest files first so they aren't the stragglers
+def finishUploadBatch() :
+    global pendingUploads
+    uploads = pendingUploads
+    pendingUploads = None
+    if (None == uploads) or (0 == len(uploads)) :
+        return
+    uploads.sort(key=lambda u: -os.path.getsize(u.get("streamSource") or u["localPath"]))
+    transferUploads(uploads)
+
+# uploads is a list of dicts with localPath, remoteStore, remoteName, filemode
+def transferUploads(uploads) :
+    tasks = []
+    multiparts = []
+    for u in uploads :
+        log( "uploading " + u["localPath"] + " to " + u["remoteStore"] + "/" + u["remoteName"] )
+        if (u.get("streamSource")) : # compressed as it goes, so no size to plan parts around
+            tasks.append((u["remoteName"], makeStreamUploadTask(u)))
+        elif (runAWS()) :
+            size = os.path.getsize(u["localPath"])
+            u["remoteSize"] = size
+            partSize = getUploadPartSize()
+            if (size > partSize) :
+                mp = s3bucket.initiate_multipart_upload(u["remoteName"])
+                u["multipart"] = mp
+                u["partSize"] = partSize
+                multiparts.append(u)
+                nParts = (size+partSize-1)/partSize
+                for n in range(nParts) :
+                    tasks.append(("%s part %d of %d" % (u["remoteName"],n+1,nParts),
+                                  makeS3PartUploadTask(u["localPath"], mp.key_name, mp.id, n+1, n*partSize, min(partSize,size-(n*partSize)))))
+            else :
+                tasks.append((u["remoteName"], makeS3UploadTask(u)))
+        else :
+            tasks.append((u["remoteName"], makeHadoopUploadTask(u)))
+    failures = runConcurrently(tasks, getUploadThreadCount())
+    for u in multiparts :
+        mp = u["multipart"]
+        if (len([f for f in failures if f.startswith(u["remoteName"]+" part ")])) :
+            mp.cancel_upload()
+            failures.append(u["remoteName"])
+        else :
+            completed = mp.complete_upload()
+            u["etag"] = str(completed.etag).replace('\"','')
+    for u in uploads :
+        if (u["remoteName"] in failures) :
+            continue
+        noteUploadManifest(u.get("streamSource") or u["localPath"], u["remoteStore"], u["remoteName"], u.get("md5"), u.get("etag"), u.get("partSize"), u.get("remoteSize"))
+    if (len(failures)) :
+        log( "error: failed to upload %s" % ", ".join(failures) )
+        log( "exiting with error" )
+        exit(-1)
+
+def makeS3UploadTask(u) :
+    def task() :
+        k = Key(getWorkerBucket())
+        k.key = u["remoteName"]
+        k.set_contents_from_filename(u["localPath"]) # boto verifies file upload itself
+        u["md5"] = getattr(k,"md5",None)
+        u["etag"] = str(k.etag).replace('\"','')
+    return task
+
+def makeS3PartUploadTask(localPath, keyName, uploadId, partNum, offset, length) :
+    def task() :
+        from boto.s3.multipart import MultiPartUpload
+        mp = MultiPartUpload(getWorkerBucket())
+        mp.key_name = keyName
+        mp.id = uploadId
+        chunk = FileChunk(localPath, offset, length)
+        try :
+            mp.upload_part_from_file(chunk, partNum)
+        finally :
+            chunk.close()
+    return task
+
+def makeHadoopUploadTask(u) :
+    attempts = [0]
+    def task() :
+        if (attempts[0] > 0) : # hadoop won't overwrite whatever a failed attempt left behind
+            target = u["remoteName"]
+            if (not target.startswith(getHadoopDir())) :
+                target = getHadoopDir()+"/"+target
+            removeRemoteFile(target)
+        attempts[0] += 1
+        copyFileToHDFS(u["localPath"], u["remoteName"], u["filemode"])
+    return task
+
+# gzip u["streamSource"] straight into the upload, no .gz written locally
+def makeStreamUploadTask(u) :
+    attempts = [0]
+    def task() :
+        writeContents = lambda fp: gzipStream(u["streamSource"], fp)
+        if (runAWS()) :
+            sink = S3MultipartSink(getWorkerBucket(), u["remoteName"], getUploadPartSize())
+            try :
+                writeContents(sink)
+                u["etag"] = sink.close()
+                u["partSize"] = sink.partSize
+                u["remoteSize"] = sink.size
+            except :
+                sink.cancel()
+                raise
+        else :
+            if (attempts[0] > 0) : # hadoop won't overwrite whatever a failed attempt left behind
+                target = u["remoteName"]
+                if (not target.startswith(getHadoopDir())) :
+                    target = getHadoopDir()+"/"+target
+                removeRemoteFile(target)
+            attempts[0] += 1
+            copyStreamToHDFS(writeContents, u["remoteName"], u["filemode"])
+    return task
 
 # check list of files for existence on S3 or hadoop cluster and match with local, upload as needed
 # filenameKey allows us to get at filename as config["<filenameKey>"]
 # targetDir is the directory we want it to end up in (if blank, then use the directory named in config["<filenameKey>"])
 # if wantGZ is true and config["<filenameKey>"] does not end in ".gz", a local gzipped copy is
-# created and that's what we upload.
+# created and that's what we upload (or with keepGZipCopies False, it's gzipped as it uploads).
 # if overwriteOK is True we will overwrite if needed
 # filemode can be used to set file bits on hadoop
 #
@@ -904,32 +1987,49 @@ def uploadFile(fileNameKey, targetDir, wantGZ, overwriteOK=False, filemode="", d
                     setConfig(fileNameKey, localPath)
                 else :
                     debug( "based on filename, "+localPath+" appears to be gzipped copy of "+oldPath+" so we'll use that" )
+            streamSource = gzipStreamSource(localPath) # no .gz on disk, we compress as we go
+            sourcePath = streamSource or localPath
             # now set config
-            fp=open(localPath,"rb")
+            fp=open(sourcePath,"rb")
         except Exception, exception:
             log( exception )
             log( "error: could not open local file "+ localPath + " for upload comparison! " )
             log( "exiting with error" )
             exit(-1)
+        hadoopName = s3FileName
+        if (runHadoop() and not hadoopName.startswith(getHadoopDir())) :
+            if (not hadoopName.startswith("/")) :
+                hadoopName = "/"+hadoopName
+            hadoopName = getHadoopDir()+hadoopName
+        entry = lookupUploadManifest(sourcePath, remoteStore, s3FileName)
+        if (None != entry) :
+            # local file unchanged, just make sure the remote copy hasn't gone away
+            try :
+                if (runAWS()) :
+                    testKey = s3Bucket.get_key(s3FileName)
+                    present = (None != testKey) and ((None == entry.get("etag")) or (testKey.etag.replace('\"','') == entry["etag"]))
+                else : # hadoop
+                    status = getHadoopStatCache().stat(hadoopName)
+                    present = (None != status) and not status.isDir
+            except Exception, e :
+                log( e )
+                present = False
+            if (present) :
+                debug( "upload manifest shows "+localPath+" unchanged since it was copied to "+remoteStore+"/"+s3FileName+", skipping content check" )
+                fp.close()
+                setConfig(fileNameKey, s3FileName) # now speak in terms of S3 for node config
+                return
+            debug( "remote copy of "+localPath+" recorded in upload manifest has gone or changed" )
         debug( "checking for file " + s3FileName + " on remote system ... " )
         if (runAWS()) :
             testKey = s3Bucket.get_key(s3FileName)
         else : # hadoop
             try :
-                hadoopName = s3FileName
-                if (not hadoopName.startswith(getHadoopDir())) :
-                    if (not hadoopName.startswith("/")) :
-                        hadoopName = "/"+hadoopName
-                    hadoopName = getHadoopDir()+hadoopName
-                cmd = getHadoopBinary() + " dfs -ls "+hadoopName+" 2> /dev/null" # ignore "file not found" messages
-                debug(cmd)
-                lines = os.popen(cmd).readlines()
+                status = getHadoopStatCache().stat(hadoopName)
                 testKey = None
-                for t in lines :
-                    if ( t.find(hadoopName) > -1 ) :
-                        items = t.split()
-                        testKey = Key()
-                        testKey.size = int(items[4])
+                if ((None != status) and not status.isDir) :
+                    testKey = Key()
+                    testKey.size = status.size
                         
                 result = 0
             except Exception, e :
@@ -954,8 +2054,18 @@ def uploadFile(fileNameKey, targetDir, wantGZ, overwriteOK=False, filemode="", d
                 # (this comes back as a string surrounded by double-quote characters)
                 s3HexMD5 = testKey.etag.replace('\"','')
                 
-
-                localFileSize = os.path.getsize(localPath)
+                recordedPartSize = getRecordedPartSize(remoteStore, s3FileName)
+                nParts = 1
+                if ("-" in s3HexMD5) : # multipart upload, etag isn't a plain md5
+                    nParts = int(s3HexMD5.split("-")[1])
+                partSize = None
+                if (None != streamSource) : # nothing on disk to compare, so see what we would send
+                    debug( "compressing "+streamSource+" for comparison with S3 copy..." )
+                    sink = MultipartDigestSink(multipartPartSizes(s3FileSize, nParts, recordedPartSize))
+                    gzipStream(streamSource, sink)
+                    localFileSize = sink.size
+                else :
+                    localFileSize = os.path.getsize(localPath)
 
                 if (localFileSize != s3FileSize):
                     log( "local and S3 file sizes of "+localPath+" do not match." )
@@ -967,13 +2077,28 @@ def uploadFile(fileNameKey, targetDir, wantGZ, overwriteOK=False, filemode="", d
                         log( "exiting with error" )
                         exit(-1)
 
-                debug( "calculating local md5 hash..." )
-                (localHexMD5,localB64MD5) = testKey.compute_md5(fp)
-                debug( "done" )
                 fp.close()
+                if (("-" in s3HexMD5) and (None == streamSource)) :
+                    sink = MultipartDigestSink(multipartPartSizes(s3FileSize, nParts, recordedPartSize))
+                    fp = open(localPath,"rb")
+                    for block in iter(lambda: fp.read(1024*1024), "") :
+                        sink.write(block)
+                    fp.close()
+                if ("-" in s3HexMD5) :
+                    partSize = sink.partSizeFor(s3HexMD5)
+                    localHexMD5 = (partSize and s3HexMD5) or sink.sinks[0].etag()
+                elif (None != streamSource) :
+                    localHexMD5 = sink.md5.hexdigest()
+                else :
+                    (localHexMD5,localB64MD5) = computeLocalMD5(localPath)
 
                 if (s3HexMD5 == localHexMD5):
                     debug( "existing S3 copy of file "+localPath+" verified with correct size and checksum, good" )
+                    if (not needsWrite) :
+                        if (("-" in s3HexMD5) or (None != streamSource)) : # md5 of what's in S3, not of sourcePath
+                            noteUploadManifest(sourcePath, remoteStore, s3FileName, None, s3HexMD5, partSize, s3FileSize)
+                        else :
+                            noteUploadManifest(localPath, remoteStore, s3FileName, localHexMD5, s3HexMD5, None, s3FileSize)
                 elif (overwriteOK) :
                     log( "md5 sums for local and S3 copies of "+localPath+" did not match! Overwriting S3 copy." )
                     needsWrite = True
@@ -982,9 +2107,15 @@ def uploadFile(fileNameKey, targetDir, wantGZ, overwriteOK=False, filemode="", d
                     log( "exiting with error" )
                     exit(-1)
             else : # hadoop
-                localFileSize = os.path.getsize(localPath)
+                if (None != streamSource) : # nothing on disk to compare, so see what we would send
+                    sink = DigestSink(getUploadPartSize())
+                    gzipStream(streamSource, sink)
+                    localFileSize = sink.size
+                else :
+                    localFileSize = os.path.getsize(localPath)
                 if (localFileSize == testKey.size):
                     debug( "existing HDFS copy of file "+localPath+" verified with correct size, good" )
+                    noteUploadManifest(sourcePath, remoteStore, s3FileName, None, None, None, testKey.size)
                 elif (overwriteOK) :
                     log( "existing HDFS copy of file "+localPath+" is different size than local copy, updating it from local copy" )
                     needsWrite = True
@@ -999,15 +2130,13 @@ def uploadFile(fileNameKey, targetDir, wantGZ, overwriteOK=False, filemode="", d
         if (needsWrite) :
 
             # upload if possible, or exit with error otherwise
-            log( "uploading " + localPath + " to " + remoteStore + "/" + s3FileName )
-            if (runAWS()) :
-                # boto verifies file upload itself
-                fp.close()
-                s3handle.key = s3FileName
-                s3handle.set_contents_from_filename(localPath)
-            else : # hadoop
-                copyFileToHDFS(localPath, s3FileName, filemode)
-                   
+            fp.close()
+            upload = {"localPath":localPath, "remoteStore":remoteStore, "remoteName":s3FileName, "filemode":filemode, "streamSource":streamSource}
+            if (None != pendingUploads) : # part of a batch, see beginUploadBatch()
+                pendingUploads.append(upload)
+            else :
+                transferUploads([upload])
+
                     
         setConfig(fileNameKey, s3FileName) # now speak in terms of S3 for node config
 
@@ -35,6 +35,12 @@
 import sys
 import os.path
 import mapreduce_helper as mrh # mapreduce setup functions
+import spectrum_index # for dividing spectra among mappers by cost
+import database_index # peptide mass index of the search database, reused from job to job
+import database_shards # for splitting the database among jobs instead of the spectra among mappers
+import emr_monitor # for following EMR job flow progress
+import emr_session # for running on a kept alive job flow
+import mapper_schedule # for deciding how finely to divide the work among mappers
 import platform
 import shutil
 
@@ -112,10 +118,29 @@ except Exception, inst:
         mrh.log("quitting")
         exit(1)
 
+# each line of mapper input file tells mapper to take the nth of every m spectra
+mapper_mult=mapper_schedule.getMapperMultiplier() # None means work it out from the first spectrum file
+# we output "mapper_mult" times as many pairs as we have mappers, so if anything goes wrong with one
+# the others can level that out instead of somebody getting a double load
+
+# database sharding: each parameters file becomes one search per database shard, merged at the end
+shardedSearches = [] # (merged output path, per-shard output paths)
+nshards = int(mrh.getConfig("databaseShards","1"))
+if ((nshards > 1) and not mrh.runBangBang()) :
+    shardConfigFiles = []
+    for configfile in configfiles :
+        (shardParams, outputPath, shardOutputs) = database_shards.shardSearch(configfile, nshards)
+        shardConfigFiles.extend(shardParams)
+        shardedSearches.append((outputPath, shardOutputs))
+        for n in range(nshards-1) :
+            mrh.pushConfig() # one config per shard search
+    configfiles = shardConfigFiles
+
 nSharedFileIDs = 1
 nParamFiles = 0
 cachefilesStack = []
 workstepsStack = []
+mrh.beginUploadBatch() # uploads queue up and go out concurrently after all configs are examined
 for xtandemParametersLocalPath in configfiles: # peruse each config file and do needed setup and file xfers
     mrh.info("begin processing parameters file %s" % xtandemParametersLocalPath)
     mrh.selectConfig(nParamFiles)
@@ -180,8 +205,21 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
                     else :
                         note.text = defaultXtandemParametersName
                 elif ((note.attrib["label"] == "spectrum, path" ) and ("" == spectrumName)) : 
+                    spectrumLocalPath = mrh.my_abspath( note.text )
+                    candidateCount = None
+                    if (mrh.indexDatabases() and (mrh.balanceSpectra() or (None == mapper_mult))) : # count actual candidates per precursor window
+                        candidateCount = database_index.getCandidateCounter(mrh.getConfig("xtandemParametersLocalPath"))
+                    if (None == mapper_mult) :
+                        mapper_mult = mapper_schedule.chooseMapperMultiplier(spectrumLocalPath, mrh.getMapperCount(), candidateCount)
+                    if (mrh.runLocal()) : # so the local run can measure the time per unit of estimated cost
+                        estimate = mapper_schedule.estimateSearchCost(spectrumLocalPath, candidateCount)
+                        if (None != estimate) :
+                            mrh.setConfig("estimatedSearchCost", str(estimate[1]))
+                    if (mrh.balanceSpectra()) :
+                        # reorder the spectra so that each mapper's nth-of-m share costs about the same to search
+                        spectrumLocalPath = spectrum_index.balanceSpectrumFile(spectrumLocalPath, mrh.getMapperCount()*mapper_mult, candidateCount)
                     # try to use gzipped copy instead to save upload time
-                    note.text = mrh.attemptGZip(mrh.my_abspath( note.text ))
+                    note.text = mrh.attemptGZip(spectrumLocalPath)
                     mrh.setConfig("sharedFile_spectrum%d" % nSharedFileIDs, note.text)
                     nSharedFileIDs = nSharedFileIDs+1
                     spectrumName = mrh.HadoopCacheFileName(note.text)
@@ -306,10 +344,14 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
         if (mrh.runAWS() and (1 == nParamFiles)) : # first time through on AWS EMR
             # create a job step to copy large data files from S3 to HDFS (you'd think that
             # you could just use cachefile mechanism from s3 but it doesn't seem to scale well)
-            copierCommands = ""
+            copierFiles = {} # HDFS name -> S3 name, for the copy commands we write once the uploads are done
+            copierCommands = {} # HDFS name -> (size, copy command)
+            stagingManifest = emr_session.StagingManifest(emr_session.getSessionJobflow()) # what's already in HDFS, if reusing a job flow
             copierScript = '%s/copier-step.sh' % jobDirMain 
             copierScriptInputs = '%s/copier-step-inputs' % jobDirMain
-            scripttext = "#!/bin/bash\nexec <&0\nwhile read line\ndo {\necho $line 1>&2 ; $line 1>&2\n}\n done\n"
+            # each input line is one or more copy commands, with the byte offset NLineInputFormat puts in front of it -
+            # any failed copy fails the task, so the step (and the staging manifest) can't count it as done
+            scripttext = "#!/bin/bash\nexec <&0\nwhile read line\ndo {\nline=\"${line#*$'\\t'}\"\necho $line 1>&2 ; bash -c \"$line\" 1>&2 || exit 1\n}\n done\n"
             mrh.set_contents_from_string(copierScript,scripttext)
         
         # go through the config parameters, anything named "sharedFile_*" gets uploaded
@@ -321,13 +363,11 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
                 mrh.uploadFile(cfgKey, targetDir, wantGZ=cfgKey.startswith("sharedFile_GZ_"),overwriteOK=("True"==mrh.getConfig("overwriteUploads","False"))) # side effect: after this call config speaks of data files in terms of S3
                 if ( mrh.runAWS()) :
                     # and set up for copying S3 files out to shared files system (HDFS, or NFS for X!!Tandem)
-                    # prepare a list of copy commands to be passed out to mappers
-                    cmd = mrh.constructHadoopCacheFileCopyCommand(cfgKey)
-                    if (-1 == copierCommands.find(cmd)) : # avoid redundant copy commands
-                        copierCommands = copierCommands + cmd
+                    # - the copy commands need the S3 copy's md5, so they wait until the uploads are done
+                    hdfsName = mrh.HadoopCacheFileName(mrh.getConfig(cfgKey))
+                    copierFiles[hdfsName] = mrh.getConfig(cfgKey) # avoid redundant copy commands
+                    mrh.setConfig(cfgKey, hdfsName) # transform filename in config for use on cluster
         if (mrh.runAWS()) :
-            if (len(configfiles) == nParamFiles) : # on the last or only paramfile
-                mrh.set_contents_from_string(copierScriptInputs, copierCommands)
             nodecount = int(mrh.getConfig( "numberOfClientNodes","0" ))
             mapTasksPerClient = int(mrh.getConfig("numberOfTasksPerClient")) 
             if (0==nodecount) : # perhaps they specified mapper count instead
@@ -347,6 +387,8 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
                 nmappers = (nodecount*mapTasksPerClient) 
         else :
             nmappers = int(mrh.getConfig( "numberOfMappers" ))
+    elif ( mrh.runLocal() ) :
+        nmappers = mrh.getLocalMapperCount() # one mapper process per core unless told otherwise
     else :
         nmappers = 1
     cachefilesStack.extend([cachefiles])
@@ -357,13 +399,25 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
     #
     # end for each config file
     #
+mrh.finishUploadBatch() # push any queued uploads to S3 or HDFS
+if (mrh.runAWS()) :
+    # prepare a list of copy commands to be passed out to mappers, for the S3 copies as uploaded
+    staged = {} # copy commands for what the staging manifest says HDFS has already
+    for (hdfsName, s3Name) in copierFiles.iteritems() :
+        (md5, size) = mrh.getUploadedFileIdentity(s3Name)
+        cmd = mrh.constructHadoopCacheFileCopyCommand(s3Name, md5, size) # skips the copy if HDFS already has it
+        if (stagingManifest.isStaged(hdfsName, md5)) :
+            staged[hdfsName] = (size, cmd)
+        else :
+            copierCommands[hdfsName] = (size, cmd)
+    if (len(copierCommands)) : # the copier step runs anyway, so let its HDFS checks confirm the manifest too
+        copierCommands.update(staged)
+if (None == mapper_mult) : # no spectrum file to go by
+    mapper_mult = mapper_schedule.DEFAULT_MAPPER_MULTIPLIER
 
 # create the mapper1 input file
 # there is only one reducer key
-# each line of mapper input file tells mapper to take the nth of every m spectra
-mapper_mult=4
-# we output "mapper_mult" times as many pairs as we have mappers, so if anything goes wrong with one
-# the others can level that out instead of somebody getting a double load
+# each line of mapper input file tells mapper to take the nth of every m spectra (see mapper_mult above)
 mapper1InputFile = '%s/mapper1-input-values' % jobDirMain
 mapperInputs = ""
 for count in range(nmappers*mapper_mult) :
@@ -378,6 +432,7 @@ mrh.saveStringToFile(mapperInputs,mapper1InputFile)
 # add one line for comment in github
 nParamFiles = 0
 bootstrapFile = ""
+fusedScriptWritten = False
 for xtandemParametersLocalPath in configfiles: # peruse each config file and do needed setup and file xfers
     worksteps = []
     mrh.selectConfig(nParamFiles)
@@ -400,13 +455,26 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
             nsteps = 3
         else :
             nsteps = 2
+        splitTask = None
+        if (mrh.resplitStragglers()) :
+            splitTask = mapper_schedule.splitSliceLine
+        mapperSeconds = 0
         for step in range(1,nsteps+1) :
             mapper = '%s -mapper%d_%d /tmp %s ' % ( xtandemCmd, step, nParamFiles, xtandemParametersLocalPath)
-            reducer = '%s -reducer%d_%d /tmp %s ' % ( xtandemCmd, step, nParamFiles, xtandemParametersLocalPath )
+            if (step < 3) : # as on hadoop, reducers 1 and 2 are told how many mappers the next step has
+                reducer = '%s -reducer%d_%d.%d /tmp %s ' % ( xtandemCmd, step, nParamFiles, nmappers, xtandemParametersLocalPath )
+            else :
+                reducer = '%s -reducer%d_%d /tmp %s ' % ( xtandemCmd, step, nParamFiles, xtandemParametersLocalPath )
             reducerOutFile = mapperInputFile+".next"
-            cmd = "cat " + mapperInputFile + " | " + mapper + " | sort | " + reducer + " > " + reducerOutFile
+            runtimes = []
+            if (0 != mrh.runLocalMapReduce(mapper, reducer, mapperInputFile, reducerOutFile, nmappers, runtimes=runtimes, splitTask=splitTask)) :
+                mrh.log("exiting with error")
+                exit(-1)
+            mapper_schedule.summarizeTaskRuntimes(step, runtimes)
+            mapperSeconds = mapperSeconds + sum([t for (label, t) in runtimes])
             mapperInputFile = reducerOutFile
-            mrh.runCommand(cmd)
+        if ("" != mrh.getConfig("estimatedSearchCost","")) :
+            mapper_schedule.noteMeasuredCost(float(mrh.getConfig("estimatedSearchCost")), mapperSeconds)
         wait = 1
         if (resultsFilename != "") :
             mrh.runCommand("cat "+reducerOutFile+" >> "+resultsFilename) # combine mapper and reducer logs
@@ -445,6 +513,9 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
             timeoutMinutes = 45  # stuck jobs are expensive
             if (nmappers < 1) :
                 nmappers = 1
+            if (len(configfiles) == nParamFiles) : # on the last or only paramfile
+                # spread the copying across the mappers, about the same number of bytes for each
+                mrh.set_contents_from_string(copierScriptInputs, mrh.balanceCopyCommands(copierCommands.values(), nmappers))
         else : # straight up Hadoop
             nmappers = int(mrh.getConfig("numberOfMappers"))
             timeoutMinutes = 6000  # already own the cluster, might as well hang in there
@@ -463,9 +534,35 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
                                            reducer = 'NONE',
                                            input = '%s/%s' %  (baseURL, copierScriptInputs), 
                                            output = '%s/%s/copierStepResults' %  (baseURL, jobDirMain),
-                                           step_args = ['-jobconf','mapred.task.timeout=2700000']) # 45 minute timeout for file transfer
+                                           step_args = ['-jobconf','mapred.task.timeout=2700000', # 45 minute timeout for file transfer
+                                                        '-inputformat','org.apache.hadoop.mapred.lib.NLineInputFormat', # a mapper per input line
+                                                        '-jobconf','mapred.line.input.format.linespermap=1',
+                                                        '-jobconf','mapred.map.tasks.speculative.execution=false']) # no racing copies of a copy
                 worksteps.extend([copierStep])
 
+            if ("" != emr_session.getSessionJobflow()) :
+                # a kept alive job flow still has the last search's intermediate files in HDFS, under the
+                # names ours will use (tandem picks reducer1_N, and streaming won't write to an existing
+                # output dir) - so clear them first, which also covers searches that failed or were cancelled
+                tidyScript = '%s/tidy-step.sh' % jobDirMain
+                tidyScriptInput = '%s/tidy-step-input%d' % (jobDirMain, nParamFiles)
+                if (1==nParamFiles) : # first time through
+                    # input is the config number, with the byte offset NLineInputFormat puts in front of it
+                    scripttext = '#!/bin/bash\nread line\nN="${line#*$\'\\t\'}"\n' + \
+                        'hadoop fs -rmr /home/hadoop/output$N.1 /home/hadoop/output$N.2 1>&2\n' + \
+                        'hadoop fs -rm /home/hadoop/reducer1_$N /home/hadoop/reducer2_$N 1>&2\n' + \
+                        'exit 0\n' # not there is fine
+                    mrh.set_contents_from_string(tidyScript,scripttext)
+                mrh.set_contents_from_string(tidyScriptInput,"%d\n" % nParamFiles)
+                tidyStep = boto.emr.StreamingStep( name = '%s-tidy' % baseName,
+                                           mapper = '%s/%s' % ( baseURL , tidyScript),
+                                           reducer = 'NONE',
+                                           input = '%s/%s' %  (baseURL, tidyScriptInput),
+                                           output = '%s/%s/tidyStepResults%d' %  (baseURL, jobDirMain, nParamFiles),
+                                           step_args = ['-inputformat','org.apache.hadoop.mapred.lib.NLineInputFormat', # just the one mapper
+                                                        '-jobconf','mapred.map.tasks.speculative.execution=false'])
+                worksteps.extend([tidyStep])
+
             # specify a streaming (stdio-oriented) step to run tandem (inherits stdin) then tidy up the result and copy to S3
             finalReportURL = '%s/%s/%s' %  (bucketName , jobDir, os.path.basename(outputName))
             finalOutputDir =  '%s/%s' %  (baseURL, resultsDir)
@@ -492,6 +589,40 @@ for xtandemParametersLocalPath in configfiles: # peruse each config file and do
                                        step_args = stepArgs)
             worksteps.extend([workStepOldSkool])
 
+        elif ( mrh.fuseSteps() and ("yes" != mrh.getConfig("refineSetting")) ) :
+            # no refinement, so condition and process can share one step: mapper1 runs spread across
+            # the mappers, and the reduce task does reducer1, fetches the reducer1 file that the
+            # process step would have had as a cache file, splits reducer1's output among a few copies
+            # of mapper2, sorts as hadoop would, and hands that to reducer2
+            fusedScript = '%s/fused-step.sh' % jobDirMain
+            if (not fusedScriptWritten) : # first config to take this path - configs can differ on refinement
+                scripttext = '#!/bin/bash\n# usage: fused-step.sh tandem configNumber nmappers reducer1URL ntasks xferDir params [reducer2 args]\n' + \
+                    'T=$1 ; N=$2 ; M=$3 ; R1=$4 ; P=$5 ; X=$6 ; PARAMS=$7 ; shift 7\n' + \
+                    'if [ -x ./$T ] ; then T=./$T ; fi\n' + \
+                    'while sleep 60 ; do echo "reporter:status:fused condition and process step running" 1>&2 ; done &\nHB=$!\n' + \
+                    '$T -reducer1_$N.$M $X $PARAMS > fused-reducer1.out || { kill $HB ; exit 1 ; }\n' + \
+                    'hadoop fs -get $R1 reducer1_$N 1>&2 || { kill $HB ; exit 1 ; }\n' + \
+                    'awk -v P=$P \'{ print > ("fused-mapper2-in." (NR%P)) }\' fused-reducer1.out\n' + \
+                    'K=0 ; PIDS=""\n' + \
+                    'for f in $(ls fused-mapper2-in.* 2>/dev/null) ; do\n $T -mapper2_$N $X $PARAMS < $f > $f.out &\n PIDS="$PIDS $!" ; let K=K+1\ndone\n' + \
+                    'for p in $PIDS ; do wait $p || { kill $HB ; exit 1 ; } ; done\n' + \
+                    'cat /dev/null $(ls fused-mapper2-in.*.out 2>/dev/null) | LC_ALL=C sort -s -t "$(printf \'\\t\')" -k1,1 | $T -reducer2_$N.$K $X $PARAMS "$@"\n' + \
+                    'let n=$?\nkill $HB\nexit $n\n'
+                mrh.set_contents_from_string(fusedScript,scripttext)
+                fusedScriptWritten = True
+            fusedStepCacheFiles = list(cachefiles) # make a copy of the list
+            fusedStepCacheFiles.append(mrh.constructCacheFileReference(jobDirMain, 'fused-step.sh'))
+            reducer1URL = 'hdfs://%s/reducer1_%d' % (mrh.getHadoopWorkDir(),nParamFiles)
+            mrh.info("running condition and process steps for %s as a single step" % baseName)
+            workStepFused = boto.emr.StreamingStep( name = '%s-fused-final' % baseName, # "-final" is cue to grab results below
+                                           mapper = '%s -mapper1_%d %s' % (xtandemCmd, nParamFiles, xtandemArgs),
+                                           reducer = 'bash fused-step.sh %s %d %d %s %d %s%s' % (xtandemCmd, nParamFiles, nmappers, reducer1URL, mrh.getFusedProcessTasks(), xtandemArgs, finalOutputURLArg),
+                                           cache_files = fusedStepCacheFiles,
+                                           input = '%s/%s' %  (baseURL, mapper1InputFile),
+                                           output = finalOutputDir,
+                                           step_args = stepArgs)
+            worksteps.extend([workStepFused])
+
         else :
             conditionStepOutputDir = 'hdfs://'+mrh.getHadoopWorkDir()+'/output%d.1/'%nParamFiles
             workStep1 = boto.emr.StreamingStep( name = '%s-condition' % baseName,
@@ -583,75 +714,100 @@ elif (mrh.runAWS()) :
     else :
         failure_action = 'TERMINATE_JOB_FLOW'
 
-    # are we planning a spot bid instead of demand instances?
-    spotBid = mrh.getConfig("spotBid","")
     conn = mrh.conn
 
-    if ("" != spotBid) :
-        from boto.emr.instance_group import InstanceGroup  # spot EMR is post-2.0 stuff - 2.1rc2 is known to work
-        if ('%' in spotBid) : # a percentage, eg "25%" or "25%%"
-            spotBid = mrh.calculateSpotBidAsPercentage( spotBid, mrh.getConfig("ec2_client_instance_type"), 0.20 ) # about 20% more for EMR instances
-        launchgroup = "MRT"+mrh.getConfig( "baseName" ) +"_"+mrh.getConfig("jobTimeStamp")
-        mrh.setCoreConfig("launchgroup",launchgroup)
-        instanceGroups = [  
-            InstanceGroup(1, 'MASTER', mrh.getConfig("ec2_head_instance_type"), 'SPOT', 'master-%s' % launchgroup, spotBid),  
-            InstanceGroup(int(mrh.getConfig("numberOfClientNodes")), 'CORE', mrh.getConfig("ec2_client_instance_type"), 'SPOT', 'core-%s' % launchgroup, spotBid)  
-            ]
-        jf_id = conn.run_jobflow(name = baseName,
-                            log_uri='s3://%s/%s' %  (bucketName, jobDirMain),
-                            hadoop_version="0.20",
-                            ec2_keyname=mrh.getConfig( "RSAKeyName", required=False ),
-                            action_on_failure=failure_action,
-                            keep_alive=keepalive,
-                            instance_groups=instanceGroups,
-                            enable_debugging=("False"==mrh.getConfig("noDebugEMR","False")),
-                            steps=[workstepsStack[0][0]],
-                            bootstrap_actions=[bootstrapActionInstallTandem])
+    # no need for the copier step if everything it would copy is already in the job flow's HDFS
+    stagingStep = None
+    if (not len(copierCommands)) :
+        mrh.log("data files are already staged in HDFS, no need to copy from S3")
+        workstepsStack[0].remove(copierStep)
     else :
-        mrh.log("Using demand instances.  Consider using spotBid parameter for less expensive operation.")
-        jf_id = conn.run_jobflow(name=jobName,
-                            log_uri='s3://%s/%s' %  (bucketName, jobDirMain),
-                            hadoop_version="0.20",
-                            ec2_keyname=mrh.getConfig( "RSAKeyName", required=False ),
-                            action_on_failure=failure_action,
-                            keep_alive=keepalive,
-                            master_instance_type=mrh.getConfig("ec2_head_instance_type"),
-                            slave_instance_type=mrh.getConfig("ec2_client_instance_type"),
-                            enable_debugging=("False"==mrh.getConfig("noDebugEMR","False")),
-                            num_instances=(int(mrh.getConfig("numberOfClientNodes"))+1), # +1 for master
-                            steps=[workstepsStack[0][0]],
-                            bootstrap_actions=[bootstrapActionInstallTandem])
-    # multi-config, multi-step jobs may overwhelm a single boto action
-    for n in range(1,len(workstepsStack[0])) :
-        conn.add_jobflow_steps(jf_id,[workstepsStack[0][n]]) # so add a step at a time
-    for m in range(1,len(workstepsStack)) : 
-        for n in range(0,len(workstepsStack[m])) : 
-            conn.add_jobflow_steps(jf_id,[workstepsStack[m][n]]) # so add a step at a time
-
-    wait = 30 # much less than 10 sec and AWS gets irritated and throttles you back
-    lastState = ""
+        stagingStep = 0
+    if (emr_session.isSession()) : # a failed search shouldn't take down a cluster other searches are using
+        for worksteps in workstepsStack :
+            for workstep in worksteps :
+                workstep.action_on_failure = 'CONTINUE'
+
+    # multi-config, multi-step jobs may overwhelm a single boto action, so we add a step at a time
+    allSteps = []
+    for worksteps in workstepsStack :
+        allSteps.extend(worksteps)
+    jf_id = emr_session.getSessionJobflow()
+    if ("" != jf_id) : # a kept alive job flow, already bootstrapped, so we just add our steps to it
+        firstStep = emr_session.attachJobflow(conn, jf_id)
+        newSteps = allSteps
+    else :
+        firstStep = None # ours are the last steps listed
+        newSteps = allSteps[1:]
+
+        # are we planning a spot bid instead of demand instances?
+        spotBid = mrh.getConfig("spotBid","")
+        if ("" != spotBid) :
+            from boto.emr.instance_group import InstanceGroup  # spot EMR is post-2.0 stuff - 2.1rc2 is known to work
+            if ('%' in spotBid) : # a percentage, eg "25%" or "25%%"
+                spotBid = mrh.calculateSpotBidAsPercentage( spotBid, mrh.getConfig("ec2_client_instance_type"), 0.20 ) # about 20% more for EMR instances
+            launchgroup = "MRT"+mrh.getConfig( "baseName" ) +"_"+mrh.getConfig("jobTimeStamp")
+            mrh.setCoreConfig("launchgroup",launchgroup)
+            instanceGroups = [  
+                InstanceGroup(1, 'MASTER', mrh.getConfig("ec2_head_instance_type"), 'SPOT', 'master-%s' % launchgroup, spotBid),  
+                InstanceGroup(int(mrh.getConfig("numberOfClientNodes")), 'CORE', mrh.getConfig("ec2_client_instance_type"), 'SPOT', 'core-%s' % launchgroup, spotBid)  
+                ]
+            jf_id = conn.run_jobflow(name = baseName,
+                                log_uri='s3://%s/%s' %  (bucketName, jobDirMain),
+                                hadoop_version="0.20",
+                                ec2_keyname=mrh.getConfig( "RSAKeyName", required=False ),
+                                action_on_failure=failure_action,
+                                keep_alive=keepalive,
+                                instance_groups=instanceGroups,
+                                enable_debugging=("False"==mrh.getConfig("noDebugEMR","False")),
+                                steps=[allSteps[0]],
+                                bootstrap_actions=[bootstrapActionInstallTandem])
+        else :
+            mrh.log("Using demand instances.  Consider using spotBid parameter for less expensive operation.")
+            jf_id = conn.run_jobflow(name=jobName,
+                                log_uri='s3://%s/%s' %  (bucketName, jobDirMain),
+                                hadoop_version="0.20",
+                                ec2_keyname=mrh.getConfig( "RSAKeyName", required=False ),
+                                action_on_failure=failure_action,
+                                keep_alive=keepalive,
+                                master_instance_type=mrh.getConfig("ec2_head_instance_type"),
+                                slave_instance_type=mrh.getConfig("ec2_client_instance_type"),
+                                enable_debugging=("False"==mrh.getConfig("noDebugEMR","False")),
+                                num_instances=(int(mrh.getConfig("numberOfClientNodes"))+1), # +1 for master
+                                steps=[allSteps[0]],
+                                bootstrap_actions=[bootstrapActionInstallTandem])
+        if (keepalive) :
+            mrh.log('job flow %s will be kept alive - set "jobflowId":"%s" to run more searches on it' % (jf_id, jf_id))
+    for workstep in newSteps :
+        conn.add_jobflow_steps(jf_id,[workstep])
+
+    # follow step states, and collect each config's results once its final step is done
+    finalSteps = [] # index of each config's last step among those we submitted
+    nsteps = 0
+    for worksteps in workstepsStack :
+        nsteps = nsteps + len(worksteps)
+        finalSteps.append(nsteps-1)
+    monitor = emr_monitor.JobflowMonitor(conn, jf_id, nsteps, firstStep)
     while True:
-      jf = conn.describe_jobflow(jf_id)
-      if (lastState != jf.state) : # state change
-          mrh.log("cluster status: "+jf.state)
-          lastState = jf.state
-      else :
-          mrh.log_progress() # just put a dot
+      changed = monitor.poll()
+
+      if ((None != stagingStep) and monitor.isStepFinished(stagingStep)) :
+        if (("COMPLETED" == monitor.stepState(stagingStep)) and emr_session.isSession()) :
+            stagingManifest.save(jf_id) # so later runs on this job flow know what's in HDFS
+        stagingStep = None
 
       for nConfig in range(len(configfiles)) :
         mrh.selectConfig(nConfig)
-        if (not mrh.getConfig("completed")) :
-            finalOutputDir=mrh.getConfig("finalOutputDir")
+        if ((not mrh.getConfig("completed")) and monitor.isStepFinished(finalSteps[nConfig])) :
             resultsDir=mrh.getConfig("resultsDir")
             jobDir=mrh.getJobDir()
             outputName=mrh.getConfig("outputName")
             outputLocalPath=mrh.getConfig("outputLocalPath")
             # grab the results - this is the stdout and stderr of the final reducer step of current search
-            concat = ""
-            mask = '%s/part-' % resultsDir
-            for part in BucketListResultSet(mrh.s3bucket, prefix=mask) :
-                # all results in one string
-                concat = concat + mrh.get_contents_as_string(part)
+            concat = emr_monitor.fetchParts(mrh.s3bucket, '%s/part-' % resultsDir)
+            mrh.setConfig("completed",True)
+            if ("COMPLETED" != monitor.stepState(finalSteps[nConfig])) :
+                mrh.log("error: final step for %s ended %s" % (mrh.getConfig("outputName"), monitor.stepState(finalSteps[nConfig])))
             if (len(concat) > 0) :
                 mrh.log("Done.  X!Tandem logs:")
                 # write to file?
@@ -664,25 +820,18 @@ elif (mrh.runAWS()) :
                 mrh.log(concat)   
                 # and of course grab the tandem result file
                 s3name = '%s/%s'%(jobDir, os.path.basename(outputName))
-                mrh.get_contents_to_filename(s3name,outputLocalPath)
+                mrh.get_report_to_filename(s3name,outputLocalPath)
                 mrh.log('Results written to %s' % outputLocalPath)
-                mrh.setConfig("completed",True)
-                lastState = '' # just to provoke reprint of state on console
+            changed = True
            
-      if lastState == 'COMPLETED':
-        break
-      if lastState == 'FAILED':
+      if monitor.isFinished() :
         break
-      if lastState == 'TERMINATED':
-        break
-      sleep(wait)
+      monitor.pause(changed)
 elif (not mrh.runLocal()) : # non-EMR hadoop
     mrh.log("begin execution")
-    for nConfigs in range(0,len(workstepsStack)) :
+    # nab the tandem output of a config once its last step is done
+    def collectResults(nConfigs) :
         mrh.selectConfig(nConfigs)
-        for workstep in workstepsStack[nConfigs] :
-            mrh.doHadoopStep(workstep)
-        # nab the tandem output
         max_retry = 4
         for retry in range(max_retry+1) :
             try :
@@ -693,15 +842,10 @@ elif (not mrh.runLocal()) : # non-EMR hadoop
                     f.write(results)
                     f.close()
                 # and of course grab the tandem result file
-                mrh.get_contents_to_filename(mrh.getConfig("finalReportURL"),mrh.getConfig("outputLocalPath"))
+                mrh.get_report_to_filename(mrh.getConfig("finalReportURL"),mrh.getConfig("outputLocalPath"))
                 # also place a copy in results dir
                 if (resultsFilename != "") :
                     shutil.copy(mrh.getConfig("outputLocalPath"),os.path.dirname(resultsFilename)+"/"+os.path.basename(mrh.getConfig("outputLocalPath")))
-                # and tidy up
-                mrh.removeRemoteFile(mrh.getHadoopWorkDir()+"/reducer1*") # kill our tempfiles
-                mrh.removeRemoteFile(mrh.getHadoopWorkDir()+"/mapper2*") # kill our tempfiles
-                mrh.removeRemoteFile(mrh.getHadoopWorkDir()+"/reducer2*") # kill our tempfiles
-                mrh.removeRemoteFile(mrh.getHadoopWorkDir()+"/mapper3*") # kill our tempfiles
                 
                 mrh.log("Done.  X!Tandem logs:")
                 mrh.log(results)
@@ -715,8 +859,32 @@ elif (not mrh.runLocal()) : # non-EMR hadoop
                 mrh.log( exception )
             else :
                 sleep(10)                
-                
+
+    # each config's steps run in order, but independent configs share the cluster
+    steps = []
+    lastSteps = {}
+    for nConfigs in range(0,len(workstepsStack)) :
+        deps = []
+        for nStep in range(len(workstepsStack[nConfigs])) :
+            name = "%d.%d" % (nConfigs+1, nStep+1)
+            steps.append((name, deps, lambda workstep=workstepsStack[nConfigs][nStep]: mrh.doHadoopStep(workstep)))
+            deps = [name]
+        if (len(deps)) :
+            lastSteps[deps[0]] = nConfigs
+    def stepDone(name) :
+        if (name in lastSteps) :
+            collectResults(lastSteps[name])
+    mrh.runStepGraph(steps, mrh.getConcurrentSteps(), stepDone)
+    # and tidy up, now that no search is using them
+    for nConfigs in range(0,len(workstepsStack)) :
+        mrh.selectConfig(nConfigs)
+        mrh.removeRemoteFile(mrh.getHadoopWorkDir()+"/reducer1*") # kill our tempfiles
+        mrh.removeRemoteFile(mrh.getHadoopWorkDir()+"/mapper2*") # kill our tempfiles
+        mrh.removeRemoteFile(mrh.getHadoopWorkDir()+"/reducer2*") # kill our tempfiles
+        mrh.removeRemoteFile(mrh.getHadoopWorkDir()+"/mapper3*") # kill our tempfiles
                                  
     # todo - monitor job progress
 # all configs processed
+for (outputPath, shardOutputs) in shardedSearches : # pull database shard results back together
+    database_shards.mergeShardResults(shardOutputs, outputPath)
 mrh.log_close()
@@ -0,0 +1,246 @@
+#
+# spectrum file indexing for MR-Tandem: scan an MGF or mzXML file once, noting where each
+# spectrum lives in the file along with its precursor and peak count, so that the work of
+# searching it can be divided up by estimated cost instead of by simple spectrum count
+#
+# The index stays on the launching machine.  We don't ship it to the cluster as a sidecar
+# for mappers to seek by: the mappers are X!Tandem itself, which reads the whole spectrum file
+# and takes every m'th spectrum, and a slice cut out for it would be renumbered from 1 so the
+# reducer couldn't merge the results.  Nor can the results show coverage, since spectra with
+# no match don't appear in them.  Instead balanceSpectrumFile reorders the file so that every
+# m'th spectrum makes for even mapper loads.
+#
+# Part of the Insilicos Cloud Army Project:
+# see http://sourceforge.net/projects/ica/trunk for latest and greatest
+#
+# Copyright (C) 2011 Insilicos LLC  All Rights Reserved
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import re
+import math
+import mmap
+
+import mapreduce_helper as mrh
+
+PROTON_MASS = 1.007276
+
+# where one spectrum lives in its file, and what we need to know to guess its search cost
+class SpectrumInfo :
+    def __init__(self, ordinal, offset, length, mz, charge, peaks) :
+        self.ordinal = ordinal # position in file, counting from 0
+        self.offset = offset # byte offset of the spectrum's first byte
+        self.length = length # byte count
+        self.mz = mz # precursor m/z
+        self.charge = charge # precursor charge, 0 if not given
+        self.peaks = peaks # number of fragment peaks
+
+    # precursor neutral mass, or 0 if charge is unknown
+    def neutralMass(self) :
+        if (self.charge > 0) :
+            return (self.mz-PROTON_MASS)*self.charge
+        return 0.0
+
+def isMGF(path) :
+    return path.lower().endswith(".mgf")
+
+def isMzXML(path) :
+    return path.lower().endswith(".mzxml")
+
+# returns a list of SpectrumInfo for an MGF or mzXML file, or None for other formats
+def indexSpectrumFile(path) :
+    if (isMGF(path)) :
+        return indexMGF(path)
+    elif (isMzXML(path)) :
+        return indexMzXML(path)
+    return None
+
+# map a whole file read-only, or return "" for an empty one (mmap won't do zero length)
+def mapFile(f) :
+    if (0 == os.fstat(f.fileno()).st_size) :
+        return ""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# CHARGE=2+, CHARGE=2+ and 3+, CHARGE=3- etc - we just want the first one
+def parseCharge(text) :
+    m = re.search(r'(\d+)', text)
+    if (m) :
+        return int(m.group(1))
+    return 0
+
+def indexMGF(path) :
+    entries = []
+    f = open(path,"rb")
+    data = mapFile(f)
+    try :
+        # a CHARGE line ahead of the first spectrum is the default for those that lack one
+        start = data.find("BEGIN IONS")
+        defaultCharge = 0
+        if (start > 0) :
+            m = re.search(r'(?m)^CHARGE=(.*)$', data[:start])
+            if (m) :
+                defaultCharge = parseCharge(m.group(1))
+        while (start >= 0) :
+            end = data.find("END IONS", start)
+            if (end < 0) :
+                end = len(data)
+            else :
+                end = data.find("\n", end)
+                end = len(data) if (end < 0) else end+1
+            mz = 0.0
+            charge = defaultCharge
+            peaks = 0
+            for line in data[start:end].splitlines() :
+                if (line.startswith("PEPMASS=")) :
+                    mz = float(line[8:].split()[0])
+                elif (line.startswith("CHARGE=")) :
+                    charge = parseCharge(line[7:])
+                elif (len(line) and line[0].isdigit()) :
+                    peaks += 1
+            entries.append(SpectrumInfo(len(entries), start, end-start, mz, charge, peaks))
+            start = data.find("BEGIN IONS", end)
+    finally :
+        if (len(data)) :
+            data.close()
+        f.close()
+    return entries
+
+mzXMLTags = re.compile(r'<scan\b([^>]*)>|</scan>|<precursorMz\b([^>]*)>\s*([-+0-9.eE]+)')
+
+def getAttr(attrs, name, default) :
+    m = re.search(r'\b%s="([^"]*)"' % name, attrs)
+    if (m) :
+        return m.group(1)
+    return default
+
+# index the MS2 (and higher) scans of an mzXML file - scans can nest, so we keep a stack
+def indexMzXML(path) :
+    entries = []
+    f = open(path,"rb")
+    data = mapFile(f)
+    try :
+        stack = [] # [offset, msLevel, peaks, mz, charge] for each currently open <scan>
+        for match in mzXMLTags.finditer(data) :
+            if (match.group(0).startswith("<scan")) :
+                attrs = match.group(1)
+                stack.append([match.start(), int(getAttr(attrs,"msLevel","1")), int(getAttr(attrs,"peaksCount","0")), 0.0, 0])
+                if (attrs.endswith("/")) : # empty scan element
+                    stack.pop()
+            elif (match.group(0).startswith("<precursorMz")) :
+                if (len(stack)) :
+                    stack[-1][3] = float(match.group(3))
+                    stack[-1][4] = int(getAttr(match.group(2),"precursorCharge","0"))
+            elif (len(stack)) : # </scan>
+                (offset, msLevel, peaks, mz, charge) = stack.pop()
+                if (msLevel > 1) :
+                    entries.append(SpectrumInfo(len(entries), offset, match.end()-offset, mz, charge, peaks))
+    finally :
+        if (len(data)) :
+            data.close()
+        f.close()
+    return entries
+
+# rough shape of a tryptic digest's peptide mass distribution, which peaks near 1kDa
+# and tails off above that - only relative values matter here
+def candidateDensity(mass) :
+    if (mass <= 0) :
+        return 1.0
+    return max(0.05, (mass/1000.0)*math.exp(1.0-(mass/1000.0)))
+
+# estimated cost of searching a spectrum: scoring work goes as peak count times the number
+# of candidate peptides in its precursor window.  candidateCount(mass) can be supplied when
+# something better than the generic mass distribution is known
+def estimateCost(spectrum, candidateCount=None) :
+    if (spectrum.charge > 0) :
+        masses = [spectrum.neutralMass()]
+    else : # unknown charge, tandem will try it as 2+ and 3+
+        masses = [(spectrum.mz-PROTON_MASS)*2, (spectrum.mz-PROTON_MASS)*3]
+    candidates = 0.0
+    for mass in masses :
+        if (None != candidateCount) :
+            candidates += candidateCount(mass)
+        else :
+            candidates += candidateDensity(mass)
+    return max(1,spectrum.peaks) * max(candidates,0.05)
+
+# deal items out to nslices slices, most expensive first, snaking back and forth across the
+# slices so they end up with equal counts (give or take one) and near equal total cost
+def balanceSlices(costs, nslices) :
+    slices = [[] for n in range(nslices)]
+    byCost = sorted(range(len(costs)), key=lambda i: -costs[i])
+    for r in range(0, len(byCost), nslices) :
+        dealt = byCost[r:r+nslices]
+        if ((len(dealt) == nslices) and ((r/nslices) % 2)) : # full round, alternate direction
+            dealt.reverse()
+        for n in range(len(dealt)) :
+            slices[n].append(dealt[n])
+    return slices
+
+# file order for the sliced items, such that taking every nth of nslices items (which is
+# how the tandem mappers divide up a spectrum file) picks out slice n
+def interleave(slices) :
+    order = []
+    for r in range(max([len(s) for s in slices] + [0])) :
+        for s in slices :
+            if (r < len(s)) :
+                order.append(s[r])
+    return order
+
+# write a copy of an MGF file with its spectra in the given order, keeping any header and trailer
+def writeReorderedMGF(path, entries, order, outPath) :
+    f = open(path,"rb")
+    data = mapFile(f)
+    tmpPath = outPath+".tmp"
+    out = open(tmpPath,"wb")
+    try :
+        if (len(entries)) :
+            out.write(data[:entries[0].offset])
+        for n in order :
+            out.write(data[entries[n].offset:entries[n].offset+entries[n].length])
+        if (len(entries)) :
+            out.write(data[entries[-1].offset+entries[-1].length:])
+    finally :
+        out.close()
+        if (len(data)) :
+            data.close()
+        f.close()
+    os.rename(tmpPath, outPath) # a half written copy never gets mistaken for a good one
+
+# name of the rebalanced copy of a spectrum file, which depends on how many slices it's cut into
+def balancedSpectrumPath(path, nslices) :
+    (base, ext) = os.path.splitext(path)
+    return "%s.balanced%d%s" % (base, nslices, ext)
+
+# returns the path of a copy of spectrum file "path" that's been reordered so that the tandem
+# mappers, taking every nth of nslices spectra each, get about the same amount of work -
+# or just "path" itself if that isn't possible for this file
+def balanceSpectrumFile(path, nslices, candidateCount=None) :
+    if (not isMGF(path)) : # mzXML scans nest and carry a byte offset index, so we leave those alone
+        mrh.info( "spectrum rebalancing only handles MGF, using %s as is" % path )
+        return path
+    outPath = balancedSpectrumPath(path, nslices)
+    if (os.path.exists(outPath) and (os.path.getmtime(outPath) >= os.path.getmtime(path))) :
+        mrh.info( "using existing rebalanced spectrum file %s" % outPath )
+        return outPath
+    entries = indexSpectrumFile(path)
+    if (len(entries) <= nslices) :
+        return path # nothing to gain
+    costs = [estimateCost(e, candidateCount) for e in entries]
+    slices = balanceSlices(costs, nslices)
+    loads = [sum([costs[i] for i in s]) for s in slices]
+    mrh.info( "rebalancing %d spectra in %s across %d mapper slices, estimated max/mean load %.2f" %
+              (len(entries), path, nslices, max(loads)*nslices/sum(loads)) )
+    writeReorderedMGF(path, entries, interleave(slices), outPath)
+    return outPath
@@ -0,0 +1,148 @@
+#
+# tests for hadoop_fs against its LocalWebHDFSServer stand-in, no cluster needed:
+#    python test_hadoop_fs.py
+#
+# Part of the Insilicos Cloud Army Project:
+# see http://sourceforge.net/projects/ica/trunk for latest and greatest
+#
+# Copyright (C) 2011 Insilicos LLC  All Rights Reserved
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+import hadoop_fs
+
+class WebHDFSTest(unittest.TestCase) :
+    def setUp(self) :
+        self.root = tempfile.mkdtemp()
+        self.local = tempfile.mkdtemp()
+        self.server = hadoop_fs.LocalWebHDFSServer(self.root)
+        self.fs = hadoop_fs.WebHDFSFileSystem(self.server.start())
+
+    def tearDown(self) :
+        self.fs.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.local)
+
+    def localFile(self, name, contents) :
+        path = os.path.join(self.local, name)
+        f = open(path, "wb")
+        f.write(contents)
+        f.close()
+        return path
+
+    def test_put_get(self) :
+        self.fs.put(self.localFile("a", "hello"), "/job/a")
+        self.fs.get("/job/a", os.path.join(self.local, "b"))
+        self.assertEqual("hello", open(os.path.join(self.local, "b"), "rb").read())
+        self.assertEqual("hello", self.fs.cat("/job/a"))
+
+    def test_put_stream(self) :
+        self.fs.putStream(lambda f : [f.write("x"*100000) for n in range(30)], "/job/s")
+        self.assertEqual(3000000, self.fs.stat("/job/s").size)
+
+    def test_ls_stat(self) :
+        self.fs.put(self.localFile("a", "12345"), "/job/a")
+        self.fs.mkdir("/job/sub")
+        entries = dict((e.path, e) for e in self.fs.ls("/job"))
+        self.assertEqual(["/job/a", "/job/sub"], sorted(entries.keys()))
+        self.assertEqual(5, entries["/job/a"].size)
+        self.assertTrue(entries["/job/sub"].isDir)
+        self.assertEqual(None, self.fs.stat("/job/nothing"))
+        self.assertEqual(None, self.fs.ls("/nothing"))
+
+    def test_stat_one_entry_directory(self) :
+        self.fs.put(self.localFile("a", "12345"), "/one/only")
+        self.assertTrue(self.fs.stat("/one").isDir)
+        self.assertFalse(self.fs.stat("/one/only").isDir)
+
+    def test_rm(self) :
+        self.fs.put(self.localFile("a", "1"), "/job/a")
+        self.fs.rm("/job/a")
+        self.assertEqual(None, self.fs.stat("/job/a"))
+        self.fs.rm("/job/a") # not there is fine
+
+    def test_rm_wildcard(self) :
+        for name in ("reducer1_1", "reducer1_2", "reducer2_1") :
+            self.fs.put(self.localFile(name, name), "/job/"+name)
+        self.fs.rm("/job/reducer1*")
+        self.assertEqual(["/job/reducer2_1"], [e.path for e in self.fs.ls("/job")])
+
+    def test_stat_cache_forgets_wildcard(self) :
+        cache = hadoop_fs.StatCache(self.fs)
+        for name in ("reducer1_1", "keep") :
+            self.fs.put(self.localFile(name, name), "/job/"+name)
+        self.assertNotEqual(None, cache.stat("/job/reducer1_1"))
+        self.fs.rm("/job/reducer1*")
+        cache.forget("/job/reducer1*")
+        self.assertEqual(None, cache.stat("/job/reducer1_1"))
+        self.assertNotEqual(None, cache.stat("/job/keep"))
+
+    def test_probe(self) :
+        self.fs.mkdir("/job")
+        self.assertTrue(self.fs.probe("/job"))
+        self.assertEqual([], self.fs.ls("/job"))
+
+# the hadoop command line, answered from a local directory the way hadoop fs -ls and -test do
+class LocalCLIFileSystem(hadoop_fs.HadoopCLIFileSystem) :
+    def __init__(self, root) :
+        hadoop_fs.HadoopCLIFileSystem.__init__(self, "hadoop")
+        self.root = root
+
+    def run(self, args, stdin=None) :
+        path = os.path.join(self.root, args[-1].lstrip("/"))
+        if ("-test" == args[0]) :
+            return (int(not os.path.isdir(path)), "")
+        if (not os.path.exists(path)) :
+            return (1, "ls: Cannot access %s: No such file or directory." % args[-1])
+        names = [path]
+        if (os.path.isdir(path)) :
+            names = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        lines = ["Found %d items" % len(names)]
+        for name in names :
+            lines.append("%s   1 user supergroup %10d 2011-06-01 12:00 %s" % ((os.path.isdir(name) and "drwxr-xr-x") or "-rw-r--r--",
+                         (not os.path.isdir(name) and os.path.getsize(name)) or 0, "/"+os.path.relpath(name, self.root)))
+        return (0, "\n".join(lines)+"\n")
+
+class HadoopCLITest(unittest.TestCase) :
+    def setUp(self) :
+        self.root = tempfile.mkdtemp()
+        self.fs = LocalCLIFileSystem(self.root)
+        os.makedirs(os.path.join(self.root, "one", "sub"))
+        f = open(os.path.join(self.root, "one", "only"), "wb")
+        f.write("12345")
+        f.close()
+
+    def tearDown(self) :
+        shutil.rmtree(self.root)
+
+    def test_stat_one_entry_directory(self) :
+        os.rmdir(os.path.join(self.root, "one", "sub"))
+        self.assertTrue(self.fs.stat("/one").isDir)
+        only = self.fs.stat("/one/only")
+        self.assertFalse(only.isDir)
+        self.assertEqual(5, only.size)
+        self.assertEqual(None, self.fs.stat("/nothing"))
+
+    def test_stat_directory(self) :
+        self.assertTrue(self.fs.stat("/one").isDir)
+        self.assertTrue(self.fs.stat("/one/sub").isDir)
+
+if (__name__ == "__main__") :
+    unittest.main()